@@ -0,0 +1,364 @@
+# Standard library imports
+import json
+import logging
+import logging.config
+import os
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from importlib.metadata import entry_points, version
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+from urllib.parse import urlparse
+
+# Third party imports
+import configargparse
+import josepy as jose
+from acme import challenges, client, crypto_util, messages
+from acme import errors as acme_errors
+from certbot import achallenges, configuration
+from certbot import errors as certbot_errors
+from certbot.crypto_util import cert_and_chain_from_fullchain
+from certbot.plugins.common import dest_namespace
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+# Local imports
+from dns_utils import get_dns_zone, wait_for_txt_records
+from key_pool import get_private_key
+
+# Load logging configuration
+logging.config.fileConfig("logging.ini")
+logger = logging.getLogger("acme_issuer")
+
+# Constants
+USER_AGENT = "certicopter"
+ACCOUNT_KEY_SIZE = 2048
+ORDER_TIMEOUT_SECONDS = 180
+
+# Major version of certbot (see requirements.txt) the DNS plugins are loaded with. Other versions log a warning,
+# a plugin that can't be loaded with them fails the issuance with a hint to use the certbot issuance backend.
+CERTBOT_MAJOR_VERSION = 5
+
+# Config files certbot reads its defaults from, the options of the DNS plugin (e.g. its credentials) can be set there
+CERTBOT_CONFIG_FILES = ["/etc/letsencrypt/cli.ini", os.path.join(os.environ.get("XDG_CONFIG_HOME", "~/.config"), "letsencrypt", "cli.ini")]
+
+### Results and errors of an issuance ###
+
+@dataclass
+class IssuedCertificate:
+    domain: str
+    key_type: str
+    cert_pem: bytes
+    chain_pem: bytes
+    fullchain_pem: bytes
+    key_pem: bytes
+
+@dataclass
+class PendingOrder:
+    domain: str
+    key_type: str
+    key_pem: bytes
+    order: messages.OrderResource
+    annotated_challenges: List[achallenges.KeyAuthorizationAnnotatedChallenge]
+
+class AcmeIssuanceError(Exception):
+
+    # Raised for every failed issuance. "stage" tells at which step of the ACME flow it failed
+    # (account, order, authorization, challenge, finalize) and "detail" carries the CA's or plugin's message.
+    def __init__(self, domain: str, stage: str, detail: str):
+        super().__init__(f"Issuance for {domain} failed during {stage}: {detail}")
+        self.domain = domain
+        self.stage = stage
+        self.detail = detail
+
+### In-process ACME client that is set up once per run and then issues certificates for many domains ###
+
+class AcmeIssuer:
+
+    def __init__(
+        self,
+        directory_url: str,
+        email: str,
+        dns_plugin: str,
+        state_directory: Path,
+        certbot_directory: str,
+        propagation_timeout: Optional[int] = None,
+        propagation_nameservers: Optional[List[Tuple[str, int]]] = None
+    ):
+        self.directory_url = directory_url
+        self.email = email
+        self.account_file = state_directory / f"acme_account_{urlparse(directory_url).netloc}.json"
+        logger.debug(f"ACME directory: {self.directory_url}, account file: {self.account_file}")
+
+        # The account is registered once and then loaded from the account file, it is used for every order of the run
+        self.account_key = self.load_account_key()
+        self.network = client.ClientNetwork(self.account_key, user_agent=USER_AGENT)
+        self.client = client.ClientV2(client.ClientV2.get_directory(self.directory_url, self.network), self.network)
+        self.load_account()
+
+        # The DNS plugin of certbot is loaded once per issuer and used in-process to answer the dns-01 challenges.
+        # With a propagation timeout the plugin's fixed propagation sleep is replaced by polling the nameservers,
+        # the measured propagation latency of every DNS zone is kept in propagation_latencies (None if it timed out,
+        # dns_utils.PROPAGATION_NO_NAMESERVERS if the zone had no nameservers to poll).
+        self.propagation_timeout = propagation_timeout
+        self.propagation_nameservers = propagation_nameservers
+        self.propagation_latencies: Dict[str, Optional[float]] = {}
+        self.authenticator = load_dns_authenticator(dns_plugin, email, certbot_directory, skip_propagation_wait=propagation_timeout is not None)
+
+    def load_account_key(self) -> jose.JWKRSA:
+        if self.account_file.exists():
+            return jose.JWKRSA.json_loads(json.loads(self.account_file.read_text())["key"])
+
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=ACCOUNT_KEY_SIZE)
+        return jose.JWKRSA(key=private_key)
+
+    def load_account(self) -> None:
+        if self.account_file.exists():
+            account_uri = json.loads(self.account_file.read_text())["uri"]
+            self.network.account = messages.RegistrationResource(uri=account_uri, body=messages.Registration())
+            logger.debug(f"Loaded ACME account {account_uri}")
+            return
+
+        try:
+            registration = self.client.new_account(messages.NewRegistration.from_data(email=self.email, terms_of_service_agreed=True))
+            account_uri = registration.uri
+
+        except acme_errors.ConflictError as e:
+            # The key is already registered, the CA tells us the account URI
+            account_uri = e.location
+            self.network.account = messages.RegistrationResource(uri=account_uri, body=messages.Registration())
+
+        except (acme_errors.Error, messages.Error) as e:
+            raise AcmeIssuanceError(self.directory_url, "account", str(e))
+
+        self.account_file.write_text(json.dumps({"key": self.account_key.json_dumps(), "uri": account_uri}))
+        self.account_file.chmod(0o600)
+        logger.info(f"Registered ACME account {account_uri}")
+
+    def issue_certificate(self, domain: str, key_type: str) -> IssuedCertificate:
+        issuance_result = self.issue_certificates([(domain, key_type)])[(domain, key_type)]
+
+        if isinstance(issuance_result, AcmeIssuanceError):
+            raise issuance_result
+
+        return issuance_result
+
+    def issue_certificates(self, certificate_requests: List[Tuple[str, str]]) -> Dict[Tuple[str, str], Union[IssuedCertificate, AcmeIssuanceError]]:
+
+        # Issues a batch of (domain, key type) certificates with a single DNS round: the TXT records of all orders are
+        # published together, the DNS plugin waits for propagation once and then all challenges are answered.
+        # A failure only affects the certificates it belongs to, the result holds either the certificate or the error per request.
+        issuance_results: Dict[Tuple[str, str], Union[IssuedCertificate, AcmeIssuanceError]] = {}
+        pending_orders: List[PendingOrder] = []
+
+        for domain, key_type in certificate_requests:
+            try:
+                pending_orders.append(self.place_order(domain, key_type))
+            except AcmeIssuanceError as e:
+                logger.error(str(e))
+                issuance_results[(domain, key_type)] = e
+
+        # Orders for the same domain share their pending authorization, its challenge is only answered once
+        annotated_challenges = list({
+            annotated_challenge.challb.uri: annotated_challenge
+            for pending_order in pending_orders
+            for annotated_challenge in pending_order.annotated_challenges
+        }.values())
+        logger.debug(f"{len(annotated_challenges)} challenges need to be answered for {len(pending_orders)} orders")
+
+        try:
+            if annotated_challenges:
+                self.answer_challenges(annotated_challenges)
+
+            for pending_order in pending_orders:
+                request = (pending_order.domain, pending_order.key_type)
+                try:
+                    issuance_results[request] = self.finalize_order(pending_order)
+                except AcmeIssuanceError as e:
+                    logger.error(str(e))
+                    issuance_results[request] = e
+
+        except AcmeIssuanceError as e:
+            # Publishing or answering the challenges failed, this affects every order of the batch
+            logger.error(str(e))
+            for pending_order in pending_orders:
+                issuance_results[(pending_order.domain, pending_order.key_type)] = AcmeIssuanceError(pending_order.domain, e.stage, e.detail)
+
+        finally:
+            if annotated_challenges:
+                self.cleanup_challenges(annotated_challenges)
+
+        return issuance_results
+
+    def place_order(self, domain: str, key_type: str) -> PendingOrder:
+        # Pre-generated by the key pool if it is running
+        key_pem = get_private_key(key_type)
+
+        try:
+            order = self.client.new_order(crypto_util.make_csr(key_pem, [domain]))
+        except (acme_errors.Error, messages.Error) as e:
+            raise AcmeIssuanceError(domain, "order", str(e))
+
+        # Authorizations the account already validated recently are reused by the CA and come back as valid,
+        # only the pending ones need a challenge to be answered
+        annotated_challenges = self.get_pending_challenges(domain, order)
+        logger.debug(f"{len(annotated_challenges)} of {len(order.authorizations)} authorizations for {domain} need a challenge")
+
+        return PendingOrder(domain=domain, key_type=key_type, key_pem=key_pem, order=order, annotated_challenges=annotated_challenges)
+
+    def finalize_order(self, pending_order: PendingOrder) -> IssuedCertificate:
+        domain = pending_order.domain
+
+        try:
+            deadline = datetime.now() + timedelta(seconds=ORDER_TIMEOUT_SECONDS)
+            order = self.client.poll_and_finalize(pending_order.order, deadline=deadline)
+
+        except acme_errors.ValidationError as e:
+            details = "; ".join(
+                f"{authorization.body.identifier.value}: {challenge.error}"
+                for authorization in e.failed_authzrs
+                for challenge in authorization.body.challenges
+                if challenge.error is not None
+            )
+            raise AcmeIssuanceError(domain, "authorization", details)
+        except acme_errors.TimeoutError as e:
+            raise AcmeIssuanceError(domain, "finalize", f"order didn't complete in time: {str(e)}")
+        except (acme_errors.Error, messages.Error) as e:
+            raise AcmeIssuanceError(domain, "finalize", str(e))
+
+        cert_pem, chain_pem = cert_and_chain_from_fullchain(order.fullchain_pem)
+        logger.info(f"Certificate for {domain} was issued successfully")
+
+        return IssuedCertificate(
+            domain=domain,
+            key_type=pending_order.key_type,
+            cert_pem=cert_pem.encode(),
+            chain_pem=chain_pem.encode(),
+            fullchain_pem=order.fullchain_pem.encode(),
+            key_pem=pending_order.key_pem
+        )
+
+    def get_pending_challenges(self, domain: str, order: messages.OrderResource) -> List[achallenges.KeyAuthorizationAnnotatedChallenge]:
+        annotated_challenges = []
+
+        for authorization in order.authorizations:
+            if authorization.body.status == messages.STATUS_VALID:
+                continue
+
+            challenge_body = next((challenge for challenge in authorization.body.challenges if isinstance(challenge.chall, challenges.DNS01)), None)
+            if challenge_body is None:
+                raise AcmeIssuanceError(domain, "authorization", f"CA didn't offer a dns-01 challenge for {authorization.body.identifier.value}")
+
+            annotated_challenges.append(achallenges.KeyAuthorizationAnnotatedChallenge(
+                challb=challenge_body,
+                identifier=authorization.body.identifier,
+                account_key=self.account_key
+            ))
+
+        return annotated_challenges
+
+    def answer_challenges(self, annotated_challenges: List[achallenges.KeyAuthorizationAnnotatedChallenge]) -> None:
+        domains = ", ".join(annotated_challenge.identifier.value for annotated_challenge in annotated_challenges)
+
+        # The DNS plugin publishes all TXT records first and then waits for their propagation once
+        try:
+            responses = self.authenticator.perform(annotated_challenges)
+        except certbot_errors.Error as e:
+            raise AcmeIssuanceError(domains, "challenge", f"DNS plugin couldn't publish the TXT records: {str(e)}")
+
+        if self.propagation_timeout is not None:
+            self.wait_for_propagation(annotated_challenges)
+
+        try:
+            for annotated_challenge, response in zip(annotated_challenges, responses):
+                self.client.answer_challenge(annotated_challenge.challb, response)
+        except (acme_errors.Error, messages.Error) as e:
+            raise AcmeIssuanceError(domains, "challenge", str(e))
+
+    def wait_for_propagation(self, annotated_challenges: List[achallenges.KeyAuthorizationAnnotatedChallenge]) -> None:
+
+        # Group the expected TXT values by the DNS zone of their record name and wait until the nameservers
+        # of each zone serve them. The challenges are answered after the timeout as well, the CA has the last word.
+        zone_records: Dict[str, Dict[str, set]] = {}
+        for annotated_challenge in annotated_challenges:
+            record_name = annotated_challenge.chall.validation_domain_name(annotated_challenge.identifier.value)
+            record_value = annotated_challenge.chall.validation(self.account_key)
+            zone_records.setdefault(get_dns_zone(record_name), {}).setdefault(record_name, set()).add(record_value)
+
+        for zone, expected_records in zone_records.items():
+            self.propagation_latencies[zone] = wait_for_txt_records(zone, expected_records, self.propagation_timeout, self.propagation_nameservers)
+
+    def cleanup_challenges(self, annotated_challenges: List[achallenges.KeyAuthorizationAnnotatedChallenge]) -> None:
+
+        # A failed cleanup only leaves TXT records behind, it must not fail the issuance
+        try:
+            self.authenticator.cleanup(annotated_challenges)
+        except Exception as e:
+            logger.warning(f"Couldn't remove the challenge TXT records: {str(e)}")
+
+def load_dns_authenticator(dns_plugin: str, email: str, certbot_directory: str, skip_propagation_wait: bool = False):
+
+    # The plugin is found through the "certbot.plugins" entry point it registers, like certbot finds it. Its options are
+    # parsed with the plugin's defaults and certbot's config files, the certbot options the plugins use are set explicitly.
+    certbot_version = version("certbot")
+    if int(certbot_version.split(".")[0]) != CERTBOT_MAJOR_VERSION:
+        logger.warning(f"certbot {certbot_version} is installed, the DNS plugins are loaded for certbot {CERTBOT_MAJOR_VERSION}.x")
+
+    plugin_entry_point = next((entry_point for entry_point in entry_points(group="certbot.plugins") if entry_point.name == dns_plugin), None)
+    if plugin_entry_point is None:
+        raise AcmeIssuanceError(dns_plugin, "account", f"DNS plugin {dns_plugin} is not installed. Uncomment it in the requirements.txt")
+
+    try:
+        plugin_class = plugin_entry_point.load()
+        parser = configargparse.ArgumentParser(default_config_files=CERTBOT_CONFIG_FILES, ignore_unknown_config_file_keys=True, add_help=False)
+        plugin_class.inject_parser_options(parser, dns_plugin)
+        namespace = parser.parse_args([])
+        namespace.config_dir = f"{certbot_directory}/etc/letsencrypt"
+        namespace.work_dir = f"{certbot_directory}/var/lib/letsencrypt"
+        namespace.logs_dir = f"{certbot_directory}/var/log/letsencrypt"
+        namespace.email = email
+        namespace.noninteractive_mode = True
+        namespace.http01_port = 80
+        namespace.https_port = 443
+
+        # Most plugins sleep for a fixed time after publishing the records. It's set to 0 when the
+        # propagation is checked on the nameservers instead (plugins without the option wait on their own API)
+        propagation_option = dest_namespace(dns_plugin) + "propagation_seconds"
+        if skip_propagation_wait and hasattr(namespace, propagation_option):
+            setattr(namespace, propagation_option, 0)
+            logger.debug(f"Fixed propagation wait of {dns_plugin} disabled, the nameservers are polled instead")
+
+        authenticator = plugin_class(configuration.NamespaceConfig(namespace), dns_plugin)
+        authenticator.prepare()
+
+    except (certbot_errors.Error, ImportError, AttributeError, TypeError) as e:
+        raise AcmeIssuanceError(dns_plugin, "account", f"DNS plugin {dns_plugin} couldn't be loaded with certbot {certbot_version}, the certbot issuance backend can be used instead: {str(e)}")
+
+    logger.debug(f"Loaded DNS plugin {dns_plugin}")
+
+    return authenticator
+
+### One issuer per issuance worker, created on first use ###
+
+# The ACME client keeps the nonce of its last request and the DNS plugins keep state between perform and cleanup,
+# so the workers that issue zones at the same time don't share them. The account is registered by the first issuer
+# and loaded from the account file by the others, the lock keeps them from registering one each.
+acme_issuers = threading.local()
+acme_issuer_lock = threading.Lock()
+
+def get_acme_issuer(
+    directory_url: str,
+    email: str,
+    dns_plugin: str,
+    state_directory: Path,
+    certbot_directory: str,
+    propagation_timeout: Optional[int] = None,
+    propagation_nameservers: Optional[List[Tuple[str, int]]] = None
+) -> AcmeIssuer:
+    acme_issuer = getattr(acme_issuers, "acme_issuer", None)
+    if acme_issuer is None:
+        with acme_issuer_lock:
+            acme_issuer = AcmeIssuer(directory_url, email, dns_plugin, state_directory, certbot_directory, propagation_timeout, propagation_nameservers)
+        acme_issuers.acme_issuer = acme_issuer
+
+    return acme_issuer
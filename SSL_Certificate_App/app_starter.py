@@ -6,6 +6,7 @@ import os
 from pathlib import Path
 
 # Local imports
+from config_manager import get_run_mode
 from renew_system_certificates import renew_provider_certificates
 
 # Load logging configuration
@@ -29,12 +30,17 @@ def main():
         
         logger.debug(f"Included providers: {included_providers}")
         logger.debug(f"Excluded providers: {excluded_providers}")
+
+        # Full run, or issue ahead of a maintenance window ("stage") and deploy inside of it ("deploy")
+        run_mode = get_run_mode()
+        logger.info(f"Run mode: {run_mode}")
         
         # Start certificate renewal process
         renew_provider_certificates(
             included_providers=included_providers,
             excluded_providers=excluded_providers,
-            config_file_path="config.json"
+            config_file_path="config.json",
+            run_mode=run_mode
         )
         
     except Exception as e:
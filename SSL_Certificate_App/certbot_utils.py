@@ -2,39 +2,275 @@
 import os
 import logging
 import logging.config
-import shutil
-import zipfile
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
+from typing import Optional, Union
 
 # Local imports
 import config_manager as config_manager
+from acme_issuer import AcmeIssuanceError, AcmeIssuer, IssuedCertificate, get_acme_issuer
+from certificate_archive import CertificateArchive, recover_partial_archives
+from certificate_store import CertificateStore, get_store_directory, recover_partial_manifests
+from dns_utils import PROPAGATION_NO_NAMESERVERS, get_dns_zone, get_registered_domain, parse_nameserver
+from rate_limit_scheduler import RateLimitScheduler
+from trust_anchor import get_root_certificate
 
 # Load logging configuration
 logging.config.fileConfig("logging.ini")
 logger = logging.getLogger("certbot_utils")
 
-# Global set to track domains that need certificates saved
-domains_to_save = set()
+# Archive (or certificate store, depending on "archive_format") of the certificates of this run, created when the first domain is saved
+certificate_archive: Optional[Union[CertificateArchive, CertificateStore]] = None
+certificate_archive_lock = threading.Lock()
 
-def create_instance_certificate(domain, key_type):
+# Files of a domain that go into the archive, the bundles only exist for the providers that need them
+ARCHIVED_CERTIFICATE_PATHS = [
+    "fullChain_path", "caChain_path", "cert_path", "key_path",
+    "vsphereSSL_path", "hycu_path", "vamax_path", "paloalto_path",
+    "rootChain_path"
+]
+
+# Certbot holds a lock on its config, work and logs directories, so only one certbot process can run at a time.
+# Renewals of several instances run concurrently, the lock serializes their certbot calls when the "certbot" issuance backend is used.
+certbot_lock = threading.Lock()
+
+# Certificates issued ahead of the deployment by ZoneIssuance, keyed by (domain, key type).
+# Holds the error instead of the certificate if the issuance failed, so the executor doesn't attempt it a second time.
+issued_certificates = {}
+issued_certificates_lock = threading.Lock()
+
+# Returned for zones whose DNS propagation wasn't checked (check disabled or no challenge needed)
+PROPAGATION_NOT_MEASURED = -1.0
+
+def create_instance_certificate(domain, key_type) -> IssuedCertificate:
     logger.debug(f"Key type for certificate generation is: {key_type}")
     logger.debug(f"Notification email for certificate generation is: {config_manager.notification_email}")
     logger.debug(f"DNS plugin for certificate generation is: {config_manager.dns_plugin}")
 
-    # Executing a shell command using the certbot library for generating the Let's Encrypt SSL certificate for a specific domain. 
-    # Include the --test-cert flag if you want to test certificate generation.
+    # Use the certificate if it was already issued together with the other domains of its DNS zone
+    with issued_certificates_lock:
+        issuance_result = issued_certificates.get((domain, key_type))
+
+    if isinstance(issuance_result, AcmeIssuanceError):
+        raise issuance_result
+    if issuance_result is not None:
+        logger.debug(f"Certificate for {domain} was already issued in this run")
+        return issuance_result
+
+    if config_manager.issuance_backend == "certbot":
+        create_instance_certificate_with_certbot(domain, key_type)
+        issued_certificate = load_issued_certificate(domain, key_type)
+
+    else:
+        # The in-process ACME client loads the account and the DNS plugin once per run and returns the certificate directly
+        try:
+            issued_certificate = get_configured_acme_issuer().issue_certificate(domain, key_type)
+
+        except AcmeIssuanceError as e:
+            logger.error(str(e))
+            raise
+
+        # The files are only written to the live directory for the archive, the executors get the bytes
+        write_issued_certificate(issued_certificate)
+
+    # Add domain to list of domains to save
+    save_certificates_to_zip(domain, key_type)
+
+    return issued_certificate
+
+def get_configured_acme_issuer() -> AcmeIssuer:
+    return get_acme_issuer(
+        directory_url=config_manager.acme_directory_url,
+        email=config_manager.notification_email,
+        dns_plugin=config_manager.dns_plugin,
+        state_directory=config_manager.get_state_directory(),
+        certbot_directory=config_manager.DEFAULT_CERTIFICATE_FOLDER,
+        propagation_timeout=config_manager.dns_propagation_timeout if config_manager.dns_propagation_check else None,
+        propagation_nameservers=[parse_nameserver(nameserver) for nameserver in config_manager.dns_propagation_nameservers] or None
+    )
+
+### Certificates of a run, issued on demand with one DNS round per DNS zone ###
+
+class ZoneIssuance:
+
+    # The first instance of a DNS zone that needs its certificate issues the certificates of all (domain, key type) requests
+    # of the zone, so the zone needs only one DNS propagation wait. The other instances of the zone find theirs in issued_certificates.
+    # Safe to use from several workers, every zone is issued once. Created orders and failed issuances are reported to the rate limit scheduler, if given.
+    def __init__(
+        self,
+        certificate_requests: list[tuple[str, str]],
+        domain_zones: Optional[dict[str, str]] = None,
+        rate_limit_scheduler: Optional[RateLimitScheduler] = None
+    ):
+        self.lock = threading.Lock()
+        self.zone_locks: dict[str, threading.Lock] = {}
+        self.propagation_latencies: dict[str, Optional[float]] = {}
+        self.domain_zones: dict[str, str] = {}
+        self.zone_requests: dict[str, list[tuple[str, str]]] = {}
+        self.rate_limit_scheduler = rate_limit_scheduler
+
+        certificate_requests = sorted(set(certificate_requests))
+        if not certificate_requests:
+            return
+
+        # Batched issuance isn't available with the certbot backend, every domain is its own group
+        if config_manager.issuance_backend == "certbot":
+            domain_zones = {domain: domain for domain, _ in certificate_requests}
+        elif domain_zones is None:
+            domain_zones = get_domain_zones([domain for domain, _ in certificate_requests])
+
+        for certificate_request in certificate_requests:
+            zone = domain_zones.get(certificate_request[0], certificate_request[0])
+            self.domain_zones[certificate_request[0]] = zone
+            self.zone_requests.setdefault(zone, []).append(certificate_request)
+
+        logger.info(f"{len(certificate_requests)} certificates are issued in {len(self.zone_requests)} DNS zones")
+
+    def get_zone(self, domain: str) -> str:
+        return self.domain_zones.get(domain, domain)
+
+    def ensure_issued(self, domain: str) -> None:
+
+        # Issue the certificates of the zone of the domain unless that already happened. Failures are kept in
+        # issued_certificates and raised by create_instance_certificate, the zone isn't attempted a second time.
+        zone = self.get_zone(domain)
+        with self.lock:
+            zone_lock = self.zone_locks.setdefault(zone, threading.Lock())
+
+        with zone_lock:
+            if zone in self.propagation_latencies or zone not in self.zone_requests:
+                return
+            if config_manager.issuance_backend == "certbot":
+                self.propagation_latencies[zone] = issue_certbot_certificates(self.zone_requests[zone])
+            else:
+                self.propagation_latencies[zone] = issue_zone_certificates(zone, self.zone_requests[zone])
+
+            if self.rate_limit_scheduler is not None:
+                self.record_results(zone)
+
+    def record_results(self, zone: str) -> None:
+
+        # Only the requests that got as far as an order use up the limits of the CA: a failure while loading the account
+        # or placing the order didn't create one. The CA counts its limits per registered domain, which can span several delegated zones.
+        with issued_certificates_lock:
+            issuance_results = {certificate_request: issued_certificates.get(certificate_request) for certificate_request in self.zone_requests.get(zone, [])}
+
+        for (domain, key_type), issuance_result in issuance_results.items():
+            if isinstance(issuance_result, IssuedCertificate):
+                self.rate_limit_scheduler.record_order(domain, key_type, issued=True)
+
+            elif isinstance(issuance_result, AcmeIssuanceError):
+                if issuance_result.stage not in ("account", "order"):
+                    self.rate_limit_scheduler.record_order(domain, key_type, issued=False)
+                self.rate_limit_scheduler.record_failure(domain, get_registered_domain(domain), issuance_result.stage, issuance_result.detail)
+
+    def log_propagation_latencies(self) -> None:
+
+        # Report how long the TXT records took to reach the nameservers of each zone, slowest first, to see which DNS hosting is slow.
+        # Zones without nameservers to poll are reported on their own, their records weren't checked.
+        measured_latencies = {zone: latency for zone, latency in self.propagation_latencies.items() if latency not in (PROPAGATION_NOT_MEASURED, PROPAGATION_NO_NAMESERVERS)}
+        if measured_latencies:
+            logger.info("DNS propagation per zone: " + ", ".join(
+                f"{zone} {'timed out' if latency is None else f'{latency:.1f}s'}"
+                for zone, latency in sorted(measured_latencies.items(), key=lambda item: float("inf") if item[1] is None else item[1], reverse=True)
+            ))
+
+        unchecked_zones = sorted(zone for zone, latency in self.propagation_latencies.items() if latency == PROPAGATION_NO_NAMESERVERS)
+        if unchecked_zones:
+            logger.warning(f"DNS propagation wasn't checked for zones without nameservers: {', '.join(unchecked_zones)}")
+
+def get_domain_zones(domains: list[str]) -> dict[str, str]:
+
+    # DNS zone of every domain, looked up concurrently
+    domains = sorted(set(domains))
+    with ThreadPoolExecutor(max_workers=config_manager.max_workers, thread_name_prefix="issuance") as executor:
+        return dict(zip(domains, executor.map(get_dns_zone, domains)))
+
+def issue_zone_certificates(zone: str, certificate_requests: list[tuple[str, str]]) -> Optional[float]:
+
+    # Returns the measured DNS propagation latency of the zone (None if it timed out)
+    logger.info(f"Issuing {len(certificate_requests)} certificates for DNS zone {zone}")
+    propagation_latency = PROPAGATION_NOT_MEASURED
+
+    try:
+        acme_issuer = get_configured_acme_issuer()
+        issuance_results = acme_issuer.issue_certificates(certificate_requests)
+        propagation_latency = acme_issuer.propagation_latencies.get(zone, PROPAGATION_NOT_MEASURED)
+    except Exception as e:
+        logger.error(f"Issuance for DNS zone {zone} failed: {str(e)}")
+        issuance_results = {
+            (domain, key_type): AcmeIssuanceError(domain, "account", str(e))
+            for domain, key_type in certificate_requests
+        }
+
+    for (domain, key_type), issuance_result in issuance_results.items():
+        if isinstance(issuance_result, IssuedCertificate):
+            write_issued_certificate(issuance_result)
+            save_certificates_to_zip(domain, key_type)
+
+        with issued_certificates_lock:
+            issued_certificates[(domain, key_type)] = issuance_result
+
+    return propagation_latency
+
+def issue_certbot_certificates(certificate_requests: list[tuple[str, str]]) -> float:
+
+    # Issue the certificates of one domain with certbot and keep the results in issued_certificates, like issue_zone_certificates.
+    # Certbot doesn't report the propagation latency.
+    for domain, key_type in certificate_requests:
+        try:
+            create_instance_certificate_with_certbot(domain, key_type)
+            issuance_result = load_issued_certificate(domain, key_type)
+            save_certificates_to_zip(domain, key_type)
+        except AcmeIssuanceError as e:
+            issuance_result = e
+        except Exception as e:
+            issuance_result = AcmeIssuanceError(domain, "order", str(e))
+
+        with issued_certificates_lock:
+            issued_certificates[(domain, key_type)] = issuance_result
+
+    return PROPAGATION_NOT_MEASURED
+
+def create_instance_certificate_with_certbot(domain, key_type):
+
+    # Executing the certbot command line for generating the Let's Encrypt SSL certificate for a specific domain. 
+    # Set "acme_directory_url" to the staging directory if you want to test certificate generation.
+    # The arguments are passed as a list without a shell, so values from the configuration are never interpreted by one.
+    # Certbot writes its messages to stderr, they are kept so a failure can be reported with the CA's error (e.g. a rate limit).
+    certbot_command = [
+        "certbot", "certonly",
+        "--config-dir", f"{config_manager.DEFAULT_CERTIFICATE_FOLDER}/etc/letsencrypt",
+        "--work-dir", f"{config_manager.DEFAULT_CERTIFICATE_FOLDER}/var/lib/letsencrypt",
+        "--logs-dir", f"{config_manager.DEFAULT_CERTIFICATE_FOLDER}/var/log/letsencrypt",
+        "--server", config_manager.acme_directory_url,
+        f"--{config_manager.dns_plugin}",
+        "-d", domain,
+        "--cert-name", lineage_name(domain, key_type),
+        "-n",
+        "--agree-tos",
+        "--key-type", key_type,
+        "-m", config_manager.notification_email
+    ]
+
     try:
-        os.system(f"certbot certonly --config-dir {config_manager.DEFAULT_CERTIFICATE_FOLDER}/etc/letsencrypt --work-dir {config_manager.DEFAULT_CERTIFICATE_FOLDER}/var/lib/letsencrypt --logs-dir {config_manager.DEFAULT_CERTIFICATE_FOLDER}/var/log/letsencrypt --{config_manager.dns_plugin} -d {domain} -n --agree-tos --key-type {key_type} -m {config_manager.notification_email}")
+        with certbot_lock:
+            certbot_process = subprocess.run(certbot_command, stderr=subprocess.PIPE, text=True)
 
-        if os.path.exists(f"{config_manager.DEFAULT_CERTIFICATE_FOLDER}/etc/letsencrypt/live/{domain}"):
+        if certbot_process.returncode == 0 and os.path.exists(f"{config_manager.DEFAULT_CERTIFICATE_FOLDER}/etc/letsencrypt/live/{lineage_name(domain, key_type)}"):
+            logger.debug(f"Certbot output for {domain}: {certbot_process.stderr.strip()}")
             logger.info(f"Certificate for {domain} was issued successfully")
-            
-            # Add domain to list of domains to save
-            save_certificates_to_zip(domain)
         else:
-            logger.error(f"Certificate for {domain} was not issued successfully")
-            raise
+            logger.error(f"Certificate for {domain} was not issued successfully: {certbot_process.stderr.strip()}")
+            stage = "authorization" if "failed to authenticate" in certbot_process.stderr else "order"
+            raise AcmeIssuanceError(domain, stage, certbot_process.stderr.strip() or f"certbot exited with {certbot_process.returncode}")
+    except AcmeIssuanceError:
+        raise
     except ValueError:
         logger.error("Your inputs for the 'certbot' command aren't valid. Please check if you own the domain and if you entered a valid key type.")
         raise
@@ -42,23 +278,69 @@ def create_instance_certificate(domain, key_type):
         logger.error(f"An error occurred while generating the certificate for {domain}: {str(e)}")
         raise
 
-    logger.info(f"Certificate for {domain} was issued successfully")
+def write_issued_certificate(issued_certificate: IssuedCertificate) -> None:
 
-def certificate_paths(domain: str, requested_paths: list[str]) -> tuple[str, ...]:
+    # Same file layout as certbot's live directory. Symlinks left by earlier certbot runs are replaced by plain files.
+    # Nothing is written if the certificates aren't archived.
+    if config_manager.save_certificates != "y":
+        return
+
+    fullChain_path, caChain_path, cert_path, key_path = certificate_paths(
+        domain=issued_certificate.domain,
+        key_type=issued_certificate.key_type,
+        requested_paths=["fullChain_path", "caChain_path", "cert_path", "key_path"]
+    )
+
+    Path(cert_path).parent.mkdir(parents=True, exist_ok=True)
+    for file_path, content in (
+        (fullChain_path, issued_certificate.fullchain_pem),
+        (caChain_path, issued_certificate.chain_pem),
+        (cert_path, issued_certificate.cert_pem),
+        (key_path, issued_certificate.key_pem)
+    ):
+        path = Path(file_path)
+        if path.is_symlink():
+            path.unlink()
+        path.write_bytes(content)
+
+    Path(key_path).chmod(0o600)
+    logger.debug(f"Certificate files for {issued_certificate.domain} were written to {Path(cert_path).parent}")
+
+def load_issued_certificate(domain, key_type) -> IssuedCertificate:
+    fullChain_path, caChain_path, cert_path, key_path = certificate_paths(domain=domain, key_type=key_type, requested_paths=["fullChain_path", "caChain_path", "cert_path", "key_path"])
+    loaded_files = load_certificate_files("binary", fullChain_path=fullChain_path, caChain_path=caChain_path, cert_path=cert_path, key_path=key_path)
+
+    return IssuedCertificate(
+        domain=domain,
+        key_type=key_type,
+        cert_pem=loaded_files["cert_path"],
+        chain_pem=loaded_files["caChain_path"],
+        fullchain_pem=loaded_files["fullChain_path"],
+        key_pem=loaded_files["key_path"]
+    )
+
+def lineage_name(domain: str, key_type: str) -> str:
+
+    # Name of the certificate of a domain and key type: its directory in the live directory and in the archive.
+    # Instances that share a domain but not the key type get their own files.
+    return f"{domain}_{key_type}"
+
+def certificate_paths(domain: str, key_type: str, requested_paths: list[str]) -> tuple[str, ...]:
 
     logger.debug(f"Required paths that are getting requested: {requested_paths}")
+    live_directory = f"{config_manager.DEFAULT_CERTIFICATE_FOLDER}/etc/letsencrypt/live/{lineage_name(domain, key_type)}"
 
     # All paths that are needed for finding a file are entered here
     PATH_MAP = {
-        "fullChain_path": f"{config_manager.DEFAULT_CERTIFICATE_FOLDER}/etc/letsencrypt/live/{domain}/fullchain.pem",
-        "caChain_path": f"{config_manager.DEFAULT_CERTIFICATE_FOLDER}/etc/letsencrypt/live/{domain}/chain.pem",
-        "cert_path": f"{config_manager.DEFAULT_CERTIFICATE_FOLDER}/etc/letsencrypt/live/{domain}/cert.pem",
-        "key_path": f"{config_manager.DEFAULT_CERTIFICATE_FOLDER}/etc/letsencrypt/live/{domain}/privkey.pem",
-        "vsphereSSL_path": f"{config_manager.DEFAULT_CERTIFICATE_FOLDER}/etc/letsencrypt/live/{domain}/vsphere.pem",
-        "hycu_path": f"{config_manager.DEFAULT_CERTIFICATE_FOLDER}/etc/letsencrypt/live/{domain}/hycu.pem",
-        "vamax_path": f"{config_manager.DEFAULT_CERTIFICATE_FOLDER}/etc/letsencrypt/live/{domain}/vamax.pem",
-        "paloalto_path": f"{config_manager.DEFAULT_CERTIFICATE_FOLDER}/etc/letsencrypt/live/{domain}/paloalto.pem",
-        "rootChain_path": f"{config_manager.DEFAULT_CERTIFICATE_FOLDER}/etc/letsencrypt/live/{domain}/root.pem"
+        "fullChain_path": f"{live_directory}/fullchain.pem",
+        "caChain_path": f"{live_directory}/chain.pem",
+        "cert_path": f"{live_directory}/cert.pem",
+        "key_path": f"{live_directory}/privkey.pem",
+        "vsphereSSL_path": f"{live_directory}/vsphere.pem",
+        "hycu_path": f"{live_directory}/hycu.pem",
+        "vamax_path": f"{live_directory}/vamax.pem",
+        "paloalto_path": f"{live_directory}/paloalto.pem",
+        "rootChain_path": f"{live_directory}/root.pem"
     }
 
     return tuple(PATH_MAP[path] for path in requested_paths if path in PATH_MAP)
@@ -109,111 +391,128 @@ def get_output_directory() -> Path:
         output_dir = config_manager.DEFAULT_CERTIFICATE_FOLDER
     return Path(output_dir)
 
-def save_certificates_to_zip(domain: str) -> None:
+def get_certificate_archive() -> Union[CertificateArchive, CertificateStore]:
+    global certificate_archive
+
+    with certificate_archive_lock:
+        if certificate_archive is None:
+            output_dir = get_output_directory()
+            if config_manager.archive_format == "store":
+                store_dir = get_store_directory(output_dir)
+                certificate_archive = CertificateStore(store_dir)
+                recover_partial_manifests(store_dir)
+            else:
+                recover_partial_archives(output_dir)
+                certificate_archive = CertificateArchive(output_dir)
 
-    # Add a domain to the list of domains whose certificates need to be saved.
-    # The actual saving will happen when create_final_certificate_zip is called.
+        return certificate_archive
+
+def save_certificates_to_zip(domain: str, key_type: str, path_names: Optional[list[str]] = None) -> None:
+
+    # Append the files of a domain to the archive of this run as soon as they are written.
+    # Called once the certificate is issued and again for the provider bundles.
     if config_manager.save_certificates != "y":
         logger.debug("Certificate saving is disabled")
         return
 
-    domains_to_save.add(domain)
-    logger.debug(f"Added {domain} to domains to save")
+    try:
+        file_paths = certificate_paths(domain, key_type, path_names or ARCHIVED_CERTIFICATE_PATHS)
+        get_certificate_archive().add_files(lineage_name(domain, key_type), list(file_paths))
+
+    except Exception as e:
+        logger.error(f"Failed to add the certificates of {domain} to the archive: {str(e)}")
 
 def create_final_certificate_zip() -> str:
 
-    # Create a single zip file containing all certificates for all domains.
+    # Finalize the archive of this run that holds the certificates of all domains.
     # Returns the path to the zip file if created, None otherwise.
-    if not domains_to_save or config_manager.save_certificates != "y":
+    if certificate_archive is None or config_manager.save_certificates != "y":
         logger.debug("No certificates to save")
         return None
 
     try:
-        # Get output directory from environment variable
-        output_dir = get_output_directory()
-
-        # Create a temporary directory for all certificates
-        temp_dir = Path("/tmp/certificates_temp")
-        temp_dir.mkdir(exist_ok=True)
-
-        # Process each domain
-        for domain in domains_to_save:
-            # Create domain-specific directory
-            domain_dir = temp_dir / domain
-            domain_dir.mkdir(exist_ok=True)
-
-            # Get all certificate paths for this domain
-            cert_paths = certificate_paths(domain, [
-                "fullChain_path", "caChain_path", "cert_path", "key_path",
-                "vsphereSSL_path", "hycu_path", "vamax_path", "paloalto_path",
-                "rootChain_path"
-            ])
-
-            # Copy all certificate files to the domain directory
-            for cert_path in cert_paths:
-                if os.path.exists(cert_path):
-                    file_name = os.path.basename(cert_path)
-                    shutil.copy2(cert_path, domain_dir / file_name)
-
-        # Create zip file with timestamp
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        zip_path = output_dir / f"all_certificates_{timestamp}.zip"
-        
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for domain_dir in temp_dir.glob('*'):
-                if domain_dir.is_dir():
-                    for file_path in domain_dir.glob('*'):
-                        # Store files in zip with domain name as prefix
-                        zipf.write(file_path, f"{domain_dir.name}/{file_path.name}")
-
-        # Clean up temporary directory
-        shutil.rmtree(temp_dir)
-
-        logger.info(f"All certificates saved to {zip_path}")
-        return str(zip_path)
+        archive_path = certificate_archive.finalize()
+
+        # The store only keeps the runs of the retention, blobs of the removed runs are deleted if no other run uses them
+        if isinstance(certificate_archive, CertificateStore):
+            certificate_archive.apply_retention(config_manager.archive_retention_runs)
+            certificate_archive.compact()
+
+        return archive_path
 
     except Exception as e:
         logger.error(f"Failed to create final certificate zip: {str(e)}")
         return None
 
-### All concatenation functions to generate a specific file based on the provider if the provider needs the files provided by Let's Encrypt in a given order. ###
+### Provider specific certificate bundles, assembled in memory from the files provided by Let's Encrypt ###
 
-def concat_certificates_vsphere(cert_path, caChain_path, rootChain_path, vsphereSSL_path):
-    try:
-        os.system(f"cat {cert_path} {caChain_path} isrgrootx1.pem > {vsphereSSL_path}")
-        logger.debug(f"File was concatenated to {vsphereSSL_path}")
-        os.system(f"cat {caChain_path} isrgrootx1.pem > {rootChain_path}")
-        logger.debug(f"File was concatenated to {rootChain_path}")
-    
-    except ValueError:
-        logger.error(f"Can't concatenate the files to your specified location. The provided paths were:\n{cert_path},\n{caChain_path},\n{rootChain_path},\n{vsphereSSL_path}")
-        raise
+@dataclass
+class CertificateArtifacts:
 
-def concat_certificates_vamax(key_path, cert_path, caChain_path, vamax_path):
-    try:
-        os.system(f"cat {key_path} {cert_path} {caChain_path} isrgrootx1.pem > {vamax_path}")
-        logger.debug(f"File was concatenated to {vamax_path}")
+    # Certificate, chain, key and root certificate of one issuance, loaded once. The bundle functions put them
+    # together in the order the provider needs, the executors post the bytes directly.
+    domain: str
+    key_type: str
+    cert_pem: bytes
+    chain_pem: bytes
+    fullchain_pem: bytes
+    key_pem: bytes
+    root_pem: bytes
 
-    except ValueError:
-        logger.error(f"Can't concatenate the files to your specified location. The provided paths were:\n{key_path},\n{cert_path},\n{caChain_path},\n{vamax_path}")
-        raise
+    def root_chain(self) -> bytes:
+        return join_pem(self.chain_pem, self.root_pem)
 
-def concat_certificates_hycu(cert_path, caChain_path, hycu_path):
-    try:
-        os.system(f"cat {cert_path} {caChain_path} isrgrootx1.pem > {hycu_path}")
-        logger.debug(f"File was concatenated to {hycu_path}")
+    def vsphere_bundle(self) -> bytes:
+        return join_pem(self.cert_pem, self.chain_pem, self.root_pem)
 
-    except ValueError:
-        logger.error(f"Can't concatenate the files to your specified location. The provided paths were:\n{cert_path},\n{caChain_path},\n{hycu_path}")
-        raise
+    def hycu_bundle(self) -> bytes:
+        return join_pem(self.cert_pem, self.chain_pem, self.root_pem)
 
-def concat_certificates_paloalto(key_path, fullChain_path, paloalto_path):
-    try:
-        os.system(f"cat {key_path} {fullChain_path} > {paloalto_path}")
-        logger.debug(f"File was concatenated to {paloalto_path}")
+    def vamax_bundle(self) -> bytes:
+        return join_pem(self.key_pem, self.cert_pem, self.chain_pem, self.root_pem)
 
-    except ValueError:
-        logger.error(f"Can't concatenate the files to your specified location. The provided paths were:\n{key_path},\n{fullChain_path},\n{paloalto_path}")
-        raise
+    def paloalto_bundle(self, key_pem: Optional[bytes] = None) -> bytes:
+
+        # The firewall needs the key encrypted with the passphrase, the executor passes the encrypted key
+        return join_pem(key_pem or self.key_pem, self.fullchain_pem)
+
+    def save(self, **artifacts: bytes) -> None:
+
+        # Bundles are only written to the live directory if the certificates are archived, e.g. save(vamax_path=bundle)
+        if config_manager.save_certificates != "y":
+            return
+
+        for path_name, content in artifacts.items():
+            artifact_path, = certificate_paths(domain=self.domain, key_type=self.key_type, requested_paths=[path_name])
+            Path(artifact_path).parent.mkdir(parents=True, exist_ok=True)
+            Path(artifact_path).write_bytes(content)
+            logger.debug(f"Certificate bundle was saved to {artifact_path}")
+
+        save_certificates_to_zip(self.domain, self.key_type, list(artifacts))
+
+def join_pem(*pem_blocks: bytes) -> bytes:
+
+    # Same result as "cat", but every block ends with a newline so the next one starts on its own line
+    return b"".join(pem_block if pem_block.endswith(b"\n") else pem_block + b"\n" for pem_block in pem_blocks if pem_block)
+
+@lru_cache(maxsize=None)
+def load_root_certificate() -> bytes:
+
+    # The root certificate is the same for all instances, it is loaded once per run from the trust anchor cache
+    return get_root_certificate(config_manager.get_state_directory(), config_manager.root_certificate_refresh_days)
+
+def build_certificate_artifacts(issued_certificate: IssuedCertificate) -> CertificateArtifacts:
+    return CertificateArtifacts(
+        domain=issued_certificate.domain,
+        key_type=issued_certificate.key_type,
+        cert_pem=issued_certificate.cert_pem,
+        chain_pem=issued_certificate.chain_pem,
+        fullchain_pem=issued_certificate.fullchain_pem,
+        key_pem=issued_certificate.key_pem,
+        root_pem=load_root_certificate()
+    )
 
+def create_certificate_artifacts(domain, key_type) -> CertificateArtifacts:
 
+    # Get the certificate from Let's Encrypt (or from the batched issuance of this run) and load everything the bundles need
+    return build_certificate_artifacts(create_instance_certificate(domain=domain, key_type=key_type))
@@ -0,0 +1,97 @@
+# Standard library imports
+import logging
+import logging.config
+import os
+import threading
+import zipfile
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+
+# Load logging configuration
+logging.config.fileConfig("logging.ini")
+logger = logging.getLogger("certificate_archive")
+
+# Constants
+ARCHIVE_NAME_PREFIX = "all_certificates_"
+PARTIAL_SUFFIX = ".partial"
+
+### Archive of the certificates of one run, written while the renewals are running ###
+
+class CertificateArchive:
+
+    # The files of a domain are appended to "<archive>.zip.partial" as soon as they are written, straight from the live directory.
+    # The zip is closed after every append, so the partial archive is always a complete zip file and a crash keeps what was written so far.
+    # At the end of the run the partial archive is renamed to its final name in one step.
+    def __init__(self, output_directory: Path, archive_name: Optional[str] = None):
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        self.archive_path = output_directory / (archive_name or f"{ARCHIVE_NAME_PREFIX}{timestamp}.zip")
+        self.partial_path = self.archive_path.with_name(self.archive_path.name + PARTIAL_SUFFIX)
+
+        # Several renewal workers can finish at the same time, the lock serializes their appends
+        self.lock = threading.Lock()
+        self.archived_files: Set[str] = set()
+        self.finalized = False
+
+    def add_files(self, domain: str, file_paths: List[str]) -> int:
+
+        # Returns the number of files that were appended. Files that are already in the archive are skipped,
+        # e.g. the certificate of a domain that is deployed to several instances.
+        return self.add_entries(domain, {f"{domain}/{os.path.basename(file_path)}": file_path for file_path in file_paths})
+
+    def add_entries(self, domain: str, entries: Dict[str, str]) -> int:
+
+        # Same as add_files with the name of each file in the archive given, e.g. for files that are stored under another name
+        with self.lock:
+            if self.finalized:
+                logger.warning(f"Archive {self.archive_path} is already finalized, files of {domain} are not added")
+                return 0
+
+            archive_names = {
+                archive_name: file_path
+                for archive_name, file_path in entries.items()
+                if archive_name not in self.archived_files and os.path.exists(file_path)
+            }
+
+            if not archive_names:
+                return 0
+
+            with zipfile.ZipFile(self.partial_path, "a", zipfile.ZIP_DEFLATED) as zip_file:
+                for archive_name, file_path in archive_names.items():
+                    zip_file.write(file_path, archive_name)
+
+            self.archived_files.update(archive_names)
+            logger.debug(f"Added {len(archive_names)} files of {domain} to {self.partial_path}")
+            return len(archive_names)
+
+    def finalize(self) -> Optional[str]:
+
+        # Returns the path of the archive, None if nothing was archived
+        with self.lock:
+            self.finalized = True
+            if not self.archived_files:
+                return None
+
+            os.replace(self.partial_path, self.archive_path)
+            logger.info(f"Archive with {len(self.archived_files)} files was finalized: {self.archive_path}")
+            return str(self.archive_path)
+
+def recover_partial_archives(output_directory: Path) -> List[str]:
+
+    # Partial archives left by a run that crashed are complete zip files up to their last append, they are finalized under their own name
+    recovered_archives = []
+    for partial_path in sorted(output_directory.glob(f"{ARCHIVE_NAME_PREFIX}*.zip{PARTIAL_SUFFIX}")):
+        archive_path = partial_path.with_name(partial_path.name[:-len(PARTIAL_SUFFIX)])
+        try:
+            with zipfile.ZipFile(partial_path) as zip_file:
+                file_count = len(zip_file.namelist())
+
+        except zipfile.BadZipFile:
+            logger.error(f"Partial archive {partial_path} of a previous run is damaged and is left as it is")
+            continue
+
+        os.replace(partial_path, archive_path)
+        recovered_archives.append(str(archive_path))
+        logger.warning(f"Recovered archive with {file_count} files of a previous run that didn't finish: {archive_path}")
+
+    return recovered_archives
@@ -0,0 +1,127 @@
+# Standard library imports
+import logging
+import logging.config
+import sqlite3
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Optional
+
+# Load logging configuration
+logging.config.fileConfig("logging.ini")
+logger = logging.getLogger("certificate_inventory")
+
+# Constants
+INVENTORY_FILE_NAME = "certificate_inventory.sqlite3"
+
+### One row of the inventory: what was deployed to which instance ###
+
+@dataclass
+class InventoryRecord:
+    domain: str
+    instance: str
+    provider: str
+    serial: str
+    fingerprint: str
+    not_after: datetime
+    key_type: str
+    deployed_at: datetime
+    appliance_certificate_id: Optional[str] = None
+
+    # ARI certificate ID of the deployed certificate (renewal_info.certificate_identifier), for asking the CA when to renew it
+    renewal_info_id: Optional[str] = None
+
+    def remaining_days(self, now: Optional[datetime] = None) -> float:
+        now = now or datetime.now(timezone.utc)
+        return (self.not_after - now).total_seconds() / 86400
+
+### Persistent inventory of issued and deployed certificates, keyed by domain and instance ###
+
+class CertificateInventory:
+
+    def __init__(self, database_path: Path):
+        self.database_path = database_path
+        logger.debug(f"Inventory database: {self.database_path}")
+
+        # The connection is shared by the renewal workers, the lock serializes its use
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(self.database_path), check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS certificates (
+                domain TEXT NOT NULL,
+                instance TEXT NOT NULL,
+                provider TEXT NOT NULL,
+                serial TEXT NOT NULL,
+                fingerprint TEXT NOT NULL,
+                not_after TEXT NOT NULL,
+                key_type TEXT NOT NULL,
+                deployed_at TEXT NOT NULL,
+                appliance_certificate_id TEXT,
+                renewal_info_id TEXT,
+                PRIMARY KEY (domain, instance)
+            )
+            """
+        )
+
+        # Inventories of earlier versions don't have the ARI certificate ID yet
+        columns = [column[1] for column in self.connection.execute("PRAGMA table_info(certificates)")]
+        if "renewal_info_id" not in columns:
+            self.connection.execute("ALTER TABLE certificates ADD COLUMN renewal_info_id TEXT")
+        self.connection.commit()
+
+    def get_record(self, domain: str, instance: str) -> Optional[InventoryRecord]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT * FROM certificates WHERE domain = ? AND instance = ?",
+                (domain, instance)
+            ).fetchone()
+
+        return self.row_to_record(row) if row else None
+
+    def record_deployment(self, record: InventoryRecord) -> None:
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO certificates VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    record.domain,
+                    record.instance,
+                    record.provider,
+                    record.serial,
+                    record.fingerprint,
+                    record.not_after.astimezone(timezone.utc).isoformat(),
+                    record.key_type,
+                    record.deployed_at.astimezone(timezone.utc).isoformat(),
+                    record.appliance_certificate_id,
+                    record.renewal_info_id
+                )
+            )
+            self.connection.commit()
+
+        logger.debug(f"Inventory updated for {record.domain} ({record.instance}): serial {record.serial}, valid until {record.not_after}")
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+    @staticmethod
+    def row_to_record(row: tuple) -> InventoryRecord:
+        domain, instance, provider, serial, fingerprint, not_after, key_type, deployed_at, appliance_certificate_id, renewal_info_id = row
+
+        return InventoryRecord(
+            domain=domain,
+            instance=instance,
+            provider=provider,
+            serial=serial,
+            fingerprint=fingerprint,
+            not_after=datetime.fromisoformat(not_after),
+            key_type=key_type,
+            deployed_at=datetime.fromisoformat(deployed_at),
+            appliance_certificate_id=appliance_certificate_id,
+            renewal_info_id=renewal_info_id
+        )
+
+def open_certificate_inventory(state_directory: Path) -> CertificateInventory:
+    return CertificateInventory(state_directory / INVENTORY_FILE_NAME)
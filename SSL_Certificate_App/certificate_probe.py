@@ -0,0 +1,170 @@
+# Standard library imports
+import logging
+import logging.config
+import socket
+import ssl
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+# Third party imports
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+
+# Load logging configuration
+logging.config.fileConfig("logging.ini")
+logger = logging.getLogger("certificate_probe")
+
+# Constants
+DEFAULT_PROBE_TIMEOUT = 10
+DEFAULT_REACHABILITY_TIMEOUT = 5
+
+### Details of a certificate that are needed to decide if it has to be renewed ###
+
+@dataclass
+class CertificateDetails:
+    subject_names: List[str]
+    serial: str
+    fingerprint: str
+    not_after: datetime
+
+    def remaining_days(self, now: Optional[datetime] = None) -> float:
+        now = now or datetime.now(timezone.utc)
+        return (self.not_after - now).total_seconds() / 86400
+
+    def covers_domain(self, domain: str) -> bool:
+
+        # Exact match or a wildcard name that covers exactly one label in front of its base domain
+        domain = domain.lower().rstrip(".")
+        for name in self.subject_names:
+            name = name.lower().rstrip(".")
+            if name == domain:
+                return True
+            if name.startswith("*.") and domain.split(".", 1)[-1] == name[2:]:
+                return True
+        return False
+
+def parse_certificate(certificate_bytes: bytes) -> CertificateDetails:
+
+    # Accepts PEM (as written by certbot) and DER (as returned by a TLS handshake)
+    if certificate_bytes.lstrip().startswith(b"-----BEGIN"):
+        certificate = x509.load_pem_x509_certificate(certificate_bytes)
+    else:
+        certificate = x509.load_der_x509_certificate(certificate_bytes)
+
+    try:
+        subject_alternative_names = certificate.extensions.get_extension_for_class(x509.SubjectAlternativeName)
+        subject_names = subject_alternative_names.value.get_values_for_type(x509.DNSName)
+    except x509.ExtensionNotFound:
+        subject_names = [attribute.value for attribute in certificate.subject.get_attributes_for_oid(x509.NameOID.COMMON_NAME)]
+
+    return CertificateDetails(
+        subject_names=subject_names,
+        serial=format(certificate.serial_number, "x"),
+        fingerprint=certificate.fingerprint(hashes.SHA256()).hex(":"),
+        not_after=certificate.not_valid_after_utc
+    )
+
+### Pre-flight probe of the certificate an instance is currently serving ###
+
+def create_unverified_context() -> ssl.SSLContext:
+
+    # The certificate is only read, not trusted, so verification is disabled on purpose.
+    # This way expired or self-signed certificates can be inspected as well.
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+def probe_instance_certificate(domain: str, port: int, timeout: float = DEFAULT_PROBE_TIMEOUT, host: Optional[str] = None) -> CertificateDetails:
+
+    # Connects to "host" (the domain if not given) and asks for the certificate of the domain
+    host = host or domain
+    with socket.create_connection((host, port), timeout=timeout) as connection:
+        with create_unverified_context().wrap_socket(connection, server_hostname=domain) as tls_connection:
+            certificate_bytes = tls_connection.getpeercert(binary_form=True)
+
+    if not certificate_bytes:
+        raise ssl.SSLError(f"{host}:{port} didn't present a certificate")
+
+    certificate_details = parse_certificate(certificate_bytes)
+    logger.debug(f"Certificate served by {host}:{port}: fingerprint {certificate_details.fingerprint}, valid until {certificate_details.not_after}")
+
+    return certificate_details
+
+def probe_remaining_days(domain: str, port: int, host: Optional[str] = None) -> Optional[float]:
+
+    # Days the certificate served by the instance is still valid for its domain. None if it can't be probed or isn't
+    # issued for the domain, which always leads to a renewal: the probe is only allowed to save work and never to prevent it.
+    # "host" is the management address of the instance if it isn't reached through the domain.
+    try:
+        certificate_details = probe_instance_certificate(domain, port, host=host)
+
+    except (OSError, ValueError) as e:
+        logger.warning(f"Couldn't probe the certificate of {domain} on {host or domain}:{port}, renewing it anyway: {str(e)}")
+        return None
+
+    if not certificate_details.covers_domain(domain):
+        logger.info(f"Certificate served by {domain} is not issued for {domain} ({certificate_details.subject_names}), renewal is due")
+        return None
+
+    return certificate_details.remaining_days()
+
+def certificate_renewal_is_due(domain: str, remaining_days: Optional[float], threshold_days: float) -> bool:
+
+    # "remaining_days" as returned by probe_remaining_days
+    if remaining_days is None:
+        return True
+
+    if remaining_days > threshold_days:
+        logger.info(f"Certificate served by {domain} is still valid for {remaining_days:.0f} days (threshold {threshold_days} days), renewal is skipped")
+        return False
+
+    logger.info(f"Certificate served by {domain} is only valid for {remaining_days:.0f} more days, renewal is due")
+    return True
+
+### Reachability check of the management API of the instances ###
+
+def check_endpoint_reachable(domain: str, port: int, timeout: float, tls_handshake: bool) -> Optional[str]:
+
+    # Returns None if the port accepts a TCP connection (and completes a TLS handshake if asked to),
+    # otherwise the reason why it isn't reachable. Connect and handshake share the same timeout.
+    deadline = time.monotonic() + timeout
+    try:
+        with socket.create_connection((domain, port), timeout=timeout) as connection:
+            if tls_handshake:
+                connection.settimeout(max(deadline - time.monotonic(), 0.1))
+                with create_unverified_context().wrap_socket(connection, server_hostname=domain):
+                    pass
+
+    except OSError as e:
+        return str(e) or type(e).__name__
+
+    return None
+
+def check_endpoints_reachable(
+    endpoints: List[Tuple[str, int]],
+    timeout: float = DEFAULT_REACHABILITY_TIMEOUT,
+    tls_handshake: bool = True
+) -> Dict[Tuple[str, int], Optional[str]]:
+
+    # Checks all (domain, port) endpoints at the same time, so the whole inventory is done in about one timeout.
+    # Returns the reason per unreachable endpoint and None for the reachable ones.
+    # One thread per endpoint: the threads only wait for the network, with fewer of them the unreachable endpoints would
+    # take one timeout per round of workers.
+    endpoints = list(dict.fromkeys(endpoints))
+    if not endpoints:
+        return {}
+
+    with ThreadPoolExecutor(max_workers=len(endpoints), thread_name_prefix="reachability") as executor:
+        reachability = dict(zip(endpoints, executor.map(lambda endpoint: check_endpoint_reachable(*endpoint, timeout, tls_handshake), endpoints)))
+
+    for (domain, port), reason in reachability.items():
+        if reason is None:
+            logger.debug(f"{domain}:{port} is reachable")
+        else:
+            logger.warning(f"{domain}:{port} is not reachable: {reason}")
+
+    return reachability
@@ -0,0 +1,130 @@
+# Standard library imports
+import hashlib
+import json
+import logging
+import logging.config
+import os
+import threading
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional
+
+# Local imports
+from certbot_utils import CertificateArtifacts
+
+# Load logging configuration
+logging.config.fileConfig("logging.ini")
+logger = logging.getLogger("certificate_staging")
+
+# Constants
+STAGING_DIRECTORY_NAME = "staged_certificates"
+MANIFEST_FILE_NAME = "staged.json"
+ARTIFACT_FIELDS = ["cert_pem", "chain_pem", "fullchain_pem", "key_pem", "root_pem"]
+
+### One instance whose certificate was issued by a "stage" run and waits for a "deploy" run ###
+
+@dataclass
+class StagedInstance:
+    provider: str
+    instance: str
+    domain: str
+    key_type: str
+    certificate_file: str
+    not_after: str
+    staged_at: str
+
+    def remaining_days(self, now: Optional[datetime] = None) -> float:
+        now = now or datetime.now(timezone.utc)
+        return (datetime.fromisoformat(self.not_after) - now).total_seconds() / 86400
+
+### Certificates issued ahead of a maintenance window, kept in the state directory ###
+
+class CertificateStaging:
+
+    # A "stage" run stores certificate, chain and key of every instance it issued for, a "deploy" run only uploads them.
+    # The manifest maps "<provider>/<instance>" to its certificate file, which is named after domain, key type and the hash
+    # of the certificate: instances that got the same certificate share the file, restaging one instance never changes the
+    # certificate of another. The files hold private keys and are only readable by the owner. The credentials of the
+    # instances are not stored, the deploy run takes them from the configuration.
+    def __init__(self, staging_directory: Path):
+        self.staging_directory = staging_directory
+        self.staging_directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+        self.manifest_path = staging_directory / MANIFEST_FILE_NAME
+
+        # Several workers stage or deploy at the same time, the lock serializes the manifest updates
+        self.lock = threading.Lock()
+        self.manifest: Dict[str, Dict[str, str]] = {}
+        if self.manifest_path.exists():
+            self.manifest = json.loads(self.manifest_path.read_text())
+
+        logger.debug(f"Staging directory: {self.staging_directory} ({len(self.manifest)} staged instances)")
+
+    def stage(self, provider: str, instance: str, key_type: str, not_after: datetime, artifacts: CertificateArtifacts) -> None:
+        certificate_file = f"{artifacts.domain}_{key_type}_{hashlib.sha256(artifacts.cert_pem).hexdigest()[:16]}.json"
+
+        staged_instance = StagedInstance(
+            provider=provider,
+            instance=instance,
+            domain=artifacts.domain,
+            key_type=key_type,
+            certificate_file=certificate_file,
+            not_after=not_after.astimezone(timezone.utc).isoformat(),
+            staged_at=datetime.now(timezone.utc).isoformat()
+        )
+
+        # The file is written under the lock, so a concurrent remove() can't delete it before the manifest refers to it
+        with self.lock:
+            write_private_file(
+                self.staging_directory / certificate_file,
+                json.dumps({field: getattr(artifacts, field).decode() for field in ARTIFACT_FIELDS}).encode()
+            )
+            previous_entry = self.manifest.get(f"{provider}/{instance}")
+            self.manifest[f"{provider}/{instance}"] = asdict(staged_instance)
+            write_private_file(self.manifest_path, json.dumps(self.manifest, indent=2, sort_keys=True).encode())
+
+            # The certificate staged before for the instance is dropped unless another instance still uses it
+            if previous_entry:
+                self.remove_unused_file(previous_entry["certificate_file"])
+
+        logger.info(f"Certificate for {artifacts.domain} was staged for {provider} instance {instance}")
+
+    def get_staged_instance(self, provider: str, instance: str) -> Optional[StagedInstance]:
+        with self.lock:
+            staged_instance = self.manifest.get(f"{provider}/{instance}")
+
+        return StagedInstance(**staged_instance) if staged_instance else None
+
+    def get_staged_instances(self) -> List[StagedInstance]:
+        with self.lock:
+            return [StagedInstance(**staged_instance) for _, staged_instance in sorted(self.manifest.items())]
+
+    def load_artifacts(self, staged_instance: StagedInstance) -> CertificateArtifacts:
+        pem_blocks = json.loads((self.staging_directory / staged_instance.certificate_file).read_text())
+        return CertificateArtifacts(domain=staged_instance.domain, key_type=staged_instance.key_type, **{field: pem_blocks[field].encode() for field in ARTIFACT_FIELDS})
+
+    def remove(self, staged_instance: StagedInstance) -> None:
+
+        # Called after the certificate was deployed. The certificate file is deleted with the last instance that uses it.
+        with self.lock:
+            self.manifest.pop(f"{staged_instance.provider}/{staged_instance.instance}", None)
+            write_private_file(self.manifest_path, json.dumps(self.manifest, indent=2, sort_keys=True).encode())
+            self.remove_unused_file(staged_instance.certificate_file)
+
+    def remove_unused_file(self, certificate_file: str) -> None:
+
+        # Called with the lock held
+        if all(entry["certificate_file"] != certificate_file for entry in self.manifest.values()):
+            (self.staging_directory / certificate_file).unlink(missing_ok=True)
+
+def write_private_file(file_path: Path, content: bytes) -> None:
+
+    # Written to a temporary file that only the owner can read first, the file on disk is always complete
+    temporary_path = file_path.with_name(f"{file_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    file_descriptor = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(file_descriptor, "wb") as temporary_file:
+        temporary_file.write(content)
+    os.replace(temporary_path, file_path)
+
+def open_certificate_staging(state_directory: Path) -> CertificateStaging:
+    return CertificateStaging(state_directory / STAGING_DIRECTORY_NAME)
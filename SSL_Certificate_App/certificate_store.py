@@ -0,0 +1,247 @@
+# Standard library imports
+import argparse
+import hashlib
+import json
+import logging
+import logging.config
+import os
+import secrets
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+
+# Local imports
+import config_manager as config_manager
+from certificate_archive import CertificateArchive
+
+# Load logging configuration
+logging.config.fileConfig("logging.ini")
+logger = logging.getLogger("certificate_store")
+
+# Constants
+STORE_DIRECTORY_NAME = "certificate_store"
+MANIFEST_SUFFIX = ".json"
+PARTIAL_SUFFIX = ".partial"
+TEMPORARY_SUFFIX = ".tmp"
+
+# Blobs and temporary files younger than this are kept by the compaction, a run that is still writing
+# may not have its temporary file renamed or the blob in its manifest yet
+COMPACTION_GRACE_SECONDS = 3600
+
+### Content-addressed store of the certificates of all runs ###
+
+class CertificateStore:
+
+    # Every file is stored once as a blob named after its SHA-256 hash, e.g. the root chain that is the same for all domains.
+    # A run only writes a manifest that maps domain and file name to the hashes of its blobs. A zip of any run is exported on demand.
+    # Same interface as CertificateArchive (add_files and finalize), the manifest of the running run is kept as "<run>.json.partial"
+    # and rewritten after every append, so a crash keeps what was stored so far.
+    def __init__(self, store_directory: Path, run_id: Optional[str] = None):
+        self.blob_directory = store_directory / "blobs"
+        self.manifest_directory = store_directory / "manifests"
+        self.blob_directory.mkdir(parents=True, exist_ok=True)
+        self.manifest_directory.mkdir(parents=True, exist_ok=True)
+
+        # Sorts by start time like the archives, microseconds and a random suffix keep runs that start in the same second apart
+        self.run_id = run_id or f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{secrets.token_hex(2)}"
+        self.manifest_path = self.manifest_directory / f"{self.run_id}{MANIFEST_SUFFIX}"
+        self.partial_path = self.manifest_path.with_name(self.manifest_path.name + PARTIAL_SUFFIX)
+
+        # Several renewal workers can finish at the same time, the lock serializes the manifest updates
+        self.lock = threading.Lock()
+        self.manifest: Dict[str, Dict[str, str]] = {}
+        self.finalized = False
+
+    def blob_path(self, blob_hash: str) -> Path:
+        return self.blob_directory / blob_hash[:2] / blob_hash
+
+    def put_blob(self, content: bytes) -> str:
+
+        # Blobs never change once they are written, a blob that already exists is not written again. Its modification time
+        # is refreshed instead, so a concurrent compaction keeps it for the grace period until the manifest refers to it.
+        blob_hash = hashlib.sha256(content).hexdigest()
+        blob_path = self.blob_path(blob_hash)
+        try:
+            os.utime(blob_path)
+            return blob_hash
+        except FileNotFoundError:
+            pass
+
+        blob_path.parent.mkdir(exist_ok=True)
+        temporary_path = blob_path.with_name(f"{blob_hash}.{os.getpid()}.{threading.get_ident()}{TEMPORARY_SUFFIX}")
+        temporary_path.write_bytes(content)
+        temporary_path.chmod(0o600)
+        os.replace(temporary_path, blob_path)
+
+        return blob_hash
+
+    def add_files(self, domain: str, file_paths: List[str]) -> int:
+
+        # Returns the number of files whose hash was added to the manifest
+        stored_files = {
+            os.path.basename(file_path): self.put_blob(Path(file_path).read_bytes())
+            for file_path in file_paths
+            if os.path.exists(file_path)
+        }
+
+        with self.lock:
+            if self.finalized:
+                logger.warning(f"Manifest {self.manifest_path} is already finalized, files of {domain} are not added")
+                return 0
+
+            domain_manifest = self.manifest.setdefault(domain, {})
+            added_files = {file_name: blob_hash for file_name, blob_hash in stored_files.items() if domain_manifest.get(file_name) != blob_hash}
+            if not added_files:
+                return 0
+
+            domain_manifest.update(added_files)
+            write_manifest(self.partial_path, self.manifest)
+
+        logger.debug(f"Stored {len(added_files)} files of {domain} for run {self.run_id}")
+        return len(added_files)
+
+    def finalize(self) -> Optional[str]:
+
+        # Returns the path of the manifest, None if nothing was stored
+        with self.lock:
+            self.finalized = True
+            if not self.manifest:
+                return None
+
+            os.replace(self.partial_path, self.manifest_path)
+
+        file_count = sum(len(files) for files in self.manifest.values())
+        logger.info(f"Manifest of run {self.run_id} with {file_count} files of {len(self.manifest)} domains was written: {self.manifest_path}")
+        return str(self.manifest_path)
+
+    ### Runs, export, retention and compaction ###
+
+    def list_runs(self) -> List[str]:
+        return sorted(path.name[:-len(MANIFEST_SUFFIX)] for path in self.manifest_directory.glob(f"*{MANIFEST_SUFFIX}"))
+
+    def load_manifest(self, run_id: str) -> Dict[str, Dict[str, str]]:
+        manifest_path = self.manifest_directory / f"{run_id}{MANIFEST_SUFFIX}"
+        if not manifest_path.exists():
+            raise ValueError(f"No manifest for run {run_id} in {self.manifest_directory}")
+
+        return json.loads(manifest_path.read_text())
+
+    def export_run(self, run_id: str, output_directory: Path) -> str:
+
+        # Materialize the zip of a run with the same layout as the archive of a run ("<domain>_<key type>/<file>")
+        manifest = self.load_manifest(run_id)
+        archive = CertificateArchive(output_directory, archive_name=f"certificates_{run_id}.zip")
+
+        for domain, files in sorted(manifest.items()):
+            entries = {f"{domain}/{file_name}": str(self.blob_path(blob_hash)) for file_name, blob_hash in files.items()}
+            missing_blobs = [archive_name for archive_name, blob_path in entries.items() if not os.path.exists(blob_path)]
+            if missing_blobs:
+                raise ValueError(f"Blobs of run {run_id} are missing for {missing_blobs}")
+            archive.add_entries(domain, entries)
+
+        archive_path = archive.finalize()
+        logger.info(f"Run {run_id} was exported to {archive_path}")
+        return archive_path
+
+    def apply_retention(self, retention_runs: int) -> List[str]:
+
+        # Keep the manifests of the last "retention_runs" runs, 0 keeps all of them. Returns the removed runs.
+        runs = self.list_runs()
+        if retention_runs < 1 or len(runs) <= retention_runs:
+            return []
+
+        removed_runs = runs[:-retention_runs]
+        for run_id in removed_runs:
+            (self.manifest_directory / f"{run_id}{MANIFEST_SUFFIX}").unlink()
+
+        logger.info(f"Removed the manifests of {len(removed_runs)} runs older than the last {retention_runs}")
+        return removed_runs
+
+    def compact(self) -> int:
+
+        # Remove the blobs no manifest refers to any more, including the ones of runs that are still being written.
+        # Files written within the grace period are kept, so are the temporary files of a put_blob that is running.
+        # Temporary files left behind by a crashed run are removed once they are older. Returns the number of removed files.
+        referenced_blobs: Set[str] = set()
+        manifest_paths = [*self.manifest_directory.glob(f"*{MANIFEST_SUFFIX}"), *self.manifest_directory.glob(f"*{MANIFEST_SUFFIX}{PARTIAL_SUFFIX}")]
+        for manifest_path in manifest_paths:
+            for files in json.loads(manifest_path.read_text()).values():
+                referenced_blobs.update(files.values())
+
+        removed_blobs = 0
+        freed_bytes = 0
+        grace_start = time.time() - COMPACTION_GRACE_SECONDS
+        for blob_path in self.blob_directory.glob("*/*"):
+            if blob_path.name in referenced_blobs:
+                continue
+
+            # A concurrent put_blob can rename or remove the file in between
+            try:
+                blob_stat = blob_path.stat()
+                if blob_stat.st_mtime > grace_start:
+                    continue
+                blob_path.unlink()
+            except FileNotFoundError:
+                continue
+
+            freed_bytes += blob_stat.st_size
+            removed_blobs += 1
+
+        logger.info(f"Compaction removed {removed_blobs} blobs ({freed_bytes} bytes), {len(referenced_blobs)} blobs are in use")
+        return removed_blobs
+
+def write_manifest(manifest_path: Path, manifest: Dict[str, Dict[str, str]]) -> None:
+
+    # Written to a temporary file first, the manifest on disk is always complete
+    temporary_path = manifest_path.with_name(manifest_path.name + ".tmp")
+    temporary_path.write_text(json.dumps(manifest, indent=2, sort_keys=True))
+    os.replace(temporary_path, manifest_path)
+
+def recover_partial_manifests(store_directory: Path) -> List[str]:
+
+    # Manifests of a run that crashed hold every file stored before the crash, they are finalized under their own name
+    recovered_manifests = []
+    for partial_path in sorted((store_directory / "manifests").glob(f"*{MANIFEST_SUFFIX}{PARTIAL_SUFFIX}")):
+        manifest_path = partial_path.with_name(partial_path.name[:-len(PARTIAL_SUFFIX)])
+        os.replace(partial_path, manifest_path)
+        recovered_manifests.append(str(manifest_path))
+        logger.warning(f"Recovered manifest of a previous run that didn't finish: {manifest_path}")
+
+    return recovered_manifests
+
+def get_store_directory(output_directory: Path) -> Path:
+    return output_directory / STORE_DIRECTORY_NAME
+
+### Command line: list the runs, export a run as zip or apply retention and compaction ###
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Certificate store of Certicopter")
+    parser.add_argument("--output-dir", default=os.getenv("CERTIFICATE_OUTPUT_DIR", config_manager.DEFAULT_CERTIFICATE_FOLDER), help="Directory that holds the certificate store (default: CERTIFICATE_OUTPUT_DIR)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="List the runs in the store")
+    export_parser = subparsers.add_parser("export", help="Export the certificates of a run as zip")
+    export_parser.add_argument("run_id", help="Run to export, 'latest' for the last run")
+    compact_parser = subparsers.add_parser("compact", help="Apply the retention and remove unused blobs")
+    compact_parser.add_argument("--retention-runs", type=int, default=config_manager.DEFAULT_ARCHIVE_RETENTION_RUNS, help="Number of runs to keep, 0 keeps all")
+    arguments = parser.parse_args()
+
+    output_directory = Path(arguments.output_dir)
+    store = CertificateStore(get_store_directory(output_directory))
+
+    if arguments.command == "list":
+        for run_id in store.list_runs():
+            print(run_id)
+
+    elif arguments.command == "export":
+        runs = store.list_runs()
+        run_id = runs[-1] if arguments.run_id == "latest" and runs else arguments.run_id
+        print(store.export_run(run_id, output_directory))
+
+    elif arguments.command == "compact":
+        store.apply_retention(arguments.retention_runs)
+        store.compact()
+
+if __name__ == "__main__":
+    main()
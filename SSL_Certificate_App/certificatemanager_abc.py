@@ -2,11 +2,69 @@
 # Standard library imports
 from abc import ABC, abstractmethod
 
+# Local imports
+from certbot_utils import create_certificate_artifacts
+from http_session import IDEMPOTENT_METHODS, ProviderSession, create_provider_session
+
 # Creating the CertificateManager object for managing the renewal of the SSL certificate
 
 class CertificateManager(ABC):
     
     # Abstract base class that defines the structure for all providers.
+
+    # Port the management interface of the instance serves its certificate on. Used for the pre-flight checks.
+    management_port = 443
+
+    # Key type ("rsa" or "ecdsa") of the certificates the instance gets
+    key_type = "rsa"
+
+    # Appliance-side identifier (ID, UUID or name) of the certificate that was deployed by the previous run.
+    # Set by the orchestrator from the certificate inventory, executors use it to find the old certificate without listing all of them.
+    previous_certificate_id = None
+
+    # Appliance-side identifier of the certificate deployed by this run. Set by the executors, recorded in the certificate inventory.
+    deployed_certificate_id = None
+
+    # Certificate, key and bundles of this run (certbot_utils.CertificateArtifacts). Set by the executors, the certificate is recorded in the certificate inventory.
+    certificate_artifacts = None
+
+    # TLS verification of the instance API unless "tls_verify" is configured: False for the appliances that serve
+    # a self-signed certificate until their first renewal, True (or the path of a CA bundle) to verify it
+    tls_verify = False
+
+    # HTTP methods whose calls are retried on failures. Single calls can be marked with "idempotent=True" or "idempotent=False".
+    idempotent_methods = IDEMPOTENT_METHODS
+
+    # Hooks around every API call of the instance (http_session.CallHook). Set by the orchestrator, e.g. for the adaptive concurrency control.
+    call_hooks = ()
+
+    # End of the time budget of the instance (http_session.start_deadline). Set by the orchestrator when the deployment to the
+    # instance starts, issuance doesn't count. Without it the budget starts with the session.
+    deadline = None
+
+    # Keep-alive HTTP session of the instance, created on first use
+    http_session = None
+
+    @property
+    def session(self) -> ProviderSession:
+
+        # All API calls of an executor go through this session. It pools the connections to the instance and applies the
+        # configured timeouts, retries, circuit breaker, TLS verification and the time budget of the instance.
+        if self.http_session is None:
+            self.http_session = create_provider_session(idempotent_methods=self.idempotent_methods, call_hooks=self.call_hooks, deadline=self.deadline, provider_verify=self.tls_verify)
+        return self.http_session
+
+    @classmethod
+    def get_management_endpoint(cls, instance_config: dict) -> tuple:
+
+        # (host, port) of the management interface of an instance with the given configuration, used for the pre-flight
+        # checks before an executor exists. The domain of the certificate unless the provider is managed through another host.
+        return instance_config["domain"], cls.management_port
+
+    def close_session(self) -> None:
+        if self.http_session is not None:
+            self.http_session.close()
+            self.http_session = None
     
     @staticmethod
     @abstractmethod
@@ -16,6 +74,12 @@ class CertificateManager(ABC):
         
         pass
 
+    @staticmethod
+    def get_optional_parameters() -> list:
+
+        # Parameters the provider can use if they are configured for an instance (e.g. to enable an API), none by default.
+        return []
+
     @abstractmethod
     def __init__(self, domain, *args, **kwargs) -> None:
         self.domain = domain
@@ -24,11 +88,53 @@ class CertificateManager(ABC):
         
         pass
 
-    @abstractmethod
+    ### Phases of a renewal ###
+
+    # The renewal of an instance runs through the phases issue, build artifacts, upload, activate and clean up.
+    # issue_certificate and build_artifacts only need the ACME side, the others only the instance, so the orchestrator
+    # can prepare the certificate of one instance while it deploys to another one.
+
     def execute_certificate_renewal(self) -> None:
-        
-        # Execute certificate renewal for the instance of a provider through calling provider specific functions.
-        
+
+        # All phases one after the other, for running the renewal of a single instance
+        self.issue_certificate()
+        self.build_artifacts()
+        self.deploy_certificate()
+
+    def issue_certificate(self) -> None:
+
+        # Get the SSL certificate from Let's Encrypt (already issued if the DNS zone of the domain was issued in this run)
+        self.certificate_artifacts = create_certificate_artifacts(domain=self.domain, key_type=self.key_type)
+
+    @abstractmethod
+    def build_artifacts(self) -> None:
+
+        # Put the certificate, chain and key together in the form the instance needs
+        pass
+
+    def deploy_certificate(self) -> None:
+
+        # Everything that happens on the instance. Executors that need to wrap the phases (e.g. in a commit) override it.
+        self.upload_certificate()
+        self.activate_certificate()
+        self.cleanup_old_certificate()
+
+    @abstractmethod
+    def upload_certificate(self) -> None:
+
+        # Post the new certificate to the instance
+        pass
+
+    @abstractmethod
+    def activate_certificate(self) -> None:
+
+        # Make the instance serve the new certificate
+        pass
+
+    @abstractmethod
+    def cleanup_old_certificate(self) -> None:
+
+        # Remove the certificate that was replaced
         pass
 
     @abstractmethod
@@ -0,0 +1,105 @@
+# Standard library imports
+import logging
+import logging.config
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+
+# Load logging configuration
+logging.config.fileConfig("logging.ini")
+logger = logging.getLogger("commit_coordinator")
+
+### Outcome of a commit, shared by every renewal whose changes it contained ###
+
+@dataclass
+class CommitResult:
+    success: bool
+    job_id: Optional[str] = None
+    message: str = ""
+
+class CommitBatch:
+
+    # The renewals whose changes go into the same commit. The first renewal that joins the batch runs the commit.
+    # "scopes" collects what each renewal changed if the commit needs to know it (e.g. the templates to push).
+    def __init__(self):
+        self.size = 0
+        self.scopes: List[Any] = []
+        self.done = threading.Event()
+        self.result: Optional[CommitResult] = None
+
+### Group commit of the configuration changes of several renewals on the same device ###
+
+class CommitCoordinator:
+
+    # Renewals call begin_changes before they change the configuration of the device and then either commit or discard_changes.
+    # A commit waits until no other renewal on the device is still changing its configuration and no other commit is running,
+    # then one commit is made for all renewals that are waiting and its result is handed to each of them.
+    # Only renewals that are already running are waited for, so the worker limits can't make the renewals wait for each other forever.
+    def __init__(self, device: str):
+        self.device = device
+        self.condition = threading.Condition()
+        self.changing = 0
+        self.committing = False
+        self.batch: Optional[CommitBatch] = None
+
+    def begin_changes(self) -> None:
+        with self.condition:
+            self.changing += 1
+
+    def discard_changes(self) -> None:
+
+        # For renewals that failed before their commit, the others must not wait for them
+        with self.condition:
+            self.changing -= 1
+            self.condition.notify_all()
+
+    def commit(self, commit_function: Callable[[List[Any]], CommitResult], scope: Any = None) -> CommitResult:
+        with self.condition:
+            self.changing -= 1
+            if self.batch is None:
+                self.batch = CommitBatch()
+                leads_batch = True
+            else:
+                leads_batch = False
+            batch = self.batch
+            batch.size += 1
+            if scope is not None and scope not in batch.scopes:
+                batch.scopes.append(scope)
+            self.condition.notify_all()
+
+            if leads_batch:
+                self.condition.wait_for(lambda: self.changing == 0 and not self.committing)
+
+                # Renewals that are done with their changes from now on wait for the next commit
+                self.batch = None
+                self.committing = True
+
+        if not leads_batch:
+            batch.done.wait()
+            return batch.result
+
+        logger.info(f"Committing the changes of {batch.size} renewals on {self.device}")
+        try:
+            batch.result = commit_function(batch.scopes)
+        except Exception as e:
+            batch.result = CommitResult(success=False, message=str(e))
+        finally:
+            with self.condition:
+                self.committing = False
+                self.condition.notify_all()
+            batch.done.set()
+
+        logger.info(f"Commit on {self.device} for {batch.size} renewals finished: {'success' if batch.result.success else 'failed'} (job {batch.result.job_id}) {batch.result.message}")
+        return batch.result
+
+### One coordinator per device and run ###
+
+commit_coordinators: Dict[str, CommitCoordinator] = {}
+commit_coordinators_lock = threading.Lock()
+
+def get_commit_coordinator(device: str) -> CommitCoordinator:
+    with commit_coordinators_lock:
+        if device not in commit_coordinators:
+            commit_coordinators[device] = CommitCoordinator(device)
+
+        return commit_coordinators[device]
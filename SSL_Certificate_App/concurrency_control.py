@@ -0,0 +1,146 @@
+# Standard library imports
+import logging
+import logging.config
+import threading
+import time
+from typing import Dict, Optional
+
+# Load logging configuration
+logging.config.fileConfig("logging.ini")
+logger = logging.getLogger("concurrency_control")
+
+# Constants
+INITIAL_LIMIT = 2
+MINIMUM_LIMIT = 1
+DECREASE_FACTOR = 0.5
+LATENCY_TOLERANCE = 2.0
+LATENCY_SLACK = 0.1
+BASELINE_DRIFT = 0.01
+LATENCY_SMOOTHING = 0.1
+MINIMUM_DECREASE_INTERVAL = 1.0
+
+### Additive increase, multiplicative decrease of a concurrency limit ###
+
+class AIMDLimiter:
+
+    # The limit grows by one after "limit" fast successful calls and is halved when a call fails or is slow. A call is slow
+    # if it takes more than LATENCY_TOLERANCE times (plus LATENCY_SLACK) the latency the same kind of call has without load,
+    # which is the lowest latency seen for it, drifting up slowly so it follows an appliance that got slower for good.
+    # One burst of failures halves the limit only once, the next decrease waits at least one smoothed latency.
+    # The limit stays between MINIMUM_LIMIT and "max_limit".
+    def __init__(self, name: str, max_limit: int, initial_limit: int = INITIAL_LIMIT):
+        self.name = name
+        self.max_limit = max(MINIMUM_LIMIT, max_limit)
+        self.current_limit = float(min(max(MINIMUM_LIMIT, initial_limit), self.max_limit))
+
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.smoothed_latency: Optional[float] = None
+        self.baseline_latencies: Dict[str, float] = {}
+        self.observed_calls = 0
+        self.last_decrease = 0.0
+
+    @property
+    def limit(self) -> int:
+        return int(self.current_limit)
+
+    def acquire(self) -> None:
+
+        # Wait until the number of running calls is below the limit
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self) -> None:
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+    def record(self, call_type: str, latency_seconds: float, success: bool) -> None:
+        with self.condition:
+            self.observed_calls += 1
+            baseline_latency = self.baseline_latencies.get(call_type)
+            slow = (
+                success
+                and baseline_latency is not None
+                and latency_seconds > LATENCY_TOLERANCE * baseline_latency + LATENCY_SLACK
+            )
+
+            if success:
+                self.baseline_latencies[call_type] = latency_seconds if baseline_latency is None else min(
+                    latency_seconds, baseline_latency + BASELINE_DRIFT * (latency_seconds - baseline_latency)
+                )
+                self.smoothed_latency = latency_seconds if self.smoothed_latency is None else (
+                    (1 - LATENCY_SMOOTHING) * self.smoothed_latency + LATENCY_SMOOTHING * latency_seconds
+                )
+
+            previous_limit = self.limit
+            if success and not slow:
+                self.current_limit = min(self.max_limit, self.current_limit + 1 / self.current_limit)
+
+            elif time.monotonic() - self.last_decrease >= max(MINIMUM_DECREASE_INTERVAL, self.smoothed_latency or 0):
+                self.current_limit = max(MINIMUM_LIMIT, self.current_limit * DECREASE_FACTOR)
+                self.last_decrease = time.monotonic()
+
+            if self.limit != previous_limit:
+                reason = "fast successful calls" if self.limit > previous_limit else ("slow call" if slow else "failed call")
+                logger.debug(f"Concurrency of {self.name} changed from {previous_limit} to {self.limit} ({reason}, {latency_seconds:.2f}s)")
+                self.condition.notify_all()
+
+### Limits per provider (instances renewed at the same time) and per host (API calls at the same time) ###
+
+class ConcurrencyController:
+
+    # Fed by the HTTP sessions of the executors through their call hooks. The provider limit decides how many instances of a
+    # provider the renewal engine deploys at the same time, the host limit how many calls run against one appliance at the same time.
+    # The configured worker limits are the upper bounds.
+    def __init__(self, max_workers: int, provider_max_workers: Dict[str, int]):
+        self.max_workers = max_workers
+        self.provider_max_workers = provider_max_workers
+
+        self.lock = threading.Lock()
+        self.provider_limiters: Dict[str, AIMDLimiter] = {}
+        self.host_limiters: Dict[str, AIMDLimiter] = {}
+
+    def get_provider_limiter(self, provider: str) -> AIMDLimiter:
+        with self.lock:
+            if provider not in self.provider_limiters:
+                self.provider_limiters[provider] = AIMDLimiter(f"provider {provider}", self.provider_max_workers.get(provider, self.max_workers))
+            return self.provider_limiters[provider]
+
+    def get_host_limiter(self, host: str) -> AIMDLimiter:
+        with self.lock:
+            if host not in self.host_limiters:
+                self.host_limiters[host] = AIMDLimiter(f"host {host}", self.max_workers)
+            return self.host_limiters[host]
+
+    def provider_limit(self, provider: str) -> int:
+        return self.get_provider_limiter(provider).limit
+
+    def call_hook(self, provider: str) -> "ConcurrencyCallHook":
+        return ConcurrencyCallHook(self, provider)
+
+    def log_limits(self) -> None:
+        with self.lock:
+            limiters = [*self.provider_limiters.values(), *self.host_limiters.values()]
+
+        for limiter in limiters:
+            smoothed_latency = f"{limiter.smoothed_latency:.2f}s" if limiter.smoothed_latency is not None else "n/a"
+            logger.info(f"Concurrency of {limiter.name} ended at {limiter.limit} of {limiter.max_limit} after {limiter.observed_calls} calls (smoothed latency {smoothed_latency})")
+
+class ConcurrencyCallHook:
+
+    # Call hook of the HTTP session of one instance (see http_session.ProviderSession)
+    def __init__(self, controller: ConcurrencyController, provider: str):
+        self.controller = controller
+        self.provider = provider
+
+    def before_call(self, host: str) -> None:
+        self.controller.get_host_limiter(host).acquire()
+
+    def after_call(self, host: str, call_type: str, latency_seconds: float, success: bool) -> None:
+        host_limiter = self.controller.get_host_limiter(host)
+        host_limiter.release()
+        host_limiter.record(call_type, latency_seconds, success)
+        self.controller.get_provider_limiter(self.provider).record(call_type, latency_seconds, success)
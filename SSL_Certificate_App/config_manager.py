@@ -4,7 +4,7 @@ import logging
 import logging.config
 import os
 from pathlib import Path
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Union
 
 # Load logging configuration
 logging.config.fileConfig("logging.ini")
@@ -12,11 +12,68 @@ logger = logging.getLogger("config_manager")
 
 # Constants
 DEFAULT_CERTIFICATE_FOLDER = "/home/appuser/certicopter"
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_RENEWAL_THRESHOLD_DAYS = 30
+LETSENCRYPT_DIRECTORY_URL = "https://acme-v02.api.letsencrypt.org/directory"
+ISSUANCE_BACKENDS = ["native", "certbot"]
+DEFAULT_DNS_PROPAGATION_TIMEOUT = 600
+DEFAULT_REACHABILITY_TIMEOUT = 5
+DEFAULT_HTTP_CONNECT_TIMEOUT = 10
+DEFAULT_HTTP_READ_TIMEOUT = 120
+DEFAULT_HTTP_RETRIES = 3
+DEFAULT_INSTANCE_DEADLINE = 3600
+DEFAULT_CIRCUIT_BREAKER_THRESHOLD = 5
+DEFAULT_CIRCUIT_BREAKER_COOLDOWN = 300
+ARCHIVE_FORMATS = ["zip", "store"]
+DEFAULT_ARCHIVE_RETENTION_RUNS = 30
+DEFAULT_ROOT_CERTIFICATE_REFRESH_DAYS = 30
+RUN_MODES = ["full", "stage", "deploy"]
+DEFAULT_RUN_MODE = "full"
 
 # Global variables for certificate configuration
 notification_email: Optional[str] = None
 dns_plugin: Optional[str] = None
 save_certificates: Optional[bool] = None
+issuance_backend: str = "certbot"
+acme_directory_url: str = LETSENCRYPT_DIRECTORY_URL
+
+# Global variables for saving the certificates of a run
+archive_format: str = "zip"
+archive_retention_runs: int = DEFAULT_ARCHIVE_RETENTION_RUNS
+root_certificate_refresh_days: int = DEFAULT_ROOT_CERTIFICATE_REFRESH_DAYS
+
+# Global variables for the DNS propagation check of the dns-01 challenges
+dns_propagation_check: bool = True
+dns_propagation_timeout: int = DEFAULT_DNS_PROPAGATION_TIMEOUT
+dns_propagation_nameservers: List[str] = []
+
+# Global variables for the concurrent renewal engine
+max_workers: int = DEFAULT_MAX_WORKERS
+provider_max_workers: Dict[str, int] = {}
+adaptive_concurrency: bool = True
+
+# Global variables for the expiry-aware pre-flight stage
+renewal_threshold_days: int = DEFAULT_RENEWAL_THRESHOLD_DAYS
+force_renewal: bool = False
+
+# Global variable for keeping the orders within the rate limits of the CA
+rate_limit_scheduling: bool = True
+
+# Global variable for renewing inside the renewal window the CA suggests (ACME Renewal Information)
+acme_renewal_info: bool = True
+
+# Global variables for the reachability check of the instances
+reachability_timeout: float = DEFAULT_REACHABILITY_TIMEOUT
+reachability_tls_handshake: bool = True
+
+# Global variables for the HTTP sessions of the executors
+http_connect_timeout: float = DEFAULT_HTTP_CONNECT_TIMEOUT
+http_read_timeout: float = DEFAULT_HTTP_READ_TIMEOUT
+tls_verify: Union[bool, str, None] = None
+http_retries: int = DEFAULT_HTTP_RETRIES
+instance_deadline: float = DEFAULT_INSTANCE_DEADLINE
+circuit_breaker_threshold: int = DEFAULT_CIRCUIT_BREAKER_THRESHOLD
+circuit_breaker_cooldown: float = DEFAULT_CIRCUIT_BREAKER_COOLDOWN
 
 # Provider mappings
 CERTIFICATE_MANAGER_MAP = {
@@ -24,6 +81,7 @@ CERTIFICATE_MANAGER_MAP = {
     "rubrik": "RubrikCertificateManager",
     "hycu": "HYCUCertificateManager",
     "paloalto": "PaloAltoCertificateManager",
+    "panorama": "PanoramaCertificateManager",
     "vamax": "VAMaxCertificateManager",
     "vsphere": "VSphereCertificateManager"
 }
@@ -75,7 +133,13 @@ def load_configuration_file(config_file_path: str) -> Dict[str, Any]:
 def validate_and_set_global_config(config: Dict[str, Any]) -> None:
 
     # Validate and set global configuration variables.
-    global notification_email, dns_plugin, save_certificates
+    global notification_email, dns_plugin, save_certificates, max_workers, provider_max_workers, adaptive_concurrency
+    global renewal_threshold_days, force_renewal, rate_limit_scheduling, acme_renewal_info, issuance_backend, acme_directory_url
+    global dns_propagation_check, dns_propagation_timeout, dns_propagation_nameservers
+    global reachability_timeout, reachability_tls_handshake
+    global http_connect_timeout, http_read_timeout, tls_verify
+    global http_retries, instance_deadline, circuit_breaker_threshold, circuit_breaker_cooldown
+    global archive_format, archive_retention_runs, root_certificate_refresh_days
     
     # Validate required global settings
     required_settings = ['hosting_provider', 'notification_email', 'save_certificates']
@@ -97,6 +161,134 @@ def validate_and_set_global_config(config: Dict[str, Any]) -> None:
     dns_plugin = DNS_PLUGIN_MAP[hosting_provider]
     #os.system(f"pip install certbot-{dns_plugin}")
 
+    global_settings = config["certicopter_global_settings"]
+
+    # Optional settings for the issuance of the certificates
+    issuance_backend = global_settings.get("issuance_backend", "certbot")
+    if issuance_backend not in ISSUANCE_BACKENDS:
+        raise ValueError(f"Unsupported issuance backend: {issuance_backend}")
+    logger.debug(f"Issuance backend: {issuance_backend}")
+    acme_directory_url = global_settings.get("acme_directory_url", LETSENCRYPT_DIRECTORY_URL)
+    logger.debug(f"ACME directory url: {acme_directory_url}")
+
+    # Optional settings for saving the certificates ("zip" writes one archive per run, "store" keeps every file once in the certificate store)
+    archive_format = global_settings.get("archive_format", "zip")
+    if archive_format not in ARCHIVE_FORMATS:
+        raise ValueError(f"Unsupported archive format: {archive_format}")
+    logger.debug(f"Archive format: {archive_format}")
+    archive_retention_runs = int(global_settings.get("archive_retention_runs", DEFAULT_ARCHIVE_RETENTION_RUNS))
+    if archive_retention_runs < 0:
+        raise ValueError(f"archive_retention_runs must be at least 0, got {archive_retention_runs}")
+    logger.debug(f"Archive retention runs: {archive_retention_runs or 'all'}")
+
+    # Days between the checks for a new Let's Encrypt root certificate, 0 only uses the bundled copy (e.g. without internet access)
+    root_certificate_refresh_days = int(global_settings.get("root_certificate_refresh_days", DEFAULT_ROOT_CERTIFICATE_REFRESH_DAYS))
+    if root_certificate_refresh_days < 0:
+        raise ValueError(f"root_certificate_refresh_days must be at least 0, got {root_certificate_refresh_days}")
+    logger.debug(f"Root certificate refresh days: {root_certificate_refresh_days or 'never'}")
+
+    # Optional settings for the DNS propagation check (only used by the native issuance backend)
+    dns_propagation_check = global_settings.get("dns_propagation_check", "y") == "y"
+    logger.debug(f"DNS propagation check: {dns_propagation_check}")
+    dns_propagation_timeout = int(global_settings.get("dns_propagation_timeout", DEFAULT_DNS_PROPAGATION_TIMEOUT))
+    if dns_propagation_timeout < 1:
+        raise ValueError(f"dns_propagation_timeout must be at least 1, got {dns_propagation_timeout}")
+    logger.debug(f"DNS propagation timeout: {dns_propagation_timeout}")
+    dns_propagation_nameservers = global_settings.get("dns_propagation_nameservers", [])
+    logger.debug(f"DNS propagation nameservers: {dns_propagation_nameservers or 'authoritative nameservers of each zone'}")
+
+    # Optional settings for the concurrent renewal engine
+    max_workers = int(global_settings.get("max_workers", DEFAULT_MAX_WORKERS))
+    if max_workers < 1:
+        raise ValueError(f"max_workers must be at least 1, got {max_workers}")
+    logger.debug(f"Max workers: {max_workers}")
+
+    provider_max_workers = {
+        provider: int(limit)
+        for provider, limit in global_settings.get("provider_max_workers", {}).items()
+    }
+    for provider, limit in provider_max_workers.items():
+        if provider not in CERTIFICATE_MANAGER_MAP:
+            raise ValueError(f"Unsupported provider in provider_max_workers: {provider}")
+        if limit < 1:
+            raise ValueError(f"provider_max_workers for {provider} must be at least 1, got {limit}")
+    logger.debug(f"Provider max workers: {provider_max_workers}")
+
+    # "y" (default) adapts the concurrency per provider and per appliance to the latency and errors of the API calls,
+    # max_workers and provider_max_workers are the upper bounds. "n" always uses the configured worker limits.
+    adaptive_concurrency = global_settings.get("adaptive_concurrency", "y") == "y"
+    logger.debug(f"Adaptive concurrency: {adaptive_concurrency}")
+
+    # Optional settings for skipping instances whose certificate is still valid long enough
+    renewal_threshold_days = int(global_settings.get("renewal_threshold_days", DEFAULT_RENEWAL_THRESHOLD_DAYS))
+    logger.debug(f"Renewal threshold days: {renewal_threshold_days}")
+    force_renewal = global_settings.get("force_renewal", "n") == "y"
+    logger.debug(f"Force renewal: {force_renewal}")
+
+    # "y" (default) orders the due certificates most urgent first within the rate limits of the CA and defers the rest to a later run
+    rate_limit_scheduling = global_settings.get("rate_limit_scheduling", "y") == "y"
+    logger.debug(f"Rate limit scheduling: {rate_limit_scheduling}")
+
+    # "y" (default) renews the certificates in the live directory inside the renewal window the CA suggests for them,
+    # renewal_threshold_days decides for the certificates without a window
+    acme_renewal_info = global_settings.get("acme_renewal_info", "y") == "y"
+    logger.debug(f"ACME renewal information: {acme_renewal_info}")
+
+    # Optional settings for the reachability check of the instances
+    reachability_timeout = float(global_settings.get("reachability_timeout", DEFAULT_REACHABILITY_TIMEOUT))
+    if reachability_timeout <= 0:
+        raise ValueError(f"reachability_timeout must be greater than 0, got {reachability_timeout}")
+    logger.debug(f"Reachability timeout: {reachability_timeout}")
+    reachability_tls_handshake = global_settings.get("reachability_tls_handshake", "y") == "y"
+    logger.debug(f"Reachability TLS handshake: {reachability_tls_handshake}")
+
+    # Optional settings for the HTTP sessions the executors use to talk to the instances
+    http_connect_timeout = float(global_settings.get("http_connect_timeout", DEFAULT_HTTP_CONNECT_TIMEOUT))
+    http_read_timeout = float(global_settings.get("http_read_timeout", DEFAULT_HTTP_READ_TIMEOUT))
+    if http_connect_timeout <= 0 or http_read_timeout <= 0:
+        raise ValueError(f"http_connect_timeout and http_read_timeout must be greater than 0, got {http_connect_timeout} and {http_read_timeout}")
+    logger.debug(f"HTTP timeouts: connect {http_connect_timeout}, read {http_read_timeout}")
+
+    # Retries of idempotent calls, time budget of an instance (0 = none) and circuit breaker per appliance (threshold 0 = off)
+    http_retries = int(global_settings.get("http_retries", DEFAULT_HTTP_RETRIES))
+    instance_deadline = float(global_settings.get("instance_deadline", DEFAULT_INSTANCE_DEADLINE))
+    circuit_breaker_threshold = int(global_settings.get("circuit_breaker_threshold", DEFAULT_CIRCUIT_BREAKER_THRESHOLD))
+    circuit_breaker_cooldown = float(global_settings.get("circuit_breaker_cooldown", DEFAULT_CIRCUIT_BREAKER_COOLDOWN))
+    if http_retries < 0 or instance_deadline < 0 or circuit_breaker_threshold < 0 or circuit_breaker_cooldown < 0:
+        raise ValueError("http_retries, instance_deadline, circuit_breaker_threshold and circuit_breaker_cooldown must not be negative")
+    logger.debug(f"HTTP retries: {http_retries}, instance deadline: {instance_deadline}s, circuit breaker: {circuit_breaker_threshold} failures, {circuit_breaker_cooldown}s cooldown")
+
+    # Not set (default) keeps the TLS verification of each provider (CertificateManager.tls_verify), "n" accepts the
+    # self-signed certificates of all instances, "y" verifies against the system CAs and any other value is used as the path of a CA bundle
+    tls_verify_setting = global_settings.get("tls_verify")
+    tls_verify = {"y": True, "n": False}.get(tls_verify_setting, tls_verify_setting)
+    if tls_verify is False:
+        logger.warning("TLS certificates of the instances are not verified (tls_verify is 'n')")
+    logger.debug(f"TLS verify: {'provider default' if tls_verify is None else tls_verify}")
+
+def get_state_directory() -> Path:
+
+    # Get the directory for state that has to survive between runs (e.g. the certificate inventory).
+    # The CERTICOPTER_STATE_DIR environment variable should point to a mounted volume.
+    state_dir = os.getenv("CERTICOPTER_STATE_DIR")
+    if not state_dir:
+        logger.warning("CERTICOPTER_STATE_DIR not set, using default state directory")
+        state_dir = f"{DEFAULT_CERTIFICATE_FOLDER}/files/state"
+
+    path = Path(state_dir)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+def get_run_mode() -> str:
+
+    # Get what a run does from the CERTICOPTER_RUN_MODE environment variable: "full" (default) issues and deploys the certificates,
+    # "stage" only issues them and stores them in the state directory and "deploy" only deploys the stored certificates
+    run_mode = os.getenv("CERTICOPTER_RUN_MODE", DEFAULT_RUN_MODE)
+    if run_mode not in RUN_MODES:
+        raise ValueError(f"Unsupported run mode {run_mode}. Use one of {RUN_MODES}")
+
+    return run_mode
+
 def get_provider_instances(
     config: Dict[str, Any],
     included_providers: Optional[List[str]] = None,
@@ -132,20 +324,25 @@ def get_certificate_manager_class(provider: str) -> str:
     
     return CERTIFICATE_MANAGER_MAP[provider]
 
-def get_instance_config(instance: Dict[str, str], required_parameters: List[str]) -> Dict[str, str]:
+def get_instance_config(
+    instance: Dict[str, str],
+    required_parameters: List[str],
+    optional_parameters: Optional[List[str]] = None
+) -> Dict[str, str]:
 
     # Extract and resolve environment variables for an instance configuration.
+    # Optional parameters are only part of the result if their environment variable is configured and set.
     # Extract environment variable names from the instance config
     env_var_names = {
         key: instance.get(f"{key}_env_var")
-        for key in required_parameters
+        for key in required_parameters + (optional_parameters or [])
     }
     
     # Resolve environment variables to their actual values and strip quotes
     instance_config = {
         key: os.getenv(env_var_name)
         for key, env_var_name in env_var_names.items()
-        if env_var_name is not None
+        if env_var_name is not None and (key in required_parameters or os.getenv(env_var_name) is not None)
     }
     # To resolve a possible quote issue use this instead:
     # instance_config = {
@@ -0,0 +1,152 @@
+# Standard library imports
+import logging
+import logging.config
+import time
+from functools import lru_cache
+from typing import Dict, List, Optional, Set, Tuple
+
+# Third party imports
+import dns.exception
+import dns.flags
+import dns.message
+import dns.query
+import dns.rcode
+import dns.rdatatype
+import dns.resolver
+from publicsuffixlist import PublicSuffixList
+
+# Load logging configuration
+logging.config.fileConfig("logging.ini")
+logger = logging.getLogger("dns_utils")
+
+# Constants
+DNS_LOOKUP_TIMEOUT = 10
+DNS_PORT = 53
+PROPAGATION_QUERY_TIMEOUT = 5
+PROPAGATION_INITIAL_INTERVAL = 1.0
+PROPAGATION_MAX_INTERVAL = 15.0
+PROPAGATION_BACKOFF_FACTOR = 1.5
+
+# Returned by wait_for_txt_records instead of a latency if the zone has no nameservers to check (None means it timed out)
+PROPAGATION_NO_NAMESERVERS = -2.0
+
+@lru_cache(maxsize=None)
+def get_public_suffix_list() -> PublicSuffixList:
+
+    # The list ships with the package, it is parsed once per run
+    return PublicSuffixList()
+
+@lru_cache(maxsize=None)
+def get_registered_domain(domain: str) -> str:
+
+    # The registered domain (eTLD+1) from the public suffix list, e.g. example.co.uk for host.example.co.uk.
+    # The CA counts its certificates per registered domain, no matter how the DNS zones below it are delegated.
+    domain = domain.rstrip(".").lower()
+    return get_public_suffix_list().privatesuffix(domain) or domain
+
+@lru_cache(maxsize=None)
+def get_dns_zone(domain: str) -> str:
+
+    # The zone is the closest parent of the domain that has an SOA record. It decides which domains
+    # can share one DNS round during issuance. If it can't be looked up the registered domain
+    # from the public suffix list is used as a best guess.
+    try:
+        zone = dns.resolver.zone_for_name(domain, lifetime=DNS_LOOKUP_TIMEOUT).to_text(omit_final_dot=True)
+    except (dns.exception.DNSException, OSError) as e:
+        zone = get_registered_domain(domain)
+        logger.warning(f"Couldn't look up the DNS zone of {domain}, assuming {zone}: {str(e)}")
+
+    logger.debug(f"DNS zone of {domain} is {zone}")
+    return zone
+
+### Propagation check of the dns-01 TXT records on the authoritative nameservers ###
+
+def get_authoritative_nameservers(zone: str) -> List[Tuple[str, int]]:
+
+    # The addresses of all nameservers of the zone. The CA queries one of them, so a record
+    # only counts as propagated once every one of them answers with it.
+    nameservers = []
+    try:
+        for ns_record in dns.resolver.resolve(zone, "NS", lifetime=DNS_LOOKUP_TIMEOUT):
+            ns_name = ns_record.target.to_text()
+            for record_type in ("A", "AAAA"):
+                try:
+                    nameservers += [(address.to_text(), DNS_PORT) for address in dns.resolver.resolve(ns_name, record_type, lifetime=DNS_LOOKUP_TIMEOUT)]
+                except (dns.resolver.NoAnswer, dns.resolver.NXDOMAIN):
+                    continue
+    except (dns.exception.DNSException, OSError) as e:
+        logger.warning(f"Couldn't look up the nameservers of DNS zone {zone}: {str(e)}")
+
+    logger.debug(f"Authoritative nameservers of {zone}: {nameservers}")
+    return nameservers
+
+def parse_nameserver(nameserver: str) -> Tuple[str, int]:
+
+    # Nameservers from the configuration are given as "address" or "address:port"
+    # (IPv6 addresses have more than one colon and always use the default port)
+    if nameserver.count(":") == 1:
+        address, port = nameserver.split(":")
+        return address, int(port)
+
+    return nameserver, DNS_PORT
+
+def query_txt_values(name: str, address: str, port: int) -> Set[str]:
+
+    # Ask the nameserver directly (no recursion, no caches in between) for the TXT values of the name
+    query = dns.message.make_query(name, dns.rdatatype.TXT)
+    query.flags &= ~dns.flags.RD
+    response = dns.query.udp(query, address, timeout=PROPAGATION_QUERY_TIMEOUT, port=port)
+    if response.flags & dns.flags.TC:
+        response = dns.query.tcp(query, address, timeout=PROPAGATION_QUERY_TIMEOUT, port=port)
+
+    if response.rcode() != dns.rcode.NOERROR:
+        return set()
+
+    return {
+        b"".join(rdata.strings).decode()
+        for rrset in response.answer if rrset.rdtype == dns.rdatatype.TXT
+        for rdata in rrset
+    }
+
+def wait_for_txt_records(
+    zone: str,
+    expected_records: Dict[str, Set[str]],
+    timeout: float,
+    nameservers: Optional[List[Tuple[str, int]]] = None
+) -> Optional[float]:
+
+    # Poll the nameservers of the zone until each of them returns every expected TXT value (name -> values).
+    # Returns the measured propagation latency in seconds, None if the records weren't seen everywhere
+    # before the timeout or PROPAGATION_NO_NAMESERVERS if there was nothing to poll. The caller goes on with the validation in all cases.
+    nameservers = nameservers or get_authoritative_nameservers(zone)
+    if not nameservers:
+        logger.warning(f"No nameservers to check for DNS zone {zone}, continuing without propagation check")
+        return PROPAGATION_NO_NAMESERVERS
+
+    start_time = time.monotonic()
+    deadline = start_time + timeout
+    pending_checks = {(nameserver, name) for nameserver in nameservers for name in expected_records}
+    interval = PROPAGATION_INITIAL_INTERVAL
+
+    while True:
+        for nameserver, name in sorted(pending_checks):
+            try:
+                if expected_records[name] <= query_txt_values(name, *nameserver):
+                    pending_checks.discard((nameserver, name))
+            except (dns.exception.DNSException, OSError) as e:
+                logger.debug(f"TXT query for {name} at {nameserver[0]}:{nameserver[1]} failed: {str(e)}")
+
+        elapsed_time = time.monotonic() - start_time
+        if not pending_checks:
+            logger.info(f"TXT records of DNS zone {zone} propagated to {len(nameservers)} nameservers in {elapsed_time:.1f}s")
+            return elapsed_time
+
+        remaining_time = deadline - time.monotonic()
+        if remaining_time <= 0:
+            missing = ", ".join(f"{name}@{nameserver[0]}" for nameserver, name in sorted(pending_checks))
+            logger.warning(f"TXT records of DNS zone {zone} didn't propagate within {timeout}s, still missing: {missing}")
+            return None
+
+        logger.debug(f"{len(pending_checks)} TXT checks pending for DNS zone {zone}, next poll in {min(interval, remaining_time):.1f}s")
+        time.sleep(min(interval, remaining_time))
+        interval = min(interval * PROPAGATION_BACKOFF_FACTOR, PROPAGATION_MAX_INTERVAL)
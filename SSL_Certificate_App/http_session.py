@@ -0,0 +1,278 @@
+# Standard library imports
+import logging
+import logging.config
+import random
+import threading
+import time
+from typing import Dict, FrozenSet, Optional, Protocol, Sequence, Tuple, Union
+from urllib.parse import urlparse
+
+# Third party imports
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+# Local imports
+import config_manager as config_manager
+
+# Load logging configuration
+logging.config.fileConfig("logging.ini")
+logger = logging.getLogger("http_session")
+
+# Constants
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 120
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 4
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS"})
+RETRY_STATUS_CODES = frozenset({429, 502, 503, 504})
+RETRY_BACKOFF_BASE = 1.0
+RETRY_BACKOFF_MAX = 30.0
+
+class DeadlineExceeded(requests.Timeout):
+
+    # Raised instead of a call once the time budget of the instance is used up
+    pass
+
+class CircuitOpenError(requests.ConnectionError):
+
+    # Raised instead of a call while the circuit breaker of the host is open
+    pass
+
+class CallHook(Protocol):
+
+    # Called around every attempt of a call, e.g. by concurrency_control to limit and measure the calls to a host.
+    # "call_type" is method and path of the call (e.g. "GET /api/v1/certificate"), "success" is False for connection errors,
+    # timeouts, 429 and 5xx responses.
+    def before_call(self, host: str) -> None: ...
+
+    def after_call(self, host: str, call_type: str, latency_seconds: float, success: bool) -> None: ...
+
+### Circuit breaker per appliance ###
+
+class CircuitBreaker:
+
+    # Counts the consecutive failed calls (connection errors, timeouts and 5xx responses) to one host. After "failure_threshold"
+    # of them the breaker opens and every call to the host fails right away, so the renewals on a broken appliance stop instead of
+    # waiting for their timeouts. After "cooldown" seconds one trial call is let through, its result closes or reopens the breaker.
+    def __init__(self, host: str, failure_threshold: int, cooldown: float):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+
+        # Shared by the sessions of all instances on the host
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_running = False
+
+    def before_call(self) -> None:
+        with self.lock:
+            if self.opened_at is None:
+                return
+
+            if time.monotonic() - self.opened_at < self.cooldown or self.trial_running:
+                raise CircuitOpenError(f"Circuit breaker of {self.host} is open after {self.failures} failed calls")
+
+            # Half-open: this call decides if the breaker closes again
+            self.trial_running = True
+
+    def record_success(self) -> None:
+        with self.lock:
+            if self.opened_at is not None:
+                logger.info(f"Circuit breaker of {self.host} is closed again")
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def abort_trial(self) -> None:
+
+        # The call failed for a reason that says nothing about the host (e.g. an invalid URL), the next call is the trial
+        with self.lock:
+            self.trial_running = False
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.opened_at is None and self.failures >= self.failure_threshold:
+                logger.warning(f"Circuit breaker of {self.host} was opened after {self.failures} failed calls, calls are refused for {self.cooldown:.0f}s")
+                self.opened_at = time.monotonic()
+            elif self.opened_at is not None:
+                self.opened_at = time.monotonic()
+
+# One breaker per host for the whole run
+circuit_breakers: Dict[str, CircuitBreaker] = {}
+circuit_breakers_lock = threading.Lock()
+
+def get_circuit_breaker(host: str) -> Optional[CircuitBreaker]:
+
+    # A circuit_breaker_threshold of 0 turns the breakers off
+    if config_manager.circuit_breaker_threshold < 1:
+        return None
+
+    with circuit_breakers_lock:
+        if host not in circuit_breakers:
+            circuit_breakers[host] = CircuitBreaker(host, config_manager.circuit_breaker_threshold, config_manager.circuit_breaker_cooldown)
+        return circuit_breakers[host]
+
+### Keep-alive HTTP session shared by all API calls of one executor ###
+
+class ProviderSession(requests.Session):
+
+    # A requests session with its own connection pool per host, so the calls of an executor reuse
+    # the TCP connection and TLS session instead of doing a full handshake for every call.
+    # Timeout and TLS verification are applied to every request that doesn't set them explicitly.
+    # "deadline" is the end of the time budget of its instance (time.monotonic(), see start_deadline): no call starts
+    # after it and the timeouts of a call never reach beyond it. Idempotent calls are retried with jittered exponential backoff, calls can be marked
+    # with "idempotent=True" (e.g. listings sent as POST) or "idempotent=False" (e.g. APIs that change the configuration with GET).
+    def __init__(
+        self,
+        timeout: Tuple[float, float],
+        verify: Union[bool, str],
+        retries: int = 0,
+        deadline: Optional[float] = None,
+        idempotent_methods: FrozenSet[str] = IDEMPOTENT_METHODS,
+        call_hooks: Sequence[CallHook] = ()
+    ):
+        super().__init__()
+        self.timeout = timeout
+        self.verify = verify
+        self.retries = retries
+        self.idempotent_methods = idempotent_methods
+        self.call_hooks = list(call_hooks)
+        self.deadline = deadline
+
+        adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, method, url, *args, idempotent: Optional[bool] = None, **kwargs) -> requests.Response:
+
+        # verify is passed per request as well, otherwise a CA bundle from the environment (REQUESTS_CA_BUNDLE)
+        # would turn verification back on for a session that has it disabled
+        timeout = kwargs.pop("timeout", self.timeout)
+        kwargs.setdefault("verify", self.verify)
+
+        if idempotent is None:
+            idempotent = method.upper() in self.idempotent_methods
+        attempts = 1 + (self.retries if idempotent else 0)
+        host = urlparse(url).hostname or ""
+        circuit_breaker = get_circuit_breaker(host)
+
+        for attempt in range(1, attempts + 1):
+            call_timeout = self.limit_timeout(timeout, method, url)
+            if circuit_breaker is not None:
+                circuit_breaker.before_call()
+
+            try:
+                response = self.send_with_hooks(host, method, url, *args, timeout=call_timeout, **kwargs)
+
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if circuit_breaker is not None:
+                    circuit_breaker.record_failure()
+                if attempt == attempts:
+                    raise
+                logger.warning(f"{method} {url} failed (attempt {attempt} of {attempts}): {str(e)}")
+                retry_after = None
+
+            except Exception:
+                if circuit_breaker is not None:
+                    circuit_breaker.abort_trial()
+                raise
+
+            else:
+                if circuit_breaker is not None:
+                    if response.status_code >= 500:
+                        circuit_breaker.record_failure()
+                    else:
+                        circuit_breaker.record_success()
+
+                if response.status_code not in RETRY_STATUS_CODES or attempt == attempts:
+                    return response
+                logger.warning(f"{method} {url} returned {response.status_code} (attempt {attempt} of {attempts})")
+                retry_after = response.headers.get("Retry-After")
+                response.close()
+
+            self.wait_before_retry(attempt, retry_after)
+
+    def send_with_hooks(self, host, method, url, *args, **kwargs) -> requests.Response:
+        for call_hook in self.call_hooks:
+            call_hook.before_call(host)
+
+        start_time = time.monotonic()
+        success = False
+        try:
+            response = super().request(method, url, *args, **kwargs)
+            success = response.status_code < 500 and response.status_code != 429
+            return response
+
+        finally:
+            latency_seconds = time.monotonic() - start_time
+            call_type = f"{method.upper()} {urlparse(url).path}"
+            for call_hook in self.call_hooks:
+                call_hook.after_call(host, call_type, latency_seconds, success)
+
+    def remaining_time(self) -> Optional[float]:
+        return self.deadline - time.monotonic() if self.deadline is not None else None
+
+    def limit_timeout(self, timeout, method, url):
+
+        # Cap the timeouts of a call to what is left of the time budget of the instance
+        remaining_time = self.remaining_time()
+        if remaining_time is None or timeout is None:
+            return timeout
+        if remaining_time <= 0:
+            raise DeadlineExceeded(f"Time budget of the instance is used up, {method} {url} was not sent")
+        if isinstance(timeout, tuple):
+            return tuple(min(part, remaining_time) if part is not None else remaining_time for part in timeout)
+        return min(timeout, remaining_time)
+
+    def wait_before_retry(self, attempt: int, retry_after: Optional[str]) -> None:
+
+        # Full jitter: a random wait up to the exponential backoff, so retries of many instances don't hit an appliance together.
+        # A numeric Retry-After of the appliance is respected up to the maximum backoff.
+        delay = random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** (attempt - 1)))
+        if retry_after is not None and retry_after.isdigit():
+            delay = min(float(retry_after), RETRY_BACKOFF_MAX)
+
+        remaining_time = self.remaining_time()
+        if remaining_time is not None:
+            delay = max(0.0, min(delay, remaining_time))
+        time.sleep(delay)
+
+def start_deadline() -> Optional[float]:
+
+    # End of the time budget of an instance that starts now, None if instance_deadline is 0
+    return time.monotonic() + config_manager.instance_deadline if config_manager.instance_deadline else None
+
+def create_provider_session(
+    idempotent_methods: FrozenSet[str] = IDEMPOTENT_METHODS,
+    call_hooks: Sequence[CallHook] = (),
+    deadline: Optional[float] = None,
+    provider_verify: Union[bool, str] = False
+) -> ProviderSession:
+
+    # Build a session with the timeouts, retries and TLS verification policy of the configuration. The time budget
+    # is the one the orchestrator started for the instance, or starts with the session if there is none.
+    # The TLS verification of the provider is used unless "tls_verify" is configured.
+    if deadline is None:
+        deadline = start_deadline()
+    timeout = (config_manager.http_connect_timeout, config_manager.http_read_timeout)
+    verify = provider_verify if config_manager.tls_verify is None else config_manager.tls_verify
+
+    if verify is False:
+        # The appliances mostly serve self-signed certificates until their first renewal, the warning
+        # urllib3 would print for every call is replaced by the one from the configuration
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+    remaining_time = f"{deadline - time.monotonic():.0f}s" if deadline is not None else "none"
+    logger.debug(f"New HTTP session with timeout {timeout}, remaining time budget {remaining_time} and TLS verification {verify}")
+    return ProviderSession(
+        timeout=timeout,
+        verify=verify,
+        retries=config_manager.http_retries,
+        deadline=deadline,
+        idempotent_methods=idempotent_methods,
+        call_hooks=call_hooks
+    )
@@ -4,9 +4,6 @@ import logging
 import logging.config
 from operator import itemgetter
 
-# Third party imports
-import requests
-
 # Local imports
 from certbot_utils import *
 from certificatemanager_abc import CertificateManager
@@ -19,6 +16,9 @@ logger = logging.getLogger("hycu")
 
 class HYCUCertificateManager(CertificateManager):
 
+    management_port = 8443
+    key_type = "ecdsa"
+
      # Static method to return what the provider specific requirements are regarding needed parameters for the certificate renewal process
     @staticmethod
     def get_required_parameters():
@@ -45,46 +45,49 @@ class HYCUCertificateManager(CertificateManager):
     def execute_test(self):
         logger.info(f"HYCU instance parameters: Domain: {self.domain}, IPs: {self.dns_ip_addresses} and API_Token: {self.api_token} is provided.")
 
-    def execute_certificate_renewal(self):
+    def build_artifacts(self):
 
-        try:
+        # Concatenate the different certificates to match the requirements of HYCU
+        hycu_bundle = self.certificate_artifacts.hycu_bundle()
+        self.certificate_artifacts.save(hycu_path=hycu_bundle)
+        self.key_file = self.certificate_artifacts.key_pem.decode()
+        self.hycu_file = hycu_bundle.decode()
 
-            # Get the SSL certificate from Let's Encrypt with Certbot
-            create_instance_certificate(domain=self.domain, key_type="ecdsa")
+    def upload_certificate(self):
 
-            # Open necessary files
-            key_path, cert_path, caChain_path, hycu_path  = certificate_paths(domain=self.domain, requested_paths=["key_path", "cert_path", "caChain_path", "hycu_path"])
-            
-            # Concatenate the different certificates to match the requirements of HYCU
-            concat_certificates_hycu(cert_path=cert_path, caChain_path=caChain_path, hycu_path=hycu_path)
+        # Generate a certificate name
+        certificate_name = generate_certificate_name(domain=self.domain)
 
-            # Load all files to open their content
-            loaded_files = load_certificate_files(read_mode="text", key_path=key_path, hycu_path=hycu_path)
-            key_file = loaded_files.get("key_path")
-            hycu_file = loaded_files.get("hycu_path")
-            
-            # Generate a certificate name
-            certificate_name = generate_certificate_name(domain=self.domain)
-            
-            # Post the new certificate
-            self.post_new_certificate(certificate_name=certificate_name, key_file=key_file, hycu_file=hycu_file)
+        # Post the new certificate
+        self.post_new_certificate(certificate_name=certificate_name, key_file=self.key_file, hycu_file=self.hycu_file)
 
-            # Extract the UUID of the old certificate
-            extracted_uuid = self.extract_uuid()
+    def activate_certificate(self):
 
-            # Get old and new certificate informations
-            information_about_certificates = self.get_certificate_information()
-            old_certificate_id, new_certificate_id = self.get_old_and_new_certificate_id(information_about_certificates)
+        # Extract the UUID of the old certificate
+        extracted_uuid = self.extract_uuid()
 
-            # Exchange the old with the new SSL certificate and delete the old one after a successful exchange
-            self.exchange_new_with_old_certificate(new_certificate_id=new_certificate_id, extracted_uuid=extracted_uuid)
+        # Get old and new certificate informations
+        information_about_certificates = self.get_certificate_information()
+        old_certificate_id, new_certificate_id = self.get_old_and_new_certificate_id(information_about_certificates)
+        self.deployed_certificate_id = new_certificate_id
 
-            # Delete the old certificate
-            self.delete_old_certificate(old_certificate_id)
+        # The certificate deployed by the previous run is the one to replace, even if it isn't the earliest expiring one.
+        # Its UUID from the certificate inventory is only used if the appliance still lists the certificate.
+        certificate_uuids = {entity.get("uuid") for entity in information_about_certificates.get("entities", [])}
+        if self.previous_certificate_id in certificate_uuids and self.previous_certificate_id != new_certificate_id:
+            self.old_certificate_id = self.previous_certificate_id
+        else:
+            if self.previous_certificate_id:
+                logger.warning(f"Certificate {self.previous_certificate_id} from the certificate inventory isn't on {self.domain} any more, replacing the earliest expiring one")
+            self.old_certificate_id = old_certificate_id
 
-        except Exception as e:
-            logger.error(f"Unexpected error happened for {self.domain}. Error message: {e}")
-            raise
+        # Exchange the old with the new SSL certificate
+        self.exchange_new_with_old_certificate(new_certificate_id=new_certificate_id, extracted_uuid=extracted_uuid)
+
+    def cleanup_old_certificate(self):
+
+        # Delete the old certificate after a successful exchange
+        self.delete_old_certificate(self.old_certificate_id)
 
     ### Different tasks are handled by the below functions that are needed for the execute function ###
 
@@ -95,7 +98,7 @@ class HYCUCertificateManager(CertificateManager):
             "certificate": hycu_file
         }
 
-        post_certificate_response = requests.post(url=self.url_certificate, json=payload, headers=self.headers_api, verify=False)
+        post_certificate_response = self.session.post(url=self.url_certificate, json=payload, headers=self.headers_api)
 
         if post_certificate_response.status_code != 201:
             logger.error(f"Couldn't post the certificate to {self.domain}. API response:\n{post_certificate_response}")
@@ -104,7 +107,7 @@ class HYCUCertificateManager(CertificateManager):
         logger.debug(f"Posting certificate was successful")
 
     def extract_uuid(self):
-        network_overview_response = requests.get(url=self.url_network, headers=self.headers_api, verify=False)
+        network_overview_response = self.session.get(url=self.url_network, headers=self.headers_api)
 
         if network_overview_response.status_code != 200:
             logger.error(f"Couldn't get network overview:\n{network_overview_response}")
@@ -124,7 +127,7 @@ class HYCUCertificateManager(CertificateManager):
             raise
 
     def get_certificate_information(self):
-        information_about_certificates = requests.get(url=self.url_certificate, headers=self.headers_api, verify=False)
+        information_about_certificates = self.session.get(url=self.url_certificate, headers=self.headers_api)
 
         if information_about_certificates.status_code != 200:
             logger.error(f"Couldn't get network overview:\n{information_about_certificates}")
@@ -173,7 +176,7 @@ class HYCUCertificateManager(CertificateManager):
         exchange_url = f"{self.url_network}/{extracted_uuid}"
         logger.debug(f"Exchange url: {exchange_url}")
 
-        exchange_certificate_response = requests.patch(url=exchange_url, json=payload, headers=self.headers_api, verify=False)
+        exchange_certificate_response = self.session.patch(url=exchange_url, json=payload, headers=self.headers_api)
 
         if exchange_certificate_response.status_code != 202:
             logger.error(f"Couldn't get exchange certificate:\n{exchange_certificate_response}")
@@ -185,7 +188,7 @@ class HYCUCertificateManager(CertificateManager):
         deletion_url = f"{self.url_certificate}/{old_certificate_id}"
         logger.debug(f"Deletion url is: {deletion_url}")
 
-        delete_certificate_response = requests.delete(url=deletion_url, headers=self.headers_api, verify=False)
+        delete_certificate_response = self.session.delete(url=deletion_url, headers=self.headers_api)
 
         if delete_certificate_response.status_code != 200:
             logger.error(f"Couldn't delete the old certificate:\n{delete_certificate_response}")
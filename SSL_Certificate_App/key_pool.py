@@ -0,0 +1,119 @@
+# Standard library imports
+import logging
+import logging.config
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Deque, Dict, Optional
+
+# Third party imports
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+
+# Load logging configuration
+logging.config.fileConfig("logging.ini")
+logger = logging.getLogger("key_pool")
+
+# Constants
+RSA_KEY_SIZE = 2048
+KEY_TYPES = ["rsa", "ecdsa"]
+
+def generate_private_key(key_type: str) -> bytes:
+
+    # Same defaults as certbot: RSA 2048 or ECDSA on the P-256 curve
+    if key_type == "rsa":
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=RSA_KEY_SIZE)
+    elif key_type == "ecdsa":
+        private_key = ec.generate_private_key(ec.SECP256R1())
+    else:
+        raise ValueError(f"Unsupported key type {key_type}. Use 'rsa' or 'ecdsa'.")
+
+    return private_key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption()
+    )
+
+### Private keys generated in the background while the run waits for the network ###
+
+class KeyPool:
+
+    # The keys for the orders of a run are generated in worker processes as soon as the number of instances that may
+    # need a certificate is known, so the CPU time overlaps with the reachability and pre-flight checks instead of
+    # delaying every order. Each key is handed out exactly once and only lives in memory, keys that aren't needed
+    # are dropped when the pool is closed. The workers are started by a fork server: the run already has threads, and a
+    # process forked from it could inherit a lock one of them holds and deadlock.
+    def __init__(self, key_counts: Dict[str, int]):
+        self.lock = threading.Lock()
+        self.pending_keys: Dict[str, Deque[Future]] = {key_type: deque() for key_type in KEY_TYPES}
+
+        key_count = sum(key_counts.values())
+        self.executor = ProcessPoolExecutor(max_workers=max(1, min(key_count, os.cpu_count() or 1)), mp_context=multiprocessing.get_context("forkserver"))
+
+        for key_type, count in key_counts.items():
+            if key_type not in KEY_TYPES:
+                raise ValueError(f"Unsupported key type {key_type}. Use 'rsa' or 'ecdsa'.")
+            for _ in range(count):
+                self.pending_keys[key_type].append(self.executor.submit(generate_private_key, key_type))
+
+        logger.debug(f"Generating {key_count} keys in the background: {key_counts}")
+
+    def get_key(self, key_type: str) -> bytes:
+
+        # Take the next pre-generated key, wait for it if it isn't ready yet. A key is generated right away if the pool is used up.
+        with self.lock:
+            pending_keys = self.pending_keys.get(key_type)
+            future = pending_keys.popleft() if pending_keys else None
+
+        if future is None:
+            logger.debug(f"No pre-generated {key_type} key left, generating one")
+            return generate_private_key(key_type)
+
+        try:
+            return future.result()
+        except Exception as e:
+            logger.warning(f"Background generation of a {key_type} key failed, generating one: {str(e)}")
+            return generate_private_key(key_type)
+
+    def close(self) -> None:
+        with self.lock:
+            unused_keys = sum(len(pending_keys) for pending_keys in self.pending_keys.values())
+            for pending_keys in self.pending_keys.values():
+                pending_keys.clear()
+
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        logger.debug(f"Key pool was closed, {unused_keys} unused keys were dropped")
+
+### One pool per run ###
+
+key_pool: Optional[KeyPool] = None
+key_pool_lock = threading.Lock()
+
+def start_key_pool(key_counts: Dict[str, int]) -> None:
+    global key_pool
+
+    with key_pool_lock:
+        if key_pool is None and sum(key_counts.values()) > 0:
+            key_pool = KeyPool(key_counts)
+
+def get_private_key(key_type: str) -> bytes:
+
+    # Used for every order, falls back to generating the key right away if no pool is running
+    with key_pool_lock:
+        current_key_pool = key_pool
+
+    if current_key_pool is None:
+        return generate_private_key(key_type)
+
+    return current_key_pool.get_key(key_type)
+
+def stop_key_pool() -> None:
+    global key_pool
+
+    with key_pool_lock:
+        stopped_key_pool, key_pool = key_pool, None
+
+    if stopped_key_pool is not None:
+        stopped_key_pool.close()
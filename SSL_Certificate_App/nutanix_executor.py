@@ -5,9 +5,6 @@ import logging
 import logging.config
 from datetime import datetime
 
-# Third party imports
-import requests
-
 # Local imports
 from certificatemanager_abc import CertificateManager
 from certbot_utils import *
@@ -20,6 +17,9 @@ logger = logging.getLogger("nutanix")
 
 class NutanixCertificateManager(CertificateManager):
 
+    management_port = 9440
+    key_type = "rsa"
+
     # Static method to return what the provider specific requirements are regarding needed parameters for the certificate renewal process
     @staticmethod
     def get_required_parameters():
@@ -52,26 +52,27 @@ class NutanixCertificateManager(CertificateManager):
     def execute_test(self):
         logger.info(f"Nutanix instance parameters: Domain {self.domain}, Username {self.username} and password {self.password} is provided.")
 
-    def execute_certificate_renewal(self):
+    def build_artifacts(self):
 
-        try:
-            # Get the SSL certificate from Let's Encrypt with Certbot
-            create_instance_certificate(domain=self.domain, key_type="rsa")
+        # Nutanix takes key, certificate and chain as separate files
+        self.key_file = self.certificate_artifacts.key_pem
+        self.cert_file = self.certificate_artifacts.cert_pem
+        self.caChain_file = self.certificate_artifacts.chain_pem
 
-            # Open necessary files
-            key_path, cert_path, caChain_path  = certificate_paths(domain=self.domain, requested_paths=["key_path", "cert_path", "caChain_path"])
-            loaded_files = load_certificate_files(read_mode="binary", key_path=key_path, cert_path=cert_path, caChain_path=caChain_path)
-            
-            key_file = loaded_files.get("key_path")
-            cert_file = loaded_files.get("cert_path")
-            caChain_file = loaded_files.get("caChain_path")
+    def upload_certificate(self):
 
-            # Post the new certificate with the opened files
-            self.post_new_certificate(key_file=key_file, cert_file=cert_file, caChain_file=caChain_file)
+        # Post the new certificate with the opened files
+        self.post_new_certificate(key_file=self.key_file, cert_file=self.cert_file, caChain_file=self.caChain_file)
 
-        except Exception as e:
-            logger.error(f"Unexpected error happened for {self.domain}. Error message: {e}")
-            raise
+    def activate_certificate(self):
+
+        # The imported certificate replaces the current one right away
+        pass
+
+    def cleanup_old_certificate(self):
+
+        # The import replaces the old certificate, there is nothing left to delete
+        pass
     
     ### Different tasks are handled by the below functions that are needed for the execute function ###
 
@@ -83,7 +84,7 @@ class NutanixCertificateManager(CertificateManager):
             'caChain': caChain_file
         }
 
-        post_certificate_response = requests.post(url=self.url_post, files=files, headers=self.headers_post, verify=False)
+        post_certificate_response = self.session.post(url=self.url_post, files=files, headers=self.headers_post)
 
         if post_certificate_response.status_code != 200:
             logger.error(f"Couldn't post the certificate to {self.domain}. API response:\n{post_certificate_response}")
@@ -95,6 +96,6 @@ class NutanixCertificateManager(CertificateManager):
     ### Not used for renewal process but can be helpful for debugging ###
 
     def get_certificate_information(self):
-        certificate_information_response = requests.get(url=self.url_get, headers=self.headers_get, verify=False)
+        certificate_information_response = self.session.get(url=self.url_get, headers=self.headers_get)
     
         return json.loads(certificate_information_response.text)
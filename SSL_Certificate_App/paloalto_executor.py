@@ -1,38 +1,81 @@
 # Standard library imports
-import requests
 import logging
 import logging.config
+import time
 import xml.etree.ElementTree as ET
+from typing import List
 
 # Third party imports
-import requests
+from cryptography.hazmat.primitives import serialization
 
 # Local imports
 from certbot_utils import *
 from certificatemanager_abc import CertificateManager
+from commit_coordinator import CommitResult, get_commit_coordinator
 
 # Load logging configuration
 logging.config.fileConfig("logging.ini")
 logger = logging.getLogger("paloalto")
 
+# Constants
+SHARED_CONFIG_XPATH = "/config/shared"
+DEFAULT_SSL_TLS_PROFILES = "letsencrypt"
+JOB_TIMEOUT_SECONDS = 1800
+JOB_POLL_INITIAL_INTERVAL = 2.0
+JOB_POLL_MAX_INTERVAL = 30.0
+JOB_POLL_BACKOFF_FACTOR = 1.5
+
 ### Creating the PaloAltoCertificateManager object for managing the renewal of the SSL certificate ###
 
 class PaloAltoCertificateManager(CertificateManager):
+
+    key_type = "rsa"
+
+    # The API key and the private key of the certificate go over the XML API, the certificate of the firewall is verified
+    tls_verify = True
+
+    # The XML API changes the configuration and starts commits with GET requests as well, only the calls marked as idempotent are retried
+    idempotent_methods = frozenset()
+
     @staticmethod
     def get_required_parameters():
         return ["domain", "api_token", "passphrase"]
 
-    def __init__(self, domain, api_token, passphrase):
+    # "api_host" is the management address of the firewall if it differs from the domain of the certificate,
+    # "ssl_tls_profiles" a comma separated list of the SSL/TLS service profiles that get the new certificate
+    @staticmethod
+    def get_optional_parameters():
+        return ["api_host", "ssl_tls_profiles"]
+
+    # The firewall (or Panorama) is managed through "api_host" if it is configured
+    @classmethod
+    def get_management_endpoint(cls, instance_config):
+        return instance_config.get("api_host") or instance_config["domain"], cls.management_port
+
+    def __init__(self, domain, api_token, passphrase, api_host=None, ssl_tls_profiles=DEFAULT_SSL_TLS_PROFILES):
         self.domain = domain
         self.api_token = api_token
         self.passphrase = passphrase
+        self.api_host = api_host or domain
+        self.ssl_tls_profiles = [profile.strip() for profile in ssl_tls_profiles.split(",") if profile.strip()]
+        logger.debug(f"SSL/TLS service profiles: {self.ssl_tls_profiles}")
 
         #self.username = username
         #self.password = passowrd
 
-        self.url_api = f"https://{self.domain}/api"
+        self.url_api = f"https://{self.api_host}/api"
         logger.debug(f"API url: {self.url_api}")
 
+        # Location of the certificates and SSL/TLS service profiles in the configuration
+        self.config_xpath = SHARED_CONFIG_XPATH
+        self.certificate_xpath = f"{self.config_xpath}/certificate"
+
+        # Extra parameters of the certificate import, e.g. the target template on Panorama
+        self.import_target_parameters = {}
+
+        # What the commit has to cover besides the configuration of the device itself (used by Panorama)
+        self.commit_scope = None
+
     # Can be used if you need to generate a new API key. You have to do this step manually
     def generate_new_api_key(self):
         #response = requests.post(url=self.url_get, headers=self.headers_get, verify=False)
@@ -41,7 +84,7 @@ class PaloAltoCertificateManager(CertificateManager):
             "user": self.username,
             "password": self.password
         }
-        response_api_key = requests.get(url=self.url_api, params=params, verify=False)
+        response_api_key = self.session.get(url=self.url_api, params=params, idempotent=True)
         logger.debug(f"API key response status code: {response_api_key.status_code}")
         logger.debug(f"API key response text: {response_api_key.text}")
 
@@ -50,71 +93,96 @@ class PaloAltoCertificateManager(CertificateManager):
     def execute_test(self):
         logger.info(f"PaloAlto instance parameters: Domain: {self.domain} and API_Token: {self.api_token} is provided.")
 
-    def execute_certificate_renewal(self):
+    def build_artifacts(self):
+
+        # Encrypt the private key with the given passphrase, the firewall only imports encrypted keys
+        encrypted_key = self.encrypt_private_key(self.certificate_artifacts.key_pem)
+
+        # Concatenate key and full chain to match the requirements of PaloAlto
+        self.paloalto_file = self.certificate_artifacts.paloalto_bundle(key_pem=encrypted_key)
+        self.certificate_artifacts.save(paloalto_path=self.paloalto_file)
+
+    def deploy_certificate(self):
+
+        # Renewals on the same firewall share one commit, the coordinator has to know that this one is changing the configuration
+        commit_coordinator = get_commit_coordinator(self.url_api)
+        commit_coordinator.begin_changes()
 
         try:
-            # Get the SSL certificate from Let's Encrypt with Certbot
-            create_instance_certificate(domain=self.domain, key_type="rsa")
-
-            try:
-                # The following two commands encrypt the private key with AES256 and set a password for it with the given passphrase
-                os.system(f"openssl rsa -aes256 -in /etc/letsencrypt/live/{self.domain}/privkey.pem -out /etc/letsencrypt/live/{self.domain}/privkeynew.pem -passout pass:{self.passphrase}")
-                os.system(f"mv /etc/letsencrypt/live/{self.domain}/privkeynew.pem /etc/letsencrypt/live/{self.domain}/privkey.pem")
-            
-            except ValueError:
-                logger.error(f"Couldnt encrypt the private key.")
-                raise
-    
-            # Get the required paths
-            key_path, fullChain_path, paloalto_path = certificate_paths(domain=self.domain, requested_paths=["key_path", "fullChain_path", "paloalto_path"])
-    
-            concat_certificates_paloalto(key_path=key_path, fullChain_path=fullChain_path, paloalto_path=paloalto_path)
-    
-            # Load all files to open their content
-            loaded_files = load_certificate_files("binary", paloalto_path=paloalto_path)
-            paloalto_file = loaded_files.get("paloalto_path")
-    
-            new_certificate_name = generate_certificate_name(domain=self.domain)
-    
-            # Post the newly generated certificate
-            self.post_new_certificate(paloalto_file=paloalto_file, new_certificate_name=new_certificate_name)
+            super().deploy_certificate()
 
-            # Replace the old with the new certificate
-            self.exchange_new_certificate(new_certificate_name)
+        except Exception:
+            commit_coordinator.discard_changes()
+            raise
 
-            # Get the name of the old certificate to later be able to delete it
-            old_certificate_name = self.get_old_certificate_name(new_certificate_name)
-    
-            # Delete the old certificate
-            self.delete_certificate(old_certificate_name)
+        # Commit all the changes, together with the changes of the other renewals on this firewall
+        commit_result = commit_coordinator.commit(self.commit_certificate, self.commit_scope)
+        if not commit_result.success:
+            raise RuntimeError(f"Commit job {commit_result.job_id} failed: {commit_result.message}")
+
+    def upload_certificate(self):
+
+        # Post the newly generated certificate
+        new_certificate_name = generate_certificate_name(domain=self.domain)
+        self.post_new_certificate(paloalto_file=self.paloalto_file, new_certificate_name=new_certificate_name)
+        self.deployed_certificate_id = new_certificate_name
 
-            # Commit all the changes
-            self.commit_certificate()
+    def activate_certificate(self):
 
-        except Exception as e:
-            logger.error(f"Unexpected error happened for {self.domain}. Error message: {e}")
-            raise        
+        # Replace the old with the new certificate in the SSL/TLS service profiles
+        self.exchange_new_certificate(self.deployed_certificate_id)
+
+    def cleanup_old_certificate(self):
+
+        # Get the name of the old certificate to be able to delete it (known from the certificate inventory if a previous run deployed it)
+        if self.previous_certificate_is_present():
+            old_certificate_name = self.previous_certificate_id
+        else:
+            old_certificate_name = self.get_old_certificate_name(self.deployed_certificate_id)
+
+        # Delete the old certificate
+        self.delete_certificate(old_certificate_name)
 
     ### Different tasks are handled by the below functions that are needed for the execute function ###
 
-    def get_certificate_information(self):
+    def get_certificate_information(self, xpath=None):
         params = {
             "key": self.api_token,
             "type": "config",
             "action": "get",
-            "xpath": "/config/shared/certificate"
+            "xpath": xpath or self.certificate_xpath
         }
 
-        get_certificate_information_response = requests.get(url=self.url_api, params=params)
+        # The response is streamed, a certificate store with many entries is never loaded into memory as a whole
+        get_certificate_information_response = self.session.get(url=self.url_api, params=params, stream=True, idempotent=True)
 
         if get_certificate_information_response.status_code != 200:
             logger.error(f"Couldn't not retrieve certificate information. API response:\n{get_certificate_information_response.text}")
-            raise
+            raise ValueError(f"Certificate information request failed with status code {get_certificate_information_response.status_code}")
         
         logger.debug(f"Get certificate information was successful")
 
         return get_certificate_information_response
         
+    def encrypt_private_key(self, key_pem: bytes) -> bytes:
+
+        # Same PEM as "openssl rsa -aes256" (AES-256-CBC, traditional format), built in memory from the loaded key.
+        # Works for RSA and ECDSA keys, the key on disk and the passphrase never leave the process.
+        try:
+            private_key = serialization.load_pem_private_key(key_pem, password=None)
+            encrypted_key = private_key.private_bytes(
+                encoding=serialization.Encoding.PEM,
+                format=serialization.PrivateFormat.TraditionalOpenSSL,
+                encryption_algorithm=serialization.BestAvailableEncryption(self.passphrase.encode())
+            )
+
+        except ValueError:
+            logger.error(f"Couldnt encrypt the private key.")
+            raise
+
+        logger.debug(f"Private key for {self.domain} was encrypted")
+        return encrypted_key
+
     def post_new_certificate(self, paloalto_file, new_certificate_name):
         files = {
             "file": paloalto_file
@@ -126,10 +194,11 @@ class PaloAltoCertificateManager(CertificateManager):
             "category": "keypair",
             "certificate-name": new_certificate_name,
             "format": "pem",
-            "passphrase": self.passphrase
+            "passphrase": self.passphrase,
+            **self.import_target_parameters
         }
 
-        post_certificate_response = requests.post(url=self.url_api, params=params, files=files)
+        post_certificate_response = self.session.post(url=self.url_api, params=params, files=files)
 
         if ET.fromstring(post_certificate_response.text).attrib.get("status") != "success":
             logger.error(f"Couldn't post the new certificate. API response:\n {post_certificate_response.text}")
@@ -138,67 +207,105 @@ class PaloAltoCertificateManager(CertificateManager):
         logger.debug("Successfully posted the new certificate")
     
     def exchange_new_certificate(self, new_certificate_name):
-        # The value of the @name= needs to fit to the profile you have on your Paloalto firewall
-        params = {
-            "key": self.api_token,
-            "type": "config",
-            "action": "set",
-            "xpath": f"/config/shared/ssl-tls-service-profile/entry[@name='letsencrypt']",
-            "element": f"<certificate>{new_certificate_name}</certificate>"
-        }
+        # The profile names need to fit to the profiles you have on your Paloalto firewall (ssl_tls_profiles, "letsencrypt" by default)
+        for ssl_tls_profile in self.ssl_tls_profiles:
+            params = {
+                "key": self.api_token,
+                "type": "config",
+                "action": "set",
+                "xpath": f"{self.config_xpath}/ssl-tls-service-profile/entry[@name='{ssl_tls_profile}']",
+                "element": f"<certificate>{new_certificate_name}</certificate>"
+            }
 
-        exchange_certificate_response = requests.post(url=self.url_api, params=params, verify=False)
+            exchange_certificate_response = self.session.post(url=self.url_api, params=params)
 
-        if ET.fromstring(exchange_certificate_response.text).attrib.get("status") != "success":
-            logger.error(f"Couldn't exchange the new with the old certificate. API response:\n {exchange_certificate_response.text}")
-            raise
+            if ET.fromstring(exchange_certificate_response.text).attrib.get("status") != "success":
+                logger.error(f"Couldn't exchange the new with the old certificate in profile {ssl_tls_profile}. API response:\n {exchange_certificate_response.text}")
+                raise ValueError(f"Couldn't set the new certificate in SSL/TLS service profile {ssl_tls_profile}")
 
-        logger.debug("Successfully exchanged the new with the old certificate")
+            logger.debug(f"Successfully exchanged the new with the old certificate in profile {ssl_tls_profile}")
 
-    def get_old_certificate_name(self, new_certificate_name):
-        # Get a certificate overview via API
-        get_certificate_information_response = self.get_certificate_information()
+    def previous_certificate_is_present(self) -> bool:
 
-        # Convert it with the ET library to XML code to later filter for the tags
-        root = ET.fromstring(get_certificate_information_response.text)
+        # The name from the certificate inventory is only used if the firewall still has the certificate,
+        # it can be gone after a manual change. Only that entry is requested.
+        if not self.previous_certificate_id or self.previous_certificate_id == self.deployed_certificate_id:
+            return False
 
         try:
-            # Create a list
-            certificate_names = []
-
-            # Extract the names from the 'name' attributes of the <entry> tags
-            for entry in root.findall(".//entry"):
-                name = entry.get("name")
-                if name:
-                    certificate_names.append(name)
-        
-        except:
-            logger.error(f"Wasn't able to extract names from the API response:\n{root}")
-            raise
-    
+            certificate_names = self.get_certificate_names(f"{self.certificate_xpath}/entry[@name='{self.previous_certificate_id}']")
+
+        except ValueError as e:
+            logger.warning(f"Certificate {self.previous_certificate_id} from the certificate inventory couldn't be looked up: {e}")
+            return False
+
+        if self.previous_certificate_id not in certificate_names:
+            logger.warning(f"Certificate {self.previous_certificate_id} from the certificate inventory isn't on the firewall any more, looking up the old certificate")
+            return False
+
+        return True
+
+    def get_old_certificate_name(self, new_certificate_name):
+
+        # Only ask for the entries whose name starts with the domain, the firewall filters them instead of returning
+        # every certificate with its PEM body. Firewalls that don't accept the predicate return the whole list.
         try:
-            # Loop through certificate names list and filter out the one which is not the newly created but has the same domain as a name
-            old_certificate_name = next ((name for name in certificate_names if name.startswith(self.domain) and name != new_certificate_name), None)
+            certificate_names = self.get_certificate_names(f"{self.certificate_xpath}/entry[starts-with(@name,'{self.domain}')]")
 
-            if old_certificate_name is None:
-                logger.error(f"Old certificate name can't be 'None'. Certificate names: {certificate_names}")
-                raise
+        except ValueError as e:
+            logger.warning(f"Filtered certificate lookup failed, getting all certificates instead: {e}")
+            certificate_names = self.get_certificate_names(self.certificate_xpath)
 
-            return old_certificate_name
+        # Filter out the one which is not the newly created but has the same domain as a name
+        old_certificate_name = next((name for name in certificate_names if name.startswith(self.domain) and name != new_certificate_name), None)
 
-        except:
-            logger.error(f"Couldn't filter the name out of the certificate names list:\n{certificate_names}")
-            raise
+        if old_certificate_name is None:
+            logger.error(f"Old certificate name can't be 'None'. Certificate names: {certificate_names}")
+            raise ValueError(f"No old certificate found for {self.domain}")
+
+        return old_certificate_name
+
+    def get_certificate_names(self, xpath) -> List[str]:
+        get_certificate_information_response = self.get_certificate_information(xpath)
+        get_certificate_information_response.raw.decode_content = True
+
+        # Parse the response while it is received and free every certificate entry as soon as its name is read
+        certificate_names = []
+        response_status = None
+
+        try:
+            for event, element in ET.iterparse(get_certificate_information_response.raw, events=("start", "end")):
+                if event == "start" and element.tag == "response":
+                    response_status = element.get("status")
+
+                elif event == "end" and element.tag == "entry":
+                    name = element.get("name")
+                    if name:
+                        certificate_names.append(name)
+                    element.clear()
+
+        except ET.ParseError as e:
+            raise ValueError(f"Couldn't parse the API response: {e}")
+
+        finally:
+            get_certificate_information_response.close()
+
+        if response_status != "success":
+            raise ValueError(f"API returned status '{response_status}' for xpath {xpath}")
+
+        logger.debug(f"Certificate names found for {xpath}: {certificate_names}")
+
+        return certificate_names
     
     def delete_certificate(self, old_certificate_name):
         params = {
             "key": self.api_token,
             "type": "config",
             "action": "delete",
-            "xpath": f"/config/shared/certificate/entry[@name='{old_certificate_name}']"
+            "xpath": f"{self.certificate_xpath}/entry[@name='{old_certificate_name}']"
         }
 
-        delete_certificate_response = requests.post(url=self.url_api, params=params, verify=False)
+        delete_certificate_response = self.session.post(url=self.url_api, params=params)
 
         if ET.fromstring(delete_certificate_response.text).attrib.get("status") != "success":
             logger.error(f"Couldn't delete the old certificate. API response:\n{delete_certificate_response.text}")
@@ -206,17 +313,62 @@ class PaloAltoCertificateManager(CertificateManager):
         
         logger.debug("Successfully deleted the old certificate")
 
-    def commit_certificate(self):
+    def commit_certificate(self, commit_scopes=None) -> CommitResult:
         params = {
             "key": self.api_token,
             "type": "commit",
             "cmd": "<commit></commit>"
         }
 
-        commit_response = requests.get(url=self.url_api, params=params, verify=False)
+        commit_response = self.session.get(url=self.url_api, params=params)
+        commit_root = ET.fromstring(commit_response.text)
 
-        if ET.fromstring(commit_response.text).attrib.get("status") != "success":
-            logger.error(f"Couldn't delete the old certificate. API response:\n {commit_response.text}")
-            raise
+        if commit_root.attrib.get("status") != "success":
+            logger.error(f"Couldn't commit the changes. API response:\n {commit_response.text}")
+            return CommitResult(success=False, message=commit_response.text)
+
+        # The commit runs as a job on the firewall. Without a job ID there was nothing to commit.
+        job_id = commit_root.findtext(".//job")
+        if job_id is None:
+            message = " ".join(text.strip() for text in commit_root.itertext() if text.strip())
+            logger.debug(f"No commit job was started: {message}")
+            return CommitResult(success=True, message=message)
+
+        logger.debug(f"Commit job {job_id} was started")
+        return self.wait_for_commit_job(job_id)
+
+    def wait_for_commit_job(self, job_id) -> CommitResult:
+
+        # Poll the commit job with a growing interval until the firewall reports it as finished
+        deadline = time.monotonic() + JOB_TIMEOUT_SECONDS
+        interval = JOB_POLL_INITIAL_INTERVAL
+
+        while True:
+            job = self.get_job(job_id)
+
+            if job.findtext("status") == "FIN":
+                details = " ".join(line.text.strip() for line in job.iter("line") if line.text and line.text.strip())
+                return CommitResult(success=job.findtext("result") == "OK", job_id=job_id, message=details)
+
+            remaining_time = deadline - time.monotonic()
+            if remaining_time <= 0:
+                return CommitResult(success=False, job_id=job_id, message=f"Job didn't finish within {JOB_TIMEOUT_SECONDS}s")
+
+            logger.debug(f"Commit job {job_id} is {job.findtext('status')} ({job.findtext('progress')}%), next check in {min(interval, remaining_time):.0f}s")
+            time.sleep(min(interval, remaining_time))
+            interval = min(interval * JOB_POLL_BACKOFF_FACTOR, JOB_POLL_MAX_INTERVAL)
+
+    def get_job(self, job_id) -> ET.Element:
+        params = {
+            "key": self.api_token,
+            "type": "op",
+            "cmd": f"<show><jobs><id>{job_id}</id></jobs></show>"
+        }
+
+        job_response = self.session.get(url=self.url_api, params=params, idempotent=True)
+        job = ET.fromstring(job_response.text).find(".//job")
+
+        if job is None:
+            raise ValueError(f"Couldn't get the status of job {job_id}. API response:\n {job_response.text}")
 
-        logger.debug("All changes were successfully commited")
+        return job
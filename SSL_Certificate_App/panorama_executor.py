@@ -0,0 +1,145 @@
+# Standard library imports
+import logging
+import logging.config
+import time
+import xml.etree.ElementTree as ET
+from typing import Dict
+
+# Local imports
+from commit_coordinator import CommitResult
+from paloalto_executor import (
+    DEFAULT_SSL_TLS_PROFILES,
+    JOB_POLL_BACKOFF_FACTOR,
+    JOB_POLL_INITIAL_INTERVAL,
+    JOB_POLL_MAX_INTERVAL,
+    JOB_TIMEOUT_SECONDS,
+    PaloAltoCertificateManager
+)
+
+# Load logging configuration
+logging.config.fileConfig("logging.ini")
+logger = logging.getLogger("panorama")
+
+# Constants
+PANORAMA_DEVICE_XPATH = "/config/devices/entry[@name='localhost.localdomain']"
+TEMPLATE_TYPES = ["template", "template-stack"]
+
+### Creating the PanoramaCertificateManager object for pushing one certificate to all firewalls of a template ###
+
+class PanoramaCertificateManager(PaloAltoCertificateManager):
+
+    # The certificate is imported once into a template or template stack on Panorama. A commit on Panorama
+    # and one commit-all push then distribute it to all firewalls that use the template.
+    @staticmethod
+    def get_required_parameters():
+        return ["domain", "api_host", "api_token", "passphrase", "template"]
+
+    # "template_type" is "template" (default) or "template-stack"
+    @staticmethod
+    def get_optional_parameters():
+        return ["template_type", "ssl_tls_profiles"]
+
+    def __init__(self, domain, api_host, api_token, passphrase, template, template_type="template", ssl_tls_profiles=DEFAULT_SSL_TLS_PROFILES):
+        super().__init__(domain=domain, api_token=api_token, passphrase=passphrase, api_host=api_host, ssl_tls_profiles=ssl_tls_profiles)
+
+        if template_type not in TEMPLATE_TYPES:
+            raise ValueError(f"Unsupported template type {template_type}. Use one of {TEMPLATE_TYPES}")
+
+        self.template = template
+        self.template_type = template_type
+
+        # Certificates and profiles live in the shared configuration of the template
+        self.config_xpath = f"{PANORAMA_DEVICE_XPATH}/{self.template_type}/entry[@name='{self.template}']/config/shared"
+        self.certificate_xpath = f"{self.config_xpath}/certificate"
+        self.import_target_parameters = {"target-tpl": self.template}
+        self.commit_scope = (self.template_type, self.template)
+        logger.debug(f"Panorama {self.api_host}, {self.template_type} {self.template}")
+
+    def execute_test(self):
+        logger.info(f"Panorama instance parameters: Domain: {self.domain}, Panorama: {self.api_host} and {self.template_type}: {self.template} is provided.")
+
+    ### Commit on Panorama and push to the firewalls ###
+
+    def commit_certificate(self, commit_scopes=None) -> CommitResult:
+
+        # The commit covers the changes of all renewals on this Panorama, each of their templates is pushed
+        templates = commit_scopes or [self.commit_scope]
+
+        panorama_commit_result = super().commit_certificate()
+        if not panorama_commit_result.success:
+            return panorama_commit_result
+
+        # One push per template, all push jobs are tracked together
+        push_jobs = {}
+        for template_type, template in sorted(templates):
+            push_jobs[f"{template_type} {template}"] = self.push_template(template_type, template)
+
+        return self.wait_for_push_jobs(push_jobs)
+
+    def push_template(self, template_type, template) -> str:
+        params = {
+            "key": self.api_token,
+            "type": "commit",
+            "action": "all",
+            "cmd": f"<commit-all><{template_type}><name>{template}</name></{template_type}></commit-all>"
+        }
+
+        push_response = self.session.get(url=self.url_api, params=params)
+        push_root = ET.fromstring(push_response.text)
+        job_id = push_root.findtext(".//job")
+
+        if push_root.attrib.get("status") != "success" or job_id is None:
+            logger.error(f"Couldn't push {template_type} {template} to the firewalls. API response:\n {push_response.text}")
+            raise ValueError(f"Push of {template_type} {template} failed")
+
+        logger.debug(f"Push job {job_id} was started for {template_type} {template}")
+        return job_id
+
+    def wait_for_push_jobs(self, push_jobs: Dict[str, str]) -> CommitResult:
+
+        # Poll all push jobs in one loop with a growing interval. A push job reports the result of every firewall,
+        # the push only counts as successful if every firewall accepted it.
+        deadline = time.monotonic() + JOB_TIMEOUT_SECONDS
+        interval = JOB_POLL_INITIAL_INTERVAL
+        running_jobs = dict(push_jobs)
+        failed_devices = []
+        device_count = 0
+
+        while running_jobs:
+            for target, job_id in list(running_jobs.items()):
+                job = self.get_job(job_id)
+                if job.findtext("status") != "FIN":
+                    logger.debug(f"Push job {job_id} ({target}) is {job.findtext('status')} ({job.findtext('progress')}%)")
+                    continue
+
+                del running_jobs[target]
+                for device in job.iter("entry"):
+                    if device.find("serial-no") is None:
+                        continue
+                    device_count += 1
+                    device_name = device.findtext("devicename") or device.findtext("serial-no")
+                    if device.findtext("result") != "OK":
+                        details = " ".join(line.text.strip() for line in device.iter("line") if line.text and line.text.strip())
+                        failed_devices.append(f"{device_name}: {details}")
+                        logger.error(f"Push job {job_id} ({target}) failed on {device_name}: {details}")
+                    else:
+                        logger.debug(f"Push job {job_id} ({target}) succeeded on {device_name}")
+
+                if job.findtext("result") != "OK" and not failed_devices:
+                    failed_devices.append(f"{target}: job {job_id} finished with result {job.findtext('result')}")
+
+            if not running_jobs:
+                break
+
+            remaining_time = deadline - time.monotonic()
+            if remaining_time <= 0:
+                return CommitResult(success=False, job_id=",".join(push_jobs.values()), message=f"Push jobs {list(running_jobs.values())} didn't finish within {JOB_TIMEOUT_SECONDS}s")
+
+            time.sleep(min(interval, remaining_time))
+            interval = min(interval * JOB_POLL_BACKOFF_FACTOR, JOB_POLL_MAX_INTERVAL)
+
+        job_ids = ",".join(push_jobs.values())
+        if failed_devices:
+            return CommitResult(success=False, job_id=job_ids, message="; ".join(failed_devices))
+
+        return CommitResult(success=True, job_id=job_ids, message=f"Pushed to {device_count} firewalls")
@@ -0,0 +1,211 @@
+# Standard library imports
+import json
+import logging
+import logging.config
+import os
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+# Load logging configuration
+logging.config.fileConfig("logging.ini")
+logger = logging.getLogger("rate_limit_scheduler")
+
+# Constants
+RATE_LIMITS_FILE_NAME = "rate_limits.json"
+
+# Let's Encrypt limits as (capacity, seconds to refill completely), see https://letsencrypt.org/docs/rate-limits/
+CERTIFICATES_PER_REGISTERED_DOMAIN = (50, 7 * 86400)
+DUPLICATE_CERTIFICATES_PER_NAME_SET = (5, 7 * 86400)
+NEW_ORDERS_PER_ACCOUNT = (300, 3 * 3600)
+FAILED_VALIDATIONS_PER_HOSTNAME = (5, 3600)
+
+BUCKET_LIMITS = {
+    "registered_domain": CERTIFICATES_PER_REGISTERED_DOMAIN,
+    "duplicate_certificate": DUPLICATE_CERTIFICATES_PER_NAME_SET,
+    "account": NEW_ORDERS_PER_ACCOUNT,
+    "failed_validation": FAILED_VALIDATIONS_PER_HOSTNAME
+}
+
+### Token bucket of one limit ###
+
+@dataclass
+class TokenBucket:
+
+    # Starts full and refills continuously, "capacity" tokens in "refill_seconds". One token is one certificate, order or failed validation.
+    capacity: float
+    refill_seconds: float
+    tokens: float
+    updated_at: float
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.capacity / self.refill_seconds)
+        self.updated_at = now
+
+    def seconds_until_available(self, now: float, reserved: int = 0) -> float:
+
+        # "reserved" tokens are already promised to other requests of the run
+        self.refill(now)
+        return max(0.0, (1 + reserved - self.tokens) * self.refill_seconds / self.capacity)
+
+    def take(self, now: float) -> None:
+        self.refill(now)
+        self.tokens -= 1
+
+    def drain(self, now: float) -> None:
+        self.refill(now)
+        self.tokens = min(self.tokens, 0.0)
+
+### One certificate the run wants to issue ###
+
+@dataclass
+class IssuanceRequest:
+    domain: str
+    key_type: str
+
+    # Registered domain (eTLD+1 from the public suffix list) the CA counts the certificate for
+    registered_domain: str
+
+    # Days the current certificate is still valid, None if unknown. Lower is more urgent.
+    remaining_days: Optional[float] = None
+
+    # True if a certificate for the same name set was issued before. The CA doesn't count renewals against the registered domain.
+    renewal: bool = False
+
+### Scheduler that keeps the issuance of a run within the limits of the CA ###
+
+class RateLimitScheduler:
+
+    # Models the limits of the CA with token buckets per registered domain, per name set (duplicate certificates), per account
+    # and per hostname for failed validations. The buckets survive between runs in the state directory, so a run knows what the previous runs used up.
+    # Requests are admitted in order of urgency (the certificates that expire first go first), the requests no bucket has
+    # a token for any more are deferred to a later run instead of placing orders that are bound to fail.
+    # Admission only reserves the tokens for the run, they are taken when the order is created (record_order).
+    def __init__(self, state_file: Path, account: str):
+        self.state_file = state_file
+        self.account = account
+
+        # The issuance workers report their results at the same time
+        self.lock = threading.Lock()
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.admitted_requests: Dict[Tuple[str, str], IssuanceRequest] = {}
+        if self.state_file.exists():
+            try:
+                for bucket_key, bucket_state in json.loads(self.state_file.read_text()).items():
+                    self.buckets[bucket_key] = TokenBucket(*BUCKET_LIMITS[bucket_key.split("|", 1)[0]], **bucket_state)
+            except (ValueError, KeyError, TypeError) as e:
+                logger.warning(f"Rate limit state {self.state_file} couldn't be loaded, starting with full buckets: {str(e)}")
+                self.buckets = {}
+
+    def get_bucket(self, kind: str, name: str, now: float) -> TokenBucket:
+
+        # Keyed by kind, account (the ACME directory, so staging and production don't share their buckets) and name
+        bucket_key = f"{kind}|{self.account}|{name}"
+        if bucket_key not in self.buckets:
+            capacity, refill_seconds = BUCKET_LIMITS[kind]
+            self.buckets[bucket_key] = TokenBucket(capacity=capacity, refill_seconds=refill_seconds, tokens=capacity, updated_at=now)
+        return self.buckets[bucket_key]
+
+    def schedule(self, issuance_requests: List[IssuanceRequest]) -> Tuple[List[IssuanceRequest], Dict[Tuple[str, str], str]]:
+
+        # Returns the admitted requests, most urgent first, and the reason for every deferred (domain, key type)
+        admitted_requests: List[IssuanceRequest] = []
+        deferred_requests: Dict[Tuple[str, str], str] = {}
+        urgency_order = sorted(issuance_requests, key=lambda request: float("-inf") if request.remaining_days is None else request.remaining_days)
+
+        with self.lock:
+            now = time.time()
+
+            # Tokens promised to the requests admitted so far, by limit. The names of the limits are unique per bucket.
+            reserved_tokens: Dict[str, int] = {}
+            for request in urgency_order:
+                buckets = {
+                    f"duplicate certificates for {request.domain}": self.get_bucket("duplicate_certificate", request.domain, now),
+                    "new orders of the account": self.get_bucket("account", "", now),
+                    f"failed validations of {request.domain}": self.get_bucket("failed_validation", request.domain, now)
+                }
+                if not request.renewal:
+                    buckets[f"certificates for {request.registered_domain}"] = self.get_bucket("registered_domain", request.registered_domain, now)
+
+                wait_seconds = {limit: bucket.seconds_until_available(now, reserved_tokens.get(limit, 0)) for limit, bucket in buckets.items()}
+                exhausted = {limit: seconds for limit, seconds in wait_seconds.items() if seconds > 0}
+
+                if exhausted:
+                    deferred_requests[(request.domain, request.key_type)] = "rate limit of " + ", ".join(
+                        f"{limit} reached (next in {seconds / 3600:.1f}h)" for limit, seconds in exhausted.items()
+                    )
+                    continue
+
+                # A failed validation is only counted when it happens, the other limits are reserved for the order
+                for limit in buckets:
+                    if not limit.startswith("failed validations"):
+                        reserved_tokens[limit] = reserved_tokens.get(limit, 0) + 1
+                admitted_requests.append(request)
+                self.admitted_requests[(request.domain, request.key_type)] = request
+
+        for (domain, key_type), reason in deferred_requests.items():
+            logger.warning(f"Issuance of the {key_type} certificate for {domain} is deferred to a later run: {reason}")
+        logger.info(f"{len(admitted_requests)} of {len(issuance_requests)} certificates are issued in this run, {len(deferred_requests)} are deferred")
+
+        return admitted_requests, deferred_requests
+
+    def record_order(self, domain: str, key_type: str, issued: bool) -> None:
+
+        # An order was created for an admitted request. It counts against the new orders of the account, the issued
+        # certificate against its name set and, unless it is a renewal, against its registered domain.
+        request = self.admitted_requests.get((domain, key_type))
+        if request is None:
+            logger.warning(f"Order for the {key_type} certificate for {domain} wasn't admitted by the rate limit scheduler")
+            return
+
+        with self.lock:
+            now = time.time()
+            self.get_bucket("account", "", now).take(now)
+            if issued:
+                self.get_bucket("duplicate_certificate", request.domain, now).take(now)
+                if not request.renewal:
+                    self.get_bucket("registered_domain", request.registered_domain, now).take(now)
+
+            self.save()
+
+    def record_failure(self, domain: str, registered_domain: str, stage: str, detail: str) -> None:
+
+        # A failed authorization counts against the failed validations of the hostname. If the CA itself reports
+        # a rate limit the matching bucket is emptied, the local model was too optimistic.
+        with self.lock:
+            now = time.time()
+            if stage == "authorization":
+                self.get_bucket("failed_validation", domain, now).take(now)
+
+            if "rateLimited" in detail:
+                if "new orders" in detail:
+                    self.get_bucket("account", "", now).drain(now)
+                elif "exact set" in detail:
+                    self.get_bucket("duplicate_certificate", domain, now).drain(now)
+                else:
+                    self.get_bucket("registered_domain", registered_domain, now).drain(now)
+                logger.warning(f"CA reported a rate limit for {domain}, the limits are updated: {detail}")
+
+            self.save()
+
+    def save(self) -> None:
+
+        # Full buckets are dropped, they are the same as new ones. Written to a temporary file first, the state on disk is always complete.
+        now = time.time()
+        for bucket_key, bucket in list(self.buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del self.buckets[bucket_key]
+
+        temporary_path = self.state_file.with_name(self.state_file.name + ".tmp")
+        temporary_path.write_text(json.dumps(
+            {bucket_key: {"tokens": bucket.tokens, "updated_at": bucket.updated_at} for bucket_key, bucket in self.buckets.items()},
+            indent=2,
+            sort_keys=True
+        ))
+        os.replace(temporary_path, self.state_file)
+
+def open_rate_limit_scheduler(state_directory: Path, account: str) -> RateLimitScheduler:
+    return RateLimitScheduler(state_directory / RATE_LIMITS_FILE_NAME, account)
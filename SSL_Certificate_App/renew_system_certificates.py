@@ -1,27 +1,53 @@
 # Standard library imports
 import logging
 import logging.config
-import os
+import threading
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from functools import partial
 from pathlib import Path
-from typing import Optional, Dict, Any, List, Type
-
-# Third-party imports
-from ping3 import ping
+from typing import Optional, Dict, Any, List, Tuple, Type
 
 # Local imports
-from certbot_utils import create_final_certificate_zip
+import config_manager as config_manager
+from certbot_utils import CertificateArtifacts, ZoneIssuance, certificate_paths, get_domain_zones, create_final_certificate_zip, load_root_certificate
+from certificate_inventory import CertificateInventory, InventoryRecord, open_certificate_inventory
+from certificate_probe import certificate_renewal_is_due, check_endpoints_reachable, parse_certificate, probe_remaining_days
+from certificate_staging import CertificateStaging, StagedInstance, open_certificate_staging
 from certificatemanager_abc import CertificateManager
+from concurrency_control import ConcurrencyController
+from dns_utils import get_registered_domain
+from http_session import start_deadline
+from key_pool import start_key_pool, stop_key_pool
+from rate_limit_scheduler import IssuanceRequest, RateLimitScheduler, open_rate_limit_scheduler
+from renewal_info import RenewalWindow, certificate_identifier, open_renewal_info_cache
 from nutanix_executor import NutanixCertificateManager
 from rubrik_executor import RubrikCertificateManager
 from hycu_executor import HYCUCertificateManager
 from paloalto_executor import PaloAltoCertificateManager
+from panorama_executor import PanoramaCertificateManager
 from vamax_executor import VAMaxCertificateManager
 from vsphere_executor import VSphereCertificateManager
 from config_manager import (
     load_configuration_file,
     get_provider_instances,
     get_certificate_manager_class,
-    get_instance_config
+    get_instance_config,
+    get_state_directory
+)
+from renewal_engine import (
+    PipelineJob,
+    RenewalJob,
+    InstanceResult,
+    STATUS_DEFERRED,
+    STATUS_DUE,
+    STATUS_FAILED,
+    STATUS_RENEWED,
+    STATUS_SKIPPED,
+    STATUS_STAGED,
+    run_renewal_jobs,
+    run_renewal_pipeline
 )
 
 # Load logging configuration
@@ -32,26 +58,25 @@ logger = logging.getLogger("renew_system_certificates")
 def renew_provider_certificates(
     included_providers: Optional[List[str]], 
     excluded_providers: Optional[List[str]], 
-    config_file_path: str
+    config_file_path: str,
+    run_mode: str = "full"
 ) -> None:
 
     logger.info("Configuration file is getting loaded")
     config = load_configuration_file(config_file_path=config_file_path)
     logger.debug("Configuration file was loaded successfully")
 
-    # Download root certificate
-    try:
-        os.system("wget https://letsencrypt.org/certs/isrgrootx1.pem")
-        logger.debug("Root certificate was downloaded successfully")
-        logger.debug(f"Root certificate: {Path('isrgrootx1.pem').resolve()}")
-    except Exception as e:
-        logger.error(f"Failed to download root certificate: {str(e)}")
-        raise
+    # Load the root certificate (refreshed from letsencrypt.org only if the last check is older than root_certificate_refresh_days).
+    # A deploy run uses the root certificate that was staged with the certificates.
+    if run_mode != "deploy":
+        root_certificate = load_root_certificate()
+        logger.debug(f"Root certificate was loaded ({len(root_certificate)} bytes)")
 
     # Get filtered provider instances
     filtered_providers = get_provider_instances(config, included_providers, excluded_providers)
-    
-    logger.info("Renewal process is being started")
+
+    # Collect the instances of every provider
+    renewal_targets = []
     for provider, instances in filtered_providers.items():
         try:
             # Get certificate manager class
@@ -60,70 +85,640 @@ def renew_provider_certificates(
             
             # Get required parameters for the provider
             required_provider_parameters = certificate_manager_class.get_required_parameters()
+            optional_provider_parameters = certificate_manager_class.get_optional_parameters()
             
-            # Process instances
-            renew_instance_certificate(
+            renewal_targets.extend(create_renewal_targets(
+                provider=provider,
                 instances=instances,
                 required_provider_parameters=required_provider_parameters,
+                optional_provider_parameters=optional_provider_parameters,
                 certificate_manager_class=certificate_manager_class
-            )
+            ))
             
         except Exception as e:
             logger.error(f"Failed to process provider {provider}: {str(e)}")
             continue
 
+    # Open the certificate inventory that remembers what was deployed to which instance
+    inventory = open_certificate_inventory(get_state_directory())
+
+    # Certificates issued by a "stage" run wait in the state directory for a "deploy" run
+    certificate_staging = open_certificate_staging(get_state_directory()) if run_mode != "full" else None
+
+    # Concurrency per provider and per appliance that adapts to the latency and errors of the API calls
+    concurrency_controller = ConcurrencyController(config_manager.max_workers, config_manager.provider_max_workers) if config_manager.adaptive_concurrency else None
+
+    logger.info(f"Renewal process is being started ({run_mode} run)")
+    try:
+        if run_mode == "deploy":
+            results = deploy_staged_certificates(renewal_targets, inventory, certificate_staging, concurrency_controller)
+        else:
+            results = renew_targets(renewal_targets, inventory, certificate_staging, concurrency_controller)
+    finally:
+        stop_key_pool()
+        inventory.close()
+
+    if concurrency_controller is not None:
+        concurrency_controller.log_limits()
+    log_run_summary(results)
+
     # Create final zip file with all certificates
     zip_path = create_final_certificate_zip()
 
     if zip_path:
         logger.info(f"All certificates have been saved to {zip_path}")
 
-# Renew certificates for a specific provider's instances
-# Args: 
+# Issue the certificates of the instances that need one and deploy them, or only stage them if a staging is given
+# Args:
+#     renewal_targets: The configured instances
+#     inventory: Certificate inventory of previous deployments
+#     certificate_staging: Where a "stage" run stores the certificates, None for a full run
+#     concurrency_controller: Adaptive concurrency of the deployments, None for the fixed worker limits
+def renew_targets(
+    renewal_targets: List["RenewalTarget"],
+    inventory: CertificateInventory,
+    certificate_staging: Optional[CertificateStaging],
+    concurrency_controller: Optional[ConcurrencyController]
+) -> List[InstanceResult]:
+
+    # Ask the CA when the deployed certificates should be renewed (ACME Renewal Information)
+    renewal_windows = get_renewal_windows(renewal_targets, inventory) if config_manager.acme_renewal_info and not config_manager.force_renewal else {}
+
+    # Skip the instances whose renewal is planned later in the window the CA suggests, the ones the inventory knows
+    # to have a certificate that is still valid long enough and the ones that already have a staged certificate that is valid long enough
+    results = []
+    candidate_targets = []
+    for target in renewal_targets:
+        target.renewal_window_open = renewal_window_is_open(target, inventory, renewal_windows)
+        if (
+            target.renewal_window_open is False
+            or (target.renewal_window_open is None and inventory_certificate_is_valid(target, inventory))
+            or staged_certificate_is_valid(target, certificate_staging)
+        ):
+            results.append(InstanceResult(target.provider, target.domain, STATUS_SKIPPED, instance=target.instance_name))
+        else:
+            candidate_targets.append(target)
+
+    # Drop the instances whose management API can't be reached before any certificate is ordered for them
+    reachable_targets, unreachable_results = check_targets_reachable(candidate_targets)
+    results += unreachable_results
+
+    # Pre-flight: find the instances whose certificate has to be renewed, concurrently for all instances
+    preflight_results = run_renewal_jobs(
+        jobs=[
+            RenewalJob(target.provider, target.domain, partial(check_instance_renewal_due, target), instance=target.instance_name)
+            for target in reachable_targets
+        ],
+        max_workers=config_manager.max_workers
+    )
+    due_instances = {(result.provider, result.instance) for result in preflight_results if result.status == STATUS_DUE}
+    due_targets = [target for target in reachable_targets if (target.provider, target.instance_name) in due_instances]
+    results += [result for result in preflight_results if result.status != STATUS_DUE]
+
+    # Keep the orders within the rate limits of the CA, the most urgent certificates first. The others are deferred to a later run.
+    rate_limit_scheduler = open_rate_limit_scheduler(get_state_directory(), config_manager.acme_directory_url) if config_manager.rate_limit_scheduling and due_targets else None
+    if rate_limit_scheduler is not None:
+        due_targets, deferred_results = schedule_certificate_orders(due_targets, inventory, rate_limit_scheduler)
+        results += deferred_results
+
+    # Generate the keys for the orders in the background while the DNS zones are looked up and the first zones are issued,
+    # one per domain and key type that is ordered in this run
+    if config_manager.issuance_backend == "native":
+        start_key_pool(Counter(key_type for _, key_type in {(target.domain, target.certificate_manager_class.key_type) for target in due_targets}))
+
+    # DNS zone of every domain, the native backend issues the certificates of a zone together
+    domain_zones = {}
+    if due_targets and config_manager.issuance_backend != "certbot":
+        domain_zones = get_domain_zones([target.domain for target in due_targets])
+
+    # Issue the certificates of the due instances (one DNS round per DNS zone) while the ones that are ready are deployed or staged
+    zone_issuance = ZoneIssuance(
+        [(target.domain, target.certificate_manager_class.key_type) for target in due_targets],
+        domain_zones=domain_zones,
+        rate_limit_scheduler=rate_limit_scheduler
+    )
+    # Instances that share a domain and key type (HA pairs, VIPs in front of several appliances) share one issuance
+    issuance_groups: Dict[Tuple[str, str], IssuanceGroup] = {}
+    for target in due_targets:
+        issuance_groups.setdefault((target.domain, target.certificate_manager_class.key_type), IssuanceGroup(target.domain, target.certificate_manager_class.key_type))
+
+    instance_renewals = [
+        InstanceRenewal(target, inventory, zone_issuance, concurrency_controller, issuance_groups[(target.domain, target.certificate_manager_class.key_type)])
+        for target in due_targets
+    ]
+    results += run_renewal_pipeline(
+        jobs=[
+            PipelineJob(
+                renewal.target.provider,
+                renewal.target.domain,
+                prepare=renewal.prepare,
+                deploy=partial(renewal.stage, certificate_staging) if certificate_staging else renewal.deploy,
+                instance=renewal.target.instance_name,
+                group=zone_issuance.get_zone(renewal.target.domain)
+            )
+            for renewal in instance_renewals
+        ],
+        prepare_workers=config_manager.max_workers,
+        max_workers=config_manager.max_workers,
+        provider_max_workers=config_manager.provider_max_workers,
+        provider_limit=concurrency_controller.provider_limit if concurrency_controller else None
+    )
+    zone_issuance.log_propagation_latencies()
+    log_issuance_groups(list(issuance_groups.values()))
+
+    return results
+
+# Admit the certificate orders of the due instances within the rate limits of the CA
+# Returns the instances whose certificate is ordered in this run and a deferred result for every other one
+# Args:
+#     due_targets: The instances whose certificate has to be renewed
+#     inventory: Certificate inventory of previous deployments, tells renewals from new certificates
+#     rate_limit_scheduler: Rate limits of the CA as used up by this and the previous runs
+def schedule_certificate_orders(
+    due_targets: List["RenewalTarget"],
+    inventory: CertificateInventory,
+    rate_limit_scheduler: RateLimitScheduler
+) -> Tuple[List["RenewalTarget"], List[InstanceResult]]:
+
+    # Instances that share a domain and key type share the order, the most urgent of them decides its place in the queue
+    issuance_requests: Dict[Tuple[str, str], IssuanceRequest] = {}
+    for target in due_targets:
+        certificate_request = (target.domain, target.certificate_manager_class.key_type)
+        issuance_request = issuance_requests.setdefault(certificate_request, IssuanceRequest(
+            domain=target.domain,
+            key_type=target.certificate_manager_class.key_type,
+            registered_domain=get_registered_domain(target.domain),
+            remaining_days=target.remaining_days
+        ))
+        if target.remaining_days is None or (issuance_request.remaining_days is not None and target.remaining_days < issuance_request.remaining_days):
+            issuance_request.remaining_days = target.remaining_days
+
+        # A certificate for the domain was deployed before, the CA issued the same name set already
+        if inventory.get_record(target.domain, target.instance_name) is not None:
+            issuance_request.renewal = True
+
+    _, deferred_requests = rate_limit_scheduler.schedule(list(issuance_requests.values()))
+
+    admitted_targets = []
+    deferred_results = []
+    for target in due_targets:
+        reason = deferred_requests.get((target.domain, target.certificate_manager_class.key_type))
+        if reason is None:
+            admitted_targets.append(target)
+        else:
+            deferred_results.append(InstanceResult(target.provider, target.domain, STATUS_DEFERRED, instance=target.instance_name, message=reason))
+
+    # The pipeline prepares the instances in the order of the queue
+    admitted_targets.sort(key=lambda target: float("-inf") if target.remaining_days is None else target.remaining_days)
+
+    return admitted_targets, deferred_results
+
+# Deploy the certificates of a "stage" run: only upload, activate and clean up, concurrently for all staged instances
+# Args:
+#     renewal_targets: The configured instances, they provide the credentials
+#     inventory: Certificate inventory of previous deployments
+#     certificate_staging: The staged certificates
+#     concurrency_controller: Adaptive concurrency of the deployments, None for the fixed worker limits
+def deploy_staged_certificates(
+    renewal_targets: List["RenewalTarget"],
+    inventory: CertificateInventory,
+    certificate_staging: CertificateStaging,
+    concurrency_controller: Optional[ConcurrencyController]
+) -> List[InstanceResult]:
+
+    configured_targets = {(target.provider, target.instance_name): target for target in renewal_targets}
+
+    staged_targets = []
+    for staged_instance in certificate_staging.get_staged_instances():
+        target = configured_targets.get((staged_instance.provider, staged_instance.instance))
+        if target is None:
+            logger.warning(f"{staged_instance.provider} instance {staged_instance.instance} has a staged certificate but isn't configured (any more), it is left staged")
+            continue
+        staged_targets.append((target, staged_instance))
+
+    logger.info(f"{len(staged_targets)} staged certificates are being deployed")
+
+    # Unreachable instances keep their staged certificate for the next deploy run
+    reachable_targets, results = check_targets_reachable([target for target, _ in staged_targets])
+    reachable_instances = {(target.provider, target.instance_name) for target in reachable_targets}
+
+    results += run_renewal_jobs(
+        jobs=[
+            RenewalJob(target.provider, target.domain, partial(deploy_staged_certificate, target, staged_instance, inventory, certificate_staging, concurrency_controller), instance=target.instance_name)
+            for target, staged_instance in staged_targets
+            if (target.provider, target.instance_name) in reachable_instances
+        ],
+        max_workers=config_manager.max_workers,
+        provider_max_workers=config_manager.provider_max_workers,
+        provider_limit=concurrency_controller.provider_limit if concurrency_controller else None
+    )
+
+    return results
+
+### One configured instance that takes part in the run ###
+
+@dataclass
+class RenewalTarget:
+    provider: str
+    instance_name: str
+    instance_config: Dict[str, str]
+    certificate_manager_class: Type[CertificateManager]
+
+    # Days the certificate served by the instance is still valid, set by the pre-flight check (None if unknown)
+    remaining_days: Optional[float] = None
+
+    # True if the renewal window the CA suggests for the certificate of the instance is open, False if the renewal
+    # is planned later in the window, None if there is no window and renewal_threshold_days decides
+    renewal_window_open: Optional[bool] = None
+
+    @property
+    def domain(self) -> str:
+        return self.instance_config["domain"]
+
+    # (host, port) the management interface of the instance is reached on
+    @property
+    def management_endpoint(self) -> Tuple[str, int]:
+        return self.certificate_manager_class.get_management_endpoint(self.instance_config)
+
+# Create the renewal targets for a specific provider's instances
+# Args:
+#     provider: Name of the provider the instances belong to
 #     instances: Dictionary containing instance configurations
 #     required_provider_parameters: List of required parameters for the provider
+#     optional_provider_parameters: List of parameters the provider uses if they are configured
 #     certificate_manager_class: The certificate manager class to use for renewal
-def renew_instance_certificate(
+def create_renewal_targets(
+    provider: str,
     instances: Dict[str, Any],
     required_provider_parameters: List[str],
+    optional_provider_parameters: List[str],
     certificate_manager_class: Type[CertificateManager]
-) -> None:
-    
+) -> List[RenewalTarget]:
+
+    renewal_targets = []
     for instance in instances.get("instances", []):
         try:
             # Get instance configuration
-            instance_config = get_instance_config(instance, required_provider_parameters)
+            instance_config = get_instance_config(instance, required_provider_parameters, optional_provider_parameters)
             
             domain = instance_config.get("domain")
             if not domain:
                 logger.error("Instance was skipped: domain is missing")
                 continue
-                
-            logger.info(f"Domain for the instance is: {domain}")
-            
-            # Check connection
-            if not check_instance_connection(domain):
-                logger.error(f"Instance was skipped: Could not establish connection to {domain}")
-                continue
-                
-            # Initialize and execute certificate renewal
-            certificate_manager = certificate_manager_class(**instance_config)
-            logger.info(f"Executing SSL certificate renewal for {domain}")
-            certificate_manager.execute_certificate_renewal()
+
+            # The environment variable holding the domain identifies the instance in the inventory
+            instance_name = instance.get("domain_env_var", domain)
+
+            renewal_targets.append(RenewalTarget(
+                provider=provider,
+                instance_name=instance_name,
+                instance_config=instance_config,
+                certificate_manager_class=certificate_manager_class
+            ))
 
         except Exception as e:
             logger.error(f"Failed to process instance: {str(e)}")
             continue
 
-def check_instance_connection(domain: str) -> bool:
+    return renewal_targets
 
-    # Test connection to an instance by pinging its domain.
-    try:
-        response_time = ping(domain)
-        if response_time is False:
-            logger.warning(f"Ping to {domain} failed. This might be normal if ICMP is blocked.")
-            return False
+# Decide from the inventory if the certificate of an instance is still valid long enough, without any network call
+# Args:
+#     target: The instance to check
+#     inventory: Certificate inventory of previous deployments
+def inventory_certificate_is_valid(target: RenewalTarget, inventory: CertificateInventory) -> bool:
+
+    if config_manager.force_renewal:
+        return False
+
+    inventory_record = inventory.get_record(target.domain, target.instance_name)
+    if inventory_record and inventory_record.remaining_days() > config_manager.renewal_threshold_days:
+        logger.info(f"Inventory shows the certificate of {target.domain} is valid for {inventory_record.remaining_days():.0f} more days, renewal is skipped")
         return True
-    except Exception as e:
-        logger.error(f"Unexpected error while checking connection to {domain}: {str(e)}")
-        return False
\ No newline at end of file
+
+    return False
+
+# Get the renewal window the CA suggests for the certificate the inventory knows each instance to run
+# Returns the windows by ARI certificate ID
+# Args:
+#     renewal_targets: The configured instances
+#     inventory: Certificate inventory of previous deployments
+def get_renewal_windows(renewal_targets: List[RenewalTarget], inventory: CertificateInventory) -> Dict[str, RenewalWindow]:
+
+    certificate_domains = {}
+    for target in renewal_targets:
+        inventory_record = inventory.get_record(target.domain, target.instance_name)
+        if inventory_record and inventory_record.renewal_info_id:
+            certificate_domains[inventory_record.renewal_info_id] = target.domain
+
+    renewal_info_cache = open_renewal_info_cache(get_state_directory(), config_manager.acme_directory_url)
+    return renewal_info_cache.get_renewal_windows(certificate_domains, config_manager.max_workers)
+
+# Decide from the renewal window of the deployed certificate if an instance has to be renewed
+# Returns None if there is no window, the instance then is decided by renewal_threshold_days
+# Args:
+#     target: The instance to check
+#     inventory: Certificate inventory of previous deployments
+#     renewal_windows: The renewal windows by ARI certificate ID
+def renewal_window_is_open(target: RenewalTarget, inventory: CertificateInventory, renewal_windows: Dict[str, RenewalWindow]) -> Optional[bool]:
+
+    inventory_record = inventory.get_record(target.domain, target.instance_name)
+    renewal_window = renewal_windows.get(inventory_record.renewal_info_id) if inventory_record and inventory_record.renewal_info_id else None
+    if renewal_window is None:
+        return None
+
+    if renewal_window.renewal_is_due():
+        logger.info(f"Renewal window of the certificate of {target.domain} is open (renewal was planned for {renewal_window.renew_at}), renewal is due")
+        return True
+
+    logger.info(f"Renewal of the certificate of {target.domain} is planned for {renewal_window.renew_at} inside the window the CA suggests, renewal is skipped")
+    return False
+
+# Decide from the staged certificates if a "stage" run can skip an instance
+# Args:
+#     target: The instance to check
+#     certificate_staging: The staged certificates, None for a full run
+def staged_certificate_is_valid(target: RenewalTarget, certificate_staging: Optional[CertificateStaging]) -> bool:
+
+    if certificate_staging is None or config_manager.force_renewal:
+        return False
+
+    staged_instance = certificate_staging.get_staged_instance(target.provider, target.instance_name)
+    if staged_instance and staged_instance.remaining_days() > config_manager.renewal_threshold_days:
+        logger.info(f"Certificate of {target.domain} is already staged and valid for {staged_instance.remaining_days():.0f} more days, staging is skipped")
+        return True
+
+    return False
+
+# Check the management API of all instances at the same time
+# Returns the reachable instances and a failed result for every unreachable one
+# Args:
+#     targets: The instances to check
+def check_targets_reachable(targets: List[RenewalTarget]) -> Tuple[List[RenewalTarget], List[InstanceResult]]:
+
+    reachability = check_endpoints_reachable(
+        [target.management_endpoint for target in targets],
+        timeout=config_manager.reachability_timeout,
+        tls_handshake=config_manager.reachability_tls_handshake
+    )
+
+    reachable_targets = []
+    unreachable_results = []
+    for target in targets:
+        host, port = target.management_endpoint
+        reason = reachability[(host, port)]
+        if reason is None:
+            reachable_targets.append(target)
+        else:
+            unreachable_results.append(InstanceResult(
+                target.provider,
+                target.domain,
+                STATUS_FAILED,
+                instance=target.instance_name,
+                message=f"Could not establish connection to {host}:{port}: {reason}"
+            ))
+
+    logger.info(f"{len(reachable_targets)} of {len(targets)} instances are reachable")
+    return reachable_targets, unreachable_results
+
+# Pre-flight check of a single reachable instance. Runs inside a worker of the renewal engine.
+# Returns STATUS_DUE if the certificate of the instance has to be renewed, STATUS_SKIPPED otherwise.
+# Args:
+#     target: The instance to check
+def check_instance_renewal_due(target: RenewalTarget) -> str:
+
+    domain = target.domain
+    logger.info(f"Domain for the instance is: {domain}")
+
+    # Skip the instance if the certificate it is serving is still valid long enough, unless the CA asks for its renewal.
+    # The remaining days also decide the order of issuance when the rate limits of the CA don't allow all orders.
+    if not config_manager.force_renewal:
+        host, port = target.management_endpoint
+        target.remaining_days = probe_remaining_days(domain, port, host=host)
+        if not target.renewal_window_open and not certificate_renewal_is_due(domain, target.remaining_days, config_manager.renewal_threshold_days):
+            return STATUS_SKIPPED
+
+    return STATUS_DUE
+
+### Renewal of a single instance, in the two stages of the renewal pipeline ###
+
+class InstanceRenewal:
+
+    # The certificate manager is created in the prepare stage and keeps the certificate and its artifacts for the deploy stage
+    def __init__(
+        self,
+        target: RenewalTarget,
+        inventory: CertificateInventory,
+        zone_issuance: ZoneIssuance,
+        concurrency_controller: Optional[ConcurrencyController] = None,
+        issuance_group: Optional["IssuanceGroup"] = None
+    ):
+        self.target = target
+        self.inventory = inventory
+        self.zone_issuance = zone_issuance
+        self.concurrency_controller = concurrency_controller
+        self.issuance_group = issuance_group
+        self.certificate_manager: Optional[CertificateManager] = None
+
+    def prepare(self) -> None:
+
+        # ACME side: issue the certificate (together with the other domains of its DNS zone) and build the files the instance needs.
+        # Nothing is sent to the instance yet, its time budget starts with the deploy stage.
+        self.zone_issuance.ensure_issued(self.target.domain)
+
+        inventory_record = self.inventory.get_record(self.target.domain, self.target.instance_name)
+        certificate_manager = create_certificate_manager(self.target, inventory_record, self.concurrency_controller)
+
+        logger.info(f"Preparing SSL certificate renewal for {self.target.domain}")
+        if self.issuance_group is not None:
+            self.issuance_group.issue_certificate(certificate_manager, self.target.instance_name)
+        else:
+            certificate_manager.issue_certificate()
+        certificate_manager.build_artifacts()
+        self.certificate_manager = certificate_manager
+
+    def deploy(self) -> str:
+
+        # Instance side: upload, activate and clean up. The time budget of the instance starts when the deploy stage takes
+        # the job, DNS propagation, ordering and the wait in the deploy queue don't count against it.
+        logger.info(f"Executing SSL certificate renewal for {self.target.domain}")
+        self.certificate_manager.deadline = start_deadline()
+        try:
+            self.certificate_manager.deploy_certificate()
+        finally:
+            self.certificate_manager.close_session()
+
+        record_instance_deployment(self.inventory, self.target.provider, self.target.instance_name, self.certificate_manager)
+
+        return STATUS_RENEWED
+
+    def stage(self, certificate_staging: CertificateStaging) -> str:
+
+        # "stage" run: keep the certificate for a later "deploy" run instead of deploying it
+        certificate_artifacts = self.certificate_manager.certificate_artifacts
+        certificate_staging.stage(
+            provider=self.target.provider,
+            instance=self.target.instance_name,
+            key_type=self.certificate_manager.key_type,
+            not_after=parse_certificate(certificate_artifacts.cert_pem).not_after,
+            artifacts=certificate_artifacts
+        )
+        self.certificate_manager.close_session()
+
+        return STATUS_STAGED
+
+### Instances that share a domain and key type, issued once for all of them ###
+
+class IssuanceGroup:
+
+    # The first member that is prepared issues the certificate, the other members get the same artifacts and wait for them
+    # if the issuance is still running. A failed issuance fails every member instead of being attempted again for each of them.
+    def __init__(self, domain: str, key_type: str):
+        self.domain = domain
+        self.key_type = key_type
+        self.lock = threading.Lock()
+        self.certificate_artifacts: Optional[CertificateArtifacts] = None
+        self.issuance_error: Optional[Exception] = None
+        self.issued_for: Optional[str] = None
+        self.reused_for: List[str] = []
+
+    def issue_certificate(self, certificate_manager: CertificateManager, instance_name: str) -> None:
+        with self.lock:
+            if self.issuance_error is not None:
+                raise RuntimeError(f"Issuance for {self.domain} already failed for instance {self.issued_for}: {str(self.issuance_error)}")
+
+            if self.certificate_artifacts is None:
+                self.issued_for = instance_name
+                try:
+                    certificate_manager.issue_certificate()
+                except Exception as e:
+                    self.issuance_error = e
+                    raise
+                self.certificate_artifacts = certificate_manager.certificate_artifacts
+                return
+
+            certificate_manager.certificate_artifacts = self.certificate_artifacts
+            self.reused_for.append(instance_name)
+
+        logger.info(f"Certificate for {self.domain} ({self.key_type}) issued for instance {self.issued_for} is reused for instance {instance_name}")
+
+def log_issuance_groups(issuance_groups: List[IssuanceGroup]) -> None:
+
+    # Report the certificates that were issued once and deployed to several instances
+    shared_groups = [issuance_group for issuance_group in issuance_groups if issuance_group.reused_for]
+    if not shared_groups:
+        return
+
+    issued_instances = sum(1 + len(issuance_group.reused_for) for issuance_group in issuance_groups if issuance_group.certificate_artifacts is not None)
+    issued_groups = sum(1 for issuance_group in issuance_groups if issuance_group.certificate_artifacts is not None)
+    logger.info(f"{issued_groups} certificates were issued for {issued_instances} instances")
+    for issuance_group in shared_groups:
+        logger.info(f"Certificate for {issuance_group.domain} ({issuance_group.key_type}) was issued for instance {issuance_group.issued_for} and reused for {', '.join(sorted(issuance_group.reused_for))}")
+
+# Deploy the staged certificate of a single instance. Runs inside a worker of the renewal engine.
+# Args:
+#     target: The instance to deploy to
+#     staged_instance: The staged certificate of the instance
+#     inventory: Certificate inventory of previous deployments
+#     certificate_staging: The staged certificates, the instance is removed from them after the deployment
+#     concurrency_controller: Adaptive concurrency of the deployments, None for the fixed worker limits
+def deploy_staged_certificate(
+    target: RenewalTarget,
+    staged_instance: StagedInstance,
+    inventory: CertificateInventory,
+    certificate_staging: CertificateStaging,
+    concurrency_controller: Optional[ConcurrencyController] = None
+) -> str:
+
+    deadline = start_deadline()
+    if staged_instance.remaining_days() <= 0:
+        certificate_staging.remove(staged_instance)
+        raise ValueError(f"Staged certificate of {target.domain} expired on {staged_instance.not_after}, it was removed")
+
+    # A full run may have deployed a newer certificate since the certificate was staged
+    inventory_record = inventory.get_record(target.domain, target.instance_name)
+    if inventory_record and inventory_record.not_after >= datetime.fromisoformat(staged_instance.not_after):
+        logger.info(f"Instance {target.instance_name} already has a newer certificate than the staged one, it was removed")
+        certificate_staging.remove(staged_instance)
+        return STATUS_SKIPPED
+
+    certificate_manager = create_certificate_manager(target, inventory_record, concurrency_controller, deadline)
+
+    # The bundles are built from the staged certificate in memory, only the instance side runs in the window
+    certificate_manager.certificate_artifacts = certificate_staging.load_artifacts(staged_instance)
+    certificate_manager.build_artifacts()
+
+    logger.info(f"Deploying the staged SSL certificate of {target.domain}")
+    try:
+        certificate_manager.deploy_certificate()
+    finally:
+        certificate_manager.close_session()
+
+    record_instance_deployment(inventory, target.provider, target.instance_name, certificate_manager)
+    certificate_staging.remove(staged_instance)
+
+    return STATUS_RENEWED
+
+# Create the certificate manager of an instance with what the orchestrator knows about it
+# Args:
+#     target: The instance
+#     inventory_record: What the previous run deployed to the instance, if anything
+#     concurrency_controller: Adaptive concurrency that measures the API calls of the instance, if enabled
+#     deadline: End of the time budget of the instance, started when its renewal job started
+def create_certificate_manager(
+    target: RenewalTarget,
+    inventory_record: Optional[InventoryRecord],
+    concurrency_controller: Optional[ConcurrencyController],
+    deadline: Optional[float] = None
+) -> CertificateManager:
+
+    certificate_manager = target.certificate_manager_class(**target.instance_config)
+    certificate_manager.deadline = deadline
+    if inventory_record and inventory_record.provider == target.provider:
+        certificate_manager.previous_certificate_id = inventory_record.appliance_certificate_id
+    if concurrency_controller is not None:
+        certificate_manager.call_hooks = [concurrency_controller.call_hook(target.provider)]
+
+    return certificate_manager
+
+def record_instance_deployment(
+    inventory: CertificateInventory,
+    provider: str,
+    instance_name: str,
+    certificate_manager: CertificateManager
+) -> None:
+
+    # Remember what was deployed so the next run can decide without network calls
+    if certificate_manager.certificate_artifacts is not None:
+        certificate_pem = certificate_manager.certificate_artifacts.cert_pem
+    else:
+        cert_path, = certificate_paths(domain=certificate_manager.domain, key_type=certificate_manager.key_type, requested_paths=["cert_path"])
+        certificate_pem = Path(cert_path).read_bytes()
+    certificate_details = parse_certificate(certificate_pem)
+
+    inventory.record_deployment(InventoryRecord(
+        domain=certificate_manager.domain,
+        instance=instance_name,
+        provider=provider,
+        serial=certificate_details.serial,
+        fingerprint=certificate_details.fingerprint,
+        not_after=certificate_details.not_after,
+        key_type=certificate_manager.key_type,
+        deployed_at=datetime.now(timezone.utc),
+        appliance_certificate_id=certificate_manager.deployed_certificate_id,
+        renewal_info_id=certificate_identifier(certificate_pem)
+    ))
+
+def log_run_summary(results: List[InstanceResult]) -> None:
+
+    # Report the outcome of every instance at the end of the run
+    status_counts = Counter(result.status for result in results)
+    logger.info(f"Renewal finished for {len(results)} instances: {dict(status_counts)}")
+
+    for result in results:
+        if result.status == STATUS_FAILED:
+            logger.error(f"{result.provider} instance {result.instance} ({result.domain}) failed after {result.duration_seconds:.1f}s: {result.message}")
+        elif result.status == STATUS_DEFERRED:
+            logger.warning(f"{result.provider} instance {result.instance} ({result.domain}) was deferred: {result.message}")
+        else:
+            logger.debug(f"{result.provider} instance {result.instance} ({result.domain}) {result.status} in {result.duration_seconds:.1f}s")
@@ -0,0 +1,216 @@
+# Standard library imports
+import logging
+import logging.config
+import queue
+import time
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+# Load logging configuration
+logging.config.fileConfig("logging.ini")
+logger = logging.getLogger("renewal_engine")
+
+# Possible outcomes of a single instance renewal
+STATUS_RENEWED = "renewed"
+STATUS_SKIPPED = "skipped"
+STATUS_FAILED = "failed"
+
+# Outcome of a "stage" run: the certificate was issued and stored for a later "deploy" run
+STATUS_STAGED = "staged"
+
+# The certificate is due but wasn't ordered because the rate limits of the CA are used up, a later run renews it
+STATUS_DEFERRED = "deferred"
+
+# Intermediate outcome of a pre-flight job: the instance needs a new certificate
+STATUS_DUE = "due"
+
+### Data holders for the jobs the engine runs and the results it collects ###
+
+@dataclass
+class RenewalJob:
+
+    # One unit of work for the engine. "run" does the work for one instance and
+    # returns the status it ended with (e.g. STATUS_RENEWED or STATUS_SKIPPED), raising on failure.
+    provider: str
+    domain: str
+    run: Callable[[], str]
+    instance: str = ""
+
+@dataclass
+class PipelineJob:
+
+    # One instance for the renewal pipeline. "prepare" does the ACME side (issue the certificate and build its artifacts),
+    # "deploy" the instance side and returns the status it ended with, both raise on failure.
+    # Jobs of the same "group" (e.g. a DNS zone) are prepared one after the other, so the first one can do the work for the whole group.
+    provider: str
+    domain: str
+    prepare: Callable[[], None]
+    deploy: Callable[[], str]
+    instance: str = ""
+    group: str = ""
+
+@dataclass
+class InstanceResult:
+    provider: str
+    domain: str
+    status: str
+    instance: str = ""
+    message: str = ""
+    duration_seconds: float = 0.0
+
+### Engine that runs the jobs with a global and a per-provider worker limit ###
+
+def run_renewal_jobs(
+    jobs: List[RenewalJob],
+    max_workers: int,
+    provider_max_workers: Optional[Dict[str, int]] = None,
+    provider_limit: Optional[Callable[[str], int]] = None
+) -> List[InstanceResult]:
+
+    # Jobs are only handed to the thread pool when their provider still has a free slot,
+    # so a provider that is at its limit never blocks workers that other providers could use.
+    # "provider_limit" replaces the fixed per-provider limits with ones that can change during the run (e.g. concurrency_control).
+    provider_max_workers = provider_max_workers or {}
+    provider_limit = provider_limit or (lambda provider: provider_max_workers.get(provider, max_workers))
+
+    pending_jobs: Dict[str, deque] = {}
+    for job in jobs:
+        pending_jobs.setdefault(job.provider, deque()).append(job)
+
+    running_jobs = {provider: 0 for provider in pending_jobs}
+    results: List[InstanceResult] = []
+
+    logger.info(f"Starting {len(jobs)} jobs with {max_workers} workers")
+    logger.debug(f"Provider worker limits: {provider_max_workers}")
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="renewal") as executor:
+        in_flight = {}
+
+        def submit_ready_jobs():
+            # Hand out free slots round robin over the providers to keep them progressing evenly
+            submitted = True
+            while submitted and len(in_flight) < max_workers:
+                submitted = False
+                for provider, queue in pending_jobs.items():
+                    if queue and running_jobs[provider] < provider_limit(provider) and len(in_flight) < max_workers:
+                        job = queue.popleft()
+                        in_flight[executor.submit(execute_renewal_job, job)] = job
+                        running_jobs[provider] += 1
+                        submitted = True
+
+        submit_ready_jobs()
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = in_flight.pop(future)
+                running_jobs[job.provider] -= 1
+                results.append(future.result())
+            submit_ready_jobs()
+
+    return results
+
+def execute_renewal_job(job: RenewalJob) -> InstanceResult:
+
+    # A failing instance is turned into a result instead of an exception so it never stops the others
+    start_time = time.monotonic()
+    try:
+        status = job.run()
+        return InstanceResult(job.provider, job.domain, status, instance=job.instance, duration_seconds=time.monotonic() - start_time)
+
+    except Exception as e:
+        logger.error(f"Failed to process instance {job.domain} ({job.provider}): {str(e)}")
+        return InstanceResult(job.provider, job.domain, STATUS_FAILED, instance=job.instance, message=str(e), duration_seconds=time.monotonic() - start_time)
+
+### Pipeline that prepares certificates while others are being deployed ###
+
+# Events the pipeline stages send to the scheduler
+EVENT_PREPARED = "prepared"
+EVENT_PREPARE_FAILED = "prepare_failed"
+EVENT_DEPLOYED = "deployed"
+
+def run_renewal_pipeline(
+    jobs: List[PipelineJob],
+    prepare_workers: int,
+    max_workers: int,
+    provider_max_workers: Optional[Dict[str, int]] = None,
+    queue_size: Optional[int] = None,
+    provider_limit: Optional[Callable[[str], int]] = None
+) -> List[InstanceResult]:
+
+    # Two stages with their own workers: the prepare workers issue certificates while the deploy workers upload the ones
+    # that are ready, so the ACME side and the instances are busy at the same time. The prepared jobs wait in a bounded queue,
+    # a prepare worker that finds it full waits until a deployment finishes, so certificates aren't issued far ahead of the instances.
+    # Deployments keep the global and per-provider worker limits of run_renewal_jobs.
+    provider_max_workers = provider_max_workers or {}
+    provider_limit = provider_limit or (lambda provider: provider_max_workers.get(provider, max_workers))
+    queue_size = queue_size or max_workers
+
+    prepared_jobs: queue.Queue = queue.Queue(maxsize=queue_size)
+    events: queue.Queue = queue.Queue()
+    start_times: Dict[int, float] = {}
+
+    group_jobs: Dict[str, List[PipelineJob]] = {}
+    for job in jobs:
+        group_jobs.setdefault(job.group, []).append(job)
+
+    def prepare_group(jobs_of_group: List[PipelineJob]) -> None:
+        for job in jobs_of_group:
+            start_times[id(job)] = time.monotonic()
+            try:
+                job.prepare()
+            except Exception as e:
+                logger.error(f"Failed to prepare instance {job.domain} ({job.provider}): {str(e)}")
+                events.put((EVENT_PREPARE_FAILED, job, InstanceResult(job.provider, job.domain, STATUS_FAILED, instance=job.instance, message=str(e), duration_seconds=time.monotonic() - start_times[id(job)])))
+                continue
+
+            # Blocks while the queue is full
+            prepared_jobs.put(job)
+            events.put((EVENT_PREPARED, job, None))
+
+    def deploy_job(job: PipelineJob) -> None:
+        result = execute_renewal_job(RenewalJob(job.provider, job.domain, job.deploy, instance=job.instance))
+        result.duration_seconds = time.monotonic() - start_times[id(job)]
+        events.put((EVENT_DEPLOYED, job, result))
+
+    pending_jobs: Dict[str, deque] = {}
+    running_jobs: Counter = Counter()
+    results: List[InstanceResult] = []
+
+    logger.info(f"Starting the pipeline for {len(jobs)} jobs in {len(group_jobs)} groups with {prepare_workers} prepare and {max_workers} deploy workers")
+    logger.debug(f"Provider worker limits: {provider_max_workers}, queue size: {queue_size}")
+
+    with ThreadPoolExecutor(max_workers=prepare_workers, thread_name_prefix="prepare") as prepare_executor, \
+         ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="renewal") as deploy_executor:
+
+        def submit_ready_jobs():
+            # Take prepared jobs from the queue and hand out free slots round robin over the providers
+            submitted = True
+            while submitted:
+                submitted = False
+                while sum(len(provider_queue) for provider_queue in pending_jobs.values()) < queue_size:
+                    try:
+                        job = prepared_jobs.get_nowait()
+                    except queue.Empty:
+                        break
+                    pending_jobs.setdefault(job.provider, deque()).append(job)
+
+                for provider, provider_queue in pending_jobs.items():
+                    if provider_queue and running_jobs[provider] < provider_limit(provider) and sum(running_jobs.values()) < max_workers:
+                        deploy_executor.submit(deploy_job, provider_queue.popleft())
+                        running_jobs[provider] += 1
+                        submitted = True
+
+        for jobs_of_group in group_jobs.values():
+            prepare_executor.submit(prepare_group, jobs_of_group)
+
+        while len(results) < len(jobs):
+            event, job, result = events.get()
+            if event == EVENT_DEPLOYED:
+                running_jobs[job.provider] -= 1
+            if result is not None:
+                results.append(result)
+            submit_ready_jobs()
+
+    return results
@@ -0,0 +1,223 @@
+# Standard library imports
+import base64
+import json
+import logging
+import logging.config
+import os
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from functools import partial
+from pathlib import Path
+from typing import Dict, Optional
+
+# Third party imports
+import requests
+from cryptography import x509
+
+# Load logging configuration
+logging.config.fileConfig("logging.ini")
+logger = logging.getLogger("renewal_info")
+
+# Constants
+RENEWAL_INFO_FILE_NAME = "renewal_info.json"
+RENEWAL_INFO_TIMEOUT = 10
+
+# Seconds until the renewal information of a certificate is fetched again if the CA doesn't send a Retry-After,
+# and the bounds for the Retry-After of the CA (RFC 9773)
+DEFAULT_RETRY_AFTER = 6 * 3600
+MINIMUM_RETRY_AFTER = 60
+MAXIMUM_RETRY_AFTER = 86400
+
+### Renewal window the CA suggests for one certificate ###
+
+@dataclass
+class RenewalWindow:
+    start: str
+    end: str
+
+    # Time inside the window the certificate is renewed at, picked once per window so the renewals of many certificates spread out
+    renew_at: str
+
+    # The renewal information isn't fetched again before this time
+    retry_at: str
+    explanation_url: Optional[str] = None
+
+    def renewal_is_due(self, now: Optional[datetime] = None) -> bool:
+        now = now or datetime.now(timezone.utc)
+        return now >= datetime.fromisoformat(self.renew_at)
+
+def certificate_identifier(certificate_pem: bytes) -> Optional[str]:
+
+    # ARI certificate ID: key identifier of the issuer and serial number (DER integer bytes), both base64url without padding.
+    # None if the certificate has no authority key identifier.
+    certificate = x509.load_pem_x509_certificate(certificate_pem)
+    try:
+        authority_key_identifier = certificate.extensions.get_extension_for_class(x509.AuthorityKeyIdentifier).value.key_identifier
+    except x509.ExtensionNotFound:
+        return None
+    if authority_key_identifier is None:
+        return None
+
+    serial_bytes = certificate.serial_number.to_bytes((certificate.serial_number.bit_length() + 8) // 8, "big")
+
+    return f"{base64.urlsafe_b64encode(authority_key_identifier).decode().rstrip('=')}.{base64.urlsafe_b64encode(serial_bytes).decode().rstrip('=')}"
+
+### ACME Renewal Information of the deployed certificates, cached in the state directory ###
+
+class RenewalInfoCache:
+
+    # The CA tells in its renewalInfo resource when a certificate should be renewed, and asks for an earlier renewal
+    # if it has to revoke certificates. The window of every certificate is kept until the Retry-After of the CA,
+    # runs in between don't ask again. Every failure returns no window, the renewal then falls back to renewal_threshold_days.
+    def __init__(self, state_file: Path, directory_url: str):
+        self.state_file = state_file
+        self.directory_url = directory_url
+
+        # The windows of several certificates are fetched at the same time
+        self.lock = threading.Lock()
+        self.renewal_windows: Dict[str, RenewalWindow] = {}
+        if self.state_file.exists():
+            try:
+                self.renewal_windows = {certificate_id: RenewalWindow(**window) for certificate_id, window in json.loads(self.state_file.read_text()).items()}
+            except (ValueError, TypeError) as e:
+                logger.warning(f"Renewal information cache {self.state_file} couldn't be loaded, fetching it again: {str(e)}")
+
+    def get_renewal_windows(self, certificate_domains: Dict[str, str], max_workers: int) -> Dict[str, RenewalWindow]:
+
+        # Renewal window of every ARI certificate ID given (mapped to its domain for the log), concurrently.
+        # Certificates without a window are left out.
+        if not certificate_domains:
+            return {}
+
+        # Only certificates whose cached window expired need the renewalInfo URL of the directory. It is fetched once
+        # before the workers start, if the directory can't be reached no window is fetched in this run.
+        now = datetime.now(timezone.utc)
+        renewal_info_url = None
+        if any(self.cached_window(certificate_id, now) is None for certificate_id in certificate_domains):
+            renewal_info_url = self.get_renewal_info_url()
+
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="renewal_info") as executor:
+            renewal_windows = dict(zip(
+                certificate_domains,
+                executor.map(partial(self.get_renewal_window, renewal_info_url=renewal_info_url), certificate_domains, certificate_domains.values())
+            ))
+
+        with self.lock:
+            self.save()
+
+        return {certificate_id: renewal_window for certificate_id, renewal_window in renewal_windows.items() if renewal_window is not None}
+
+    def cached_window(self, certificate_id: str, now: datetime) -> Optional[RenewalWindow]:
+        with self.lock:
+            cached_window = self.renewal_windows.get(certificate_id)
+
+        if cached_window and now < datetime.fromisoformat(cached_window.retry_at):
+            return cached_window
+        return None
+
+    def get_renewal_window(self, certificate_id: str, domain: str, renewal_info_url: Optional[str]) -> Optional[RenewalWindow]:
+        now = datetime.now(timezone.utc)
+        cached_window = self.cached_window(certificate_id, now)
+        if cached_window is not None:
+            logger.debug(f"Renewal window of {domain} is cached until {cached_window.retry_at}")
+            return cached_window
+
+        if renewal_info_url is None:
+            return None
+
+        try:
+            response = requests.get(f"{renewal_info_url.rstrip('/')}/{certificate_id}", timeout=RENEWAL_INFO_TIMEOUT)
+            response.raise_for_status()
+            renewal_info = response.json()
+            start = datetime.fromisoformat(renewal_info["suggestedWindow"]["start"].replace("Z", "+00:00"))
+            end = datetime.fromisoformat(renewal_info["suggestedWindow"]["end"].replace("Z", "+00:00"))
+            if end < start:
+                raise ValueError(f"window ends before it starts ({start} - {end})")
+
+        except (requests.RequestException, ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Renewal information for {domain} couldn't be fetched, using renewal_threshold_days: {str(e)}")
+            return None
+
+        # The time inside the window is kept as long as the CA suggests the same window
+        with self.lock:
+            previous_window = self.renewal_windows.get(certificate_id)
+
+        if previous_window and (previous_window.start, previous_window.end) == (start.isoformat(), end.isoformat()):
+            renew_at = datetime.fromisoformat(previous_window.renew_at)
+        else:
+            renew_at = start + (end - start) * random.random()
+
+        renewal_window = RenewalWindow(
+            start=start.isoformat(),
+            end=end.isoformat(),
+            renew_at=renew_at.isoformat(),
+            retry_at=(now + timedelta(seconds=parse_retry_after(response.headers.get("Retry-After"), now))).isoformat(),
+            explanation_url=renewal_info.get("explanationURL")
+        )
+        logger.info(f"CA suggests renewing the certificate of {domain} between {start:%Y-%m-%d %H:%M} and {end:%Y-%m-%d %H:%M}, renewal is planned for {renew_at:%Y-%m-%d %H:%M} UTC")
+        if renewal_window.explanation_url:
+            logger.warning(f"CA published an explanation for the renewal window of {domain}: {renewal_window.explanation_url}")
+
+        with self.lock:
+            self.renewal_windows[certificate_id] = renewal_window
+
+        return renewal_window
+
+    def get_renewal_info_url(self) -> Optional[str]:
+
+        # The renewalInfo URL of the ACME directory, None if the CA has no ARI or the directory can't be loaded
+        try:
+            response = requests.get(self.directory_url, timeout=RENEWAL_INFO_TIMEOUT)
+            response.raise_for_status()
+            renewal_info_url = response.json().get("renewalInfo")
+
+        except (requests.RequestException, ValueError, AttributeError) as e:
+            logger.warning(f"ACME directory {self.directory_url} couldn't be loaded, using renewal_threshold_days in this run: {str(e)}")
+            return None
+
+        if not renewal_info_url:
+            logger.info(f"ACME directory {self.directory_url} doesn't offer renewal information, using renewal_threshold_days")
+            return None
+
+        return renewal_info_url
+
+    def save(self) -> None:
+
+        # Windows are kept until they ended, so the planned time survives the fetches after the Retry-After
+        now = datetime.now(timezone.utc)
+        self.renewal_windows = {
+            certificate_id: renewal_window
+            for certificate_id, renewal_window in self.renewal_windows.items()
+            if max(datetime.fromisoformat(renewal_window.retry_at), datetime.fromisoformat(renewal_window.end)) > now
+        }
+
+        temporary_path = self.state_file.with_name(self.state_file.name + ".tmp")
+        temporary_path.write_text(json.dumps(
+            {certificate_id: asdict(renewal_window) for certificate_id, renewal_window in self.renewal_windows.items()},
+            indent=2,
+            sort_keys=True
+        ))
+        os.replace(temporary_path, self.state_file)
+
+def parse_retry_after(retry_after: Optional[str], now: datetime) -> float:
+
+    # Seconds or an HTTP date, kept within MINIMUM_RETRY_AFTER and MAXIMUM_RETRY_AFTER
+    if not retry_after:
+        return DEFAULT_RETRY_AFTER
+
+    try:
+        seconds = float(retry_after)
+    except ValueError:
+        try:
+            seconds = (parsedate_to_datetime(retry_after) - now).total_seconds()
+        except (TypeError, ValueError):
+            return DEFAULT_RETRY_AFTER
+
+    return min(MAXIMUM_RETRY_AFTER, max(MINIMUM_RETRY_AFTER, seconds))
+
+def open_renewal_info_cache(state_directory: Path, directory_url: str) -> RenewalInfoCache:
+    return RenewalInfoCache(state_directory / RENEWAL_INFO_FILE_NAME, directory_url)
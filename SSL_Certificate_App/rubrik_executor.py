@@ -2,9 +2,6 @@
 import logging
 import logging.config
 
-# Third party imports
-import requests
-
 # Local imports
 from certbot_utils import *
 from certificatemanager_abc import CertificateManager
@@ -16,6 +13,8 @@ logger = logging.getLogger("rubrik")
 ### Creating the RubrikCertificateManager object for managing the renewal of the SSL certificate ###
 
 class RubrikCertificateManager(CertificateManager):
+
+    key_type = "rsa"
     
      # Static method to return what the provider specific requirements are regarding needed parameters for the certificate renewal process
     @staticmethod
@@ -42,62 +41,72 @@ class RubrikCertificateManager(CertificateManager):
     def execute_test(self):
         logger.info(f"Rubrik instance parameters: Domain: {self.domain} and API_Token: {self.api_token} is provided.")
 
-    def execute_certificate_renewal(self):
+    def build_artifacts(self):
+        self.key_file = self.certificate_artifacts.key_pem.decode()
+        self.fullChain_file = self.certificate_artifacts.fullchain_pem.decode()
 
-        try:
-            # Get the SSL certificate from Let's Encrypt with Certbot
-            create_instance_certificate(domain=self.domain, key_type="rsa")
-            
-            # Open necessary files
-            key_path, fullChain_path = certificate_paths(domain=self.domain, requested_paths=["key_path", "fullChain_path"])
-            loaded_files = load_certificate_files("text", key_path=key_path, fullChain_path=fullChain_path)
+    def upload_certificate(self):
 
-            key_file = loaded_files.get("key_path")
-            fullChain_file = loaded_files.get("fullChain_path")
+        # Certificate IDs on the cluster before the upload, the new certificate is the one that wasn't there before
+        certificate_ids = self.get_certificate_ids()
 
-            # Get the old certificate ID
-            old_certificate_id = self.get_old_certificate_id()
-            logger.debug(f"Old certificate ID: {old_certificate_id}")
+        # Get the old certificate ID (known from the certificate inventory if a previous run deployed it)
+        self.old_certificate_id = self.get_old_certificate_id(certificate_ids)
+        logger.debug(f"Old certificate ID: {self.old_certificate_id}")
 
-            # Generate a certificate name
-            certificate_name = generate_certificate_name(domain=self.domain)
+        # Generate a certificate name
+        certificate_name = generate_certificate_name(domain=self.domain)
 
-            # Post the new certificate
-            self.post_new_certificate(certificate_name=certificate_name, key_file=key_file, fullChain_file=fullChain_file)
+        # Post the new certificate
+        self.post_new_certificate(certificate_name=certificate_name, key_file=self.key_file, fullChain_file=self.fullChain_file)
 
-            # Get the new certificate ID
-            new_certificate_id = self.compare_certificate_ids(old_certificate_id)
-            logger.debug(f"New certificate ID: {new_certificate_id}")
+        # Get the new certificate ID
+        self.deployed_certificate_id = self.compare_certificate_ids(certificate_ids)
+        logger.debug(f"New certificate ID: {self.deployed_certificate_id}")
 
-            # Change the cluster settings to exchange the old with the new certificate
-            self.change_cluster_certificate_settings(new_certificate_id)
+    def activate_certificate(self):
 
-            # Delete the old certificate
-            self.delete_old_certificate(old_certificate_id)
+        # Change the cluster settings to exchange the old with the new certificate
+        self.change_cluster_certificate_settings(self.deployed_certificate_id)
 
-        except Exception as e:
-            logger.error(f"Unexpected error happened for {self.domain}. Error message: {e}")
-            raise
+    def cleanup_old_certificate(self):
+
+        # Delete the old certificate
+        self.delete_old_certificate(self.old_certificate_id)
 
     ### Different tasks are handled by the below functions that are needed for the execute function ###
 
-    def get_old_certificate_id(self):
-        get_certificate_response = requests.get(url=self.url_certificate, headers=self.headers_api, verify=False)
+    def get_certificate_ids(self):
+        get_certificate_response = self.session.get(url=self.url_certificate, headers=self.headers_api)
         if get_certificate_response.status_code != 200:
             logger.error(f"Couldn't retrieve certificate information:\n{get_certificate_response.text}")
             raise
         
         try:
-            for field in get_certificate_response.json()["data"]:
-                old_certificate_id = field["certId"]
+            certificate_ids = [field["certId"] for field in get_certificate_response.json()["data"]]
 
         except KeyError:
-            logger.error(f"Old certificate ID couldn't be retrieved:\n{get_certificate_response.text}")
+            logger.error(f"Certificate IDs couldn't be retrieved:\n{get_certificate_response.text}")
             raise
 
-        logger.debug(f"Old certificate ID: {old_certificate_id}")
+        logger.debug(f"Certificate IDs: {certificate_ids}")
+
+        return certificate_ids
+
+    def get_old_certificate_id(self, certificate_ids):
+
+        # The ID from the certificate inventory is only used if the cluster still has the certificate,
+        # it can be gone after a manual change. Otherwise the last certificate of the listing is the old one.
+        if self.previous_certificate_id in certificate_ids:
+            return self.previous_certificate_id
+
+        if self.previous_certificate_id:
+            logger.warning(f"Certificate {self.previous_certificate_id} from the certificate inventory isn't on {self.domain} any more, looking up the old certificate")
 
-        return old_certificate_id
+        if not certificate_ids:
+            raise ValueError(f"No old certificate found on {self.domain}")
+
+        return certificate_ids[-1]
         
     def post_new_certificate(self, certificate_name, key_file, fullChain_file):
         payload = {
@@ -107,7 +116,7 @@ class RubrikCertificateManager(CertificateManager):
             "privateKey": key_file
         }
 
-        post_certificate_response = requests.post(url=self.url_certificate, headers=self.headers_api, json=payload, verify=False)
+        post_certificate_response = self.session.post(url=self.url_certificate, headers=self.headers_api, json=payload)
 
         if post_certificate_response.status_code != 200:
             logger.error(f"Couldn't post the certificate to {self.domain}. API response:\n{post_certificate_response.text}")
@@ -115,25 +124,17 @@ class RubrikCertificateManager(CertificateManager):
         
         logger.debug(f"Posting certificate was successful")
     
-    def compare_certificate_ids(self, old_certificate_id):   
-        get_certificate_response = requests.get(url=self.url_certificate, headers=self.headers_api, verify=False)
-        
-        if get_certificate_response.status_code != 200:
-            logger.error(f"Couldn't retrieve certificate informations:\n{get_certificate_response.text}")
-            raise
+    def compare_certificate_ids(self, previous_certificate_ids):
 
-        try:
-            for field in get_certificate_response.json()["data"]:
-                certificate_id_holder = field["certId"]
-            
-                if certificate_id_holder != old_certificate_id:
-                    new_certificate_id = field["certId"]
-                    logger.debug(f"New certificate ID is: {new_certificate_id}")
-                    return new_certificate_id
-                
-        except KeyError:
-            logger.error(f"New certificate ID couldn't be retrieved:\n{get_certificate_response.text}")
-            raise
+        # The new certificate is the only ID that wasn't listed before the upload
+        new_certificate_ids = [certificate_id for certificate_id in self.get_certificate_ids() if certificate_id not in previous_certificate_ids]
+
+        if len(new_certificate_ids) != 1:
+            logger.error(f"New certificate ID couldn't be identified, IDs added by the upload: {new_certificate_ids}")
+            raise ValueError(f"Expected one new certificate on {self.domain}, found {len(new_certificate_ids)}")
+
+        logger.debug(f"New certificate ID is: {new_certificate_ids[0]}")
+        return new_certificate_ids[0]
 
     
     def change_cluster_certificate_settings(self, new_certificate_id):
@@ -142,7 +143,7 @@ class RubrikCertificateManager(CertificateManager):
         }
 
         # Maybe needs to be done two times because of a bug with Rubrik (if you get an error here could be because of this)
-        change_cluster_settings_response = requests.put(url=self.url_cluster_settings, headers=self.headers_api, json=payload, verify=False)
+        change_cluster_settings_response = self.session.put(url=self.url_cluster_settings, headers=self.headers_api, json=payload)
 
         if change_cluster_settings_response.status_code != 202:
             logger.error(f"Couldn't change cluster settings:\n{change_cluster_settings_response.text}")
@@ -154,7 +155,7 @@ class RubrikCertificateManager(CertificateManager):
         url_delete = f"{self.url_certificate}/{old_certificate_id}"
         logger.debug(f"Delete url: {url_delete}")
 
-        delete_certificate_response = requests.delete(url=url_delete, headers=self.headers_api, verify=False)
+        delete_certificate_response = self.session.delete(url=url_delete, headers=self.headers_api)
 
         if delete_certificate_response.status_code != 204:
             logger.error(f"Couldn't delete the old certificate:\n{delete_certificate_response.text}")
@@ -0,0 +1,124 @@
+# Run from SSL_Certificate_App: python -m unittest discover -s tests
+
+# Standard library imports
+import os
+import socket
+import tempfile
+import threading
+import unittest
+
+# The modules load logging.ini, its file handler writes to LOG_OUTPUT_DIR
+os.environ.setdefault("LOG_OUTPUT_DIR", os.path.join(tempfile.gettempdir(), "certicopter_tests.log"))
+
+# Third party imports
+import dns.message
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+import dns.resolver
+import dns.rrset
+
+# Local imports
+import dns_utils
+from dns_utils import PROPAGATION_NO_NAMESERVERS, get_dns_zone, wait_for_txt_records
+
+### Local stub DNS server on UDP that answers from a fixed set of records ###
+
+class DnsStub:
+
+    def __init__(self):
+
+        # (name, record type) -> record values. A record listed in delayed_records is only served from its n-th query on.
+        self.records = {}
+        self.delayed_records = {}
+        self.rcode = dns.rcode.NOERROR
+        self.queries = []
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(("127.0.0.1", 0))
+        self.address, self.port = self.socket.getsockname()
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        while self.running:
+            try:
+                wire, client_address = self.socket.recvfrom(4096)
+            except OSError:
+                return
+
+            query = dns.message.from_wire(wire)
+            question = query.question[0]
+            record_key = (question.name.to_text(omit_final_dot=True), dns.rdatatype.to_text(question.rdtype))
+            self.queries.append(record_key)
+
+            response = dns.message.make_response(query)
+            response.set_rcode(self.rcode)
+            values = self.records.get(record_key)
+            if self.queries.count(record_key) < self.delayed_records.get(record_key, 0):
+                values = None
+
+            if self.rcode == dns.rcode.NOERROR:
+                if values:
+                    response.answer.append(dns.rrset.from_text_list(question.name, 60, dns.rdataclass.IN, question.rdtype, values))
+                else:
+                    response.set_rcode(dns.rcode.NXDOMAIN)
+
+            self.socket.sendto(response.to_wire(), client_address)
+
+    def close(self):
+        self.running = False
+        self.socket.close()
+
+class DnsUtilsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dns_stub = DnsStub()
+        self.default_resolver = dns.resolver.get_default_resolver()
+
+        # Recursive lookups (zones, nameservers) go to the stub as well
+        resolver = dns.resolver.Resolver(configure=False)
+        resolver.nameservers = [self.dns_stub.address]
+        resolver.port = self.dns_stub.port
+        dns.resolver.default_resolver = resolver
+        get_dns_zone.cache_clear()
+
+    def tearDown(self):
+        dns.resolver.default_resolver = self.default_resolver
+        get_dns_zone.cache_clear()
+        self.dns_stub.close()
+
+    def test_dns_zone(self):
+        self.dns_stub.records[("example.co.uk", "SOA")] = ["ns1.example.co.uk. hostmaster.example.co.uk. 1 3600 600 86400 60"]
+        self.assertEqual(get_dns_zone("host.eng.example.co.uk"), "example.co.uk")
+
+    def test_dns_zone_falls_back_to_the_registered_domain(self):
+        self.dns_stub.rcode = dns.rcode.SERVFAIL
+        self.assertEqual(get_dns_zone("host.eng.example.co.uk"), "example.co.uk")
+
+    def test_records_propagated(self):
+        record_name = "_acme-challenge.host.example.com"
+        self.dns_stub.records[(record_name, "TXT")] = ['"token"']
+        self.dns_stub.delayed_records[(record_name, "TXT")] = 2
+
+        latency = wait_for_txt_records("example.com", {record_name: {"token"}}, 10, [(self.dns_stub.address, self.dns_stub.port)])
+        self.assertIsNotNone(latency)
+        self.assertGreaterEqual(latency, dns_utils.PROPAGATION_INITIAL_INTERVAL)
+        self.assertEqual(self.dns_stub.queries.count((record_name, "TXT")), 2)
+
+    def test_records_timed_out(self):
+        record_name = "_acme-challenge.host.example.com"
+        self.dns_stub.records[(record_name, "TXT")] = ['"other"']
+
+        self.assertIsNone(wait_for_txt_records("example.com", {record_name: {"token"}}, 1, [(self.dns_stub.address, self.dns_stub.port)]))
+
+    def test_no_nameservers(self):
+
+        # The stub knows no NS records for the zone, there is nothing to poll
+        result = wait_for_txt_records("example.com", {"_acme-challenge.host.example.com": {"token"}}, 10)
+        self.assertEqual(result, PROPAGATION_NO_NAMESERVERS)
+        self.assertIn(("example.com", "NS"), self.dns_stub.queries)
+
+if __name__ == "__main__":
+    unittest.main()
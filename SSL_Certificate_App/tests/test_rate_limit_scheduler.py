@@ -0,0 +1,96 @@
+# Run from SSL_Certificate_App: python -m unittest discover -s tests
+
+# Standard library imports
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+# The modules load logging.ini, its file handler writes to LOG_OUTPUT_DIR
+os.environ.setdefault("LOG_OUTPUT_DIR", os.path.join(tempfile.gettempdir(), "certicopter_tests.log"))
+
+# Local imports
+from dns_utils import get_registered_domain
+from rate_limit_scheduler import CERTIFICATES_PER_REGISTERED_DOMAIN, DUPLICATE_CERTIFICATES_PER_NAME_SET, IssuanceRequest, open_rate_limit_scheduler
+
+class RateLimitSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.state_directory = tempfile.TemporaryDirectory()
+        self.state_path = Path(self.state_directory.name)
+
+    def tearDown(self):
+        self.state_directory.cleanup()
+
+    def test_registered_domain(self):
+        self.assertEqual(get_registered_domain("host.eng.example.co.uk"), "example.co.uk")
+        self.assertEqual(get_registered_domain("Host.Example.com."), "example.com")
+        self.assertEqual(get_registered_domain("co.uk"), "co.uk")
+
+    def test_delegated_zones_share_the_registered_domain_bucket(self):
+
+        # Half of the certificates in each of two delegated zones, one more than the CA allows for example.co.uk
+        capacity = CERTIFICATES_PER_REGISTERED_DOMAIN[0]
+        issuance_requests = [
+            IssuanceRequest(domain=domain, key_type="rsa", registered_domain=get_registered_domain(domain), remaining_days=index)
+            for index, domain in enumerate(f"host{number}.{zone}.example.co.uk" for number in range(capacity // 2 + 1) for zone in ("eng", "ops"))
+        ]
+
+        rate_limit_scheduler = open_rate_limit_scheduler(self.state_path, "stub")
+        admitted_requests, deferred_requests = rate_limit_scheduler.schedule(issuance_requests)
+        self.assertEqual(len(admitted_requests), capacity)
+        self.assertEqual(set(deferred_requests), {(request.domain, request.key_type) for request in issuance_requests[capacity:]})
+
+        for request in admitted_requests:
+            rate_limit_scheduler.record_order(request.domain, request.key_type, issued=True)
+
+        # The next run knows the bucket is empty
+        admitted_requests, _ = open_rate_limit_scheduler(self.state_path, "stub").schedule(issuance_requests[:1])
+        self.assertEqual(admitted_requests, [])
+
+    def test_tokens_are_only_used_by_orders(self):
+        issuance_request = IssuanceRequest("host.example.com", "rsa", "example.com")
+        capacity = DUPLICATE_CERTIFICATES_PER_NAME_SET[0]
+
+        # Admitted in every run, but no order was ever created
+        for _ in range(capacity + 1):
+            admitted_requests, _ = open_rate_limit_scheduler(self.state_path, "stub").schedule([issuance_request])
+            self.assertEqual(admitted_requests, [issuance_request])
+
+        # An order that failed validation uses up a new order, but no certificate
+        rate_limit_scheduler = open_rate_limit_scheduler(self.state_path, "stub")
+        rate_limit_scheduler.schedule([issuance_request])
+        rate_limit_scheduler.record_order("host.example.com", "rsa", issued=False)
+        self.assertEqual(rate_limit_scheduler.get_bucket("duplicate_certificate", "host.example.com", 0).tokens, capacity)
+
+    def test_renewals_only_count_as_duplicates(self):
+        capacity = DUPLICATE_CERTIFICATES_PER_NAME_SET[0]
+        issuance_requests = [IssuanceRequest("host.example.com", key_type, "example.com", renewal=True) for key_type in ("rsa", "ecdsa")]
+
+        for _ in range(capacity // 2):
+            rate_limit_scheduler = open_rate_limit_scheduler(self.state_path, "stub")
+            admitted_requests, _ = rate_limit_scheduler.schedule(issuance_requests)
+            for request in admitted_requests:
+                rate_limit_scheduler.record_order(request.domain, request.key_type, issued=True)
+
+        # Both key types share the name set, only one more certificate is left for it. The registered domain wasn't charged.
+        rate_limit_scheduler = open_rate_limit_scheduler(self.state_path, "stub")
+        admitted_requests, deferred_requests = rate_limit_scheduler.schedule(issuance_requests)
+        self.assertEqual(len(admitted_requests), 1)
+        self.assertIn("duplicate certificates for host.example.com", next(iter(deferred_requests.values())))
+        self.assertNotIn("registered_domain|stub|example.com", rate_limit_scheduler.buckets)
+
+    def test_rate_limit_reported_by_the_ca_empties_the_bucket(self):
+        rate_limit_scheduler = open_rate_limit_scheduler(self.state_path, "stub")
+        rate_limit_scheduler.record_failure(
+            "host.eng.example.co.uk",
+            get_registered_domain("host.eng.example.co.uk"),
+            "order",
+            "urn:ietf:params:acme:error:rateLimited :: too many certificates already issued for \"example.co.uk\""
+        )
+
+        admitted_requests, _ = rate_limit_scheduler.schedule([IssuanceRequest("host.ops.example.co.uk", "rsa", get_registered_domain("host.ops.example.co.uk"))])
+        self.assertEqual(admitted_requests, [])
+
+if __name__ == "__main__":
+    unittest.main()
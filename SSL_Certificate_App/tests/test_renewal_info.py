@@ -0,0 +1,140 @@
+# Run from SSL_Certificate_App: python -m unittest discover -s tests
+
+# Standard library imports
+import json
+import os
+import tempfile
+import threading
+import unittest
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+# The modules load logging.ini, its file handler writes to LOG_OUTPUT_DIR
+os.environ.setdefault("LOG_OUTPUT_DIR", os.path.join(tempfile.gettempdir(), "certicopter_tests.log"))
+
+# Third party imports
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+# Local imports
+from renewal_info import certificate_identifier, open_renewal_info_cache
+
+### Local ACME stub that serves the directory and the renewalInfo resource ###
+
+class AcmeStub:
+
+    def __init__(self):
+        self.window_start = datetime.now(timezone.utc) + timedelta(days=50)
+        self.window_end = self.window_start + timedelta(days=5)
+        self.directory_status = 200
+        self.requests = {"directory": 0, "renewal_info": 0}
+        self.requested_ids = []
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path == "/directory":
+                    stub.requests["directory"] += 1
+                    self.send_json(stub.directory_status, {"newOrder": f"{stub.url}/order", "renewalInfo": f"{stub.url}/ari"})
+                elif self.path.startswith("/ari/"):
+                    stub.requests["renewal_info"] += 1
+                    stub.requested_ids.append(self.path[len("/ari/"):])
+                    self.send_json(200, {"suggestedWindow": {
+                        "start": stub.window_start.isoformat().replace("+00:00", "Z"),
+                        "end": stub.window_end.isoformat().replace("+00:00", "Z")
+                    }}, {"Retry-After": "21600"})
+                else:
+                    self.send_json(404, {})
+
+            def send_json(self, status, body, headers=None):
+                content = json.dumps(body).encode()
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def create_certificate(serial_number: int) -> bytes:
+
+    # Certificate signed by a throwaway CA, with the authority key identifier the ARI certificate ID is built from
+    ca_key = ec.generate_private_key(ec.SECP256R1())
+    key = ec.generate_private_key(ec.SECP256R1())
+    now = datetime.now(timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "host.example.com")]))
+        .issuer_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "Stub CA")]))
+        .public_key(key.public_key())
+        .serial_number(serial_number)
+        .not_valid_before(now)
+        .not_valid_after(now + timedelta(days=90))
+        .add_extension(x509.AuthorityKeyIdentifier(b"\x01\x02\x03", None, None), critical=False)
+        .sign(ca_key, hashes.SHA256())
+    )
+    return certificate.public_bytes(encoding=serialization.Encoding.PEM)
+
+class RenewalInfoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.acme_stub = AcmeStub()
+        self.state_directory = tempfile.TemporaryDirectory()
+        self.state_path = Path(self.state_directory.name)
+
+    def tearDown(self):
+        self.acme_stub.close()
+        self.state_directory.cleanup()
+
+    def test_certificate_identifier(self):
+
+        # Serial 0x87 needs a leading zero byte to stay a positive DER integer (RFC 9773 example encoding)
+        self.assertEqual(certificate_identifier(create_certificate(0x87)), "AQID.AIc")
+
+    def test_window_is_cached_until_retry_after(self):
+        certificate_id = certificate_identifier(create_certificate(0x1234))
+
+        renewal_windows = open_renewal_info_cache(self.state_path, f"{self.acme_stub.url}/directory").get_renewal_windows({certificate_id: "host.example.com"}, 4)
+        self.assertEqual(self.acme_stub.requested_ids, [certificate_id])
+        renewal_window = renewal_windows[certificate_id]
+        self.assertFalse(renewal_window.renewal_is_due())
+        self.assertTrue(self.acme_stub.window_start <= datetime.fromisoformat(renewal_window.renew_at) <= self.acme_stub.window_end)
+
+        # A later run reads the window from the state directory and doesn't ask the CA again
+        cached_windows = open_renewal_info_cache(self.state_path, f"{self.acme_stub.url}/directory").get_renewal_windows({certificate_id: "host.example.com"}, 4)
+        self.assertEqual(cached_windows[certificate_id], renewal_window)
+        self.assertEqual(self.acme_stub.requests, {"directory": 1, "renewal_info": 1})
+
+    def test_window_moved_forward_is_due(self):
+        self.acme_stub.window_start = datetime.now(timezone.utc) - timedelta(days=2)
+        self.acme_stub.window_end = datetime.now(timezone.utc) - timedelta(days=1)
+        certificate_id = certificate_identifier(create_certificate(0x1234))
+
+        renewal_windows = open_renewal_info_cache(self.state_path, f"{self.acme_stub.url}/directory").get_renewal_windows({certificate_id: "host.example.com"}, 4)
+        self.assertTrue(renewal_windows[certificate_id].renewal_is_due())
+
+    def test_unavailable_directory_is_loaded_once(self):
+        self.acme_stub.directory_status = 503
+        certificate_domains = {certificate_identifier(create_certificate(serial_number)): f"host{serial_number}.example.com" for serial_number in range(1, 6)}
+
+        renewal_windows = open_renewal_info_cache(self.state_path, f"{self.acme_stub.url}/directory").get_renewal_windows(certificate_domains, 4)
+        self.assertEqual(renewal_windows, {})
+        self.assertEqual(self.acme_stub.requests, {"directory": 1, "renewal_info": 0})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+# Standard library imports
+import json
+import logging
+import logging.config
+import os
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict
+
+# Third party imports
+import requests
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import serialization
+
+# Load logging configuration
+logging.config.fileConfig("logging.ini")
+logger = logging.getLogger("trust_anchor")
+
+# Constants
+ROOT_CERTIFICATE_URL = "https://letsencrypt.org/certs/isrgrootx1.pem"
+BUNDLED_ROOT_CERTIFICATE_PATH = Path(__file__).resolve().parent / "isrgrootx1.pem"
+CACHED_ROOT_CERTIFICATE_NAME = "isrgrootx1.pem"
+CACHE_METADATA_NAME = "isrgrootx1.json"
+REFRESH_TIMEOUT = 10
+REFRESH_RETRY_SECONDS = 86400
+
+### Let's Encrypt root certificate, bundled with the application and refreshed in the state directory ###
+
+class TrustAnchorCache:
+
+    # The root certificate changes once in many years. A copy is shipped with the application, the cached copy in the
+    # state directory is only checked against letsencrypt.org when the last check is older than the refresh interval,
+    # with a conditional request (ETag / Last-Modified) that transfers nothing if it didn't change.
+    # Any failure of the refresh keeps the certificate that is already there, so air-gapped runs work with the bundled copy.
+    def __init__(self, state_directory: Path, refresh_days: int, url: str = ROOT_CERTIFICATE_URL):
+        self.certificate_path = state_directory / CACHED_ROOT_CERTIFICATE_NAME
+        self.metadata_path = state_directory / CACHE_METADATA_NAME
+        self.refresh_days = refresh_days
+        self.url = url
+
+    def get_root_certificate(self) -> bytes:
+        if self.refresh_is_due():
+            self.refresh()
+
+        if self.certificate_path.exists():
+            return self.certificate_path.read_bytes()
+
+        logger.debug(f"Using the bundled root certificate {BUNDLED_ROOT_CERTIFICATE_PATH}")
+        return BUNDLED_ROOT_CERTIFICATE_PATH.read_bytes()
+
+    def refresh_is_due(self) -> bool:
+
+        # A refresh_days of 0 turns the refresh off. A failed refresh is retried a day later, not on every run.
+        if self.refresh_days < 1:
+            return False
+
+        metadata = self.load_metadata()
+        if time.time() - metadata.get("failed_at", 0) < REFRESH_RETRY_SECONDS:
+            return False
+
+        return time.time() - metadata.get("checked_at", 0) > self.refresh_days * 86400
+
+    def refresh(self) -> None:
+        metadata = self.load_metadata()
+
+        headers = {}
+        if self.certificate_path.exists():
+            if metadata.get("etag"):
+                headers["If-None-Match"] = metadata["etag"]
+            if metadata.get("last_modified"):
+                headers["If-Modified-Since"] = metadata["last_modified"]
+
+        try:
+            response = requests.get(self.url, headers=headers, timeout=REFRESH_TIMEOUT)
+
+            if response.status_code == 304:
+                logger.debug("Root certificate didn't change")
+
+            elif response.status_code == 200:
+                validate_root_certificate(response.content)
+                write_file(self.certificate_path, response.content)
+                metadata["etag"] = response.headers.get("ETag")
+                metadata["last_modified"] = response.headers.get("Last-Modified")
+                logger.info(f"Root certificate was refreshed from {self.url}")
+
+            else:
+                raise ValueError(f"{self.url} returned {response.status_code}")
+
+            metadata["checked_at"] = time.time()
+            metadata.pop("failed_at", None)
+
+        except (requests.RequestException, ValueError) as e:
+            logger.warning(f"Root certificate couldn't be refreshed, using the {'cached' if self.certificate_path.exists() else 'bundled'} copy: {str(e)}")
+            metadata["failed_at"] = time.time()
+
+        write_file(self.metadata_path, json.dumps(metadata).encode())
+
+    def load_metadata(self) -> Dict[str, Any]:
+        try:
+            return json.loads(self.metadata_path.read_text())
+        except (FileNotFoundError, ValueError):
+            return {}
+
+def validate_root_certificate(certificate_pem: bytes) -> None:
+
+    # Only a valid CA certificate with the subject and the key of the bundled root, signed by that key, replaces the cached copy.
+    # A reissued root keeps its key, anything with another key is not the root the application trusts.
+    certificate = x509.load_pem_x509_certificate(certificate_pem)
+    bundled_certificate = x509.load_pem_x509_certificate(BUNDLED_ROOT_CERTIFICATE_PATH.read_bytes())
+
+    if certificate.subject != bundled_certificate.subject or certificate.issuer != certificate.subject:
+        raise ValueError(f"Downloaded certificate is not the root certificate: {certificate.subject.rfc4514_string()}")
+
+    if public_key_bytes(certificate) != public_key_bytes(bundled_certificate):
+        raise ValueError("Downloaded root certificate doesn't have the key of the bundled root certificate")
+
+    try:
+        certificate.verify_directly_issued_by(bundled_certificate)
+    except InvalidSignature:
+        raise ValueError("Signature of the downloaded root certificate doesn't match the key of the bundled root certificate")
+
+    try:
+        basic_constraints = certificate.extensions.get_extension_for_class(x509.BasicConstraints).value
+    except x509.ExtensionNotFound:
+        raise ValueError("Downloaded certificate has no basic constraints")
+    if not basic_constraints.ca:
+        raise ValueError("Downloaded certificate is not a CA certificate")
+
+    if certificate.not_valid_after_utc <= datetime.now(timezone.utc):
+        raise ValueError(f"Downloaded root certificate expired on {certificate.not_valid_after_utc}")
+
+def public_key_bytes(certificate: x509.Certificate) -> bytes:
+    return certificate.public_key().public_bytes(serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo)
+
+def write_file(file_path: Path, content: bytes) -> None:
+    temporary_path = file_path.with_name(file_path.name + ".tmp")
+    temporary_path.write_bytes(content)
+    os.replace(temporary_path, file_path)
+
+def get_root_certificate(state_directory: Path, refresh_days: int) -> bytes:
+    return TrustAnchorCache(state_directory, refresh_days).get_root_certificate()
@@ -2,11 +2,14 @@
 import re
 import logging
 import logging.config
+from base64 import b64encode
+from dataclasses import dataclass
 from datetime import datetime
+from typing import List
 
 # Third party imports
-import requests
 from requests.auth import HTTPBasicAuth
+from requests.exceptions import RequestException
 from bs4 import BeautifulSoup
 
 # Local imports
@@ -17,19 +20,39 @@ from certificatemanager_abc import CertificateManager
 logging.config.fileConfig("logging.ini")
 logger = logging.getLogger("vamax")
 
+# Constants
+CERTIFICATE_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+### One certificate stored on the loadbalancer ###
+
+@dataclass
+class VAMaxCertificate:
+    name: str
+    domain: str
+    issued_at: datetime
+
 ### Creating the VAMaxCertificateManager object for managing the renewal of the SSL certificate ###
 
 class VAMaxCertificateManager(CertificateManager):
 
+    management_port = 9443
+    key_type = "ecdsa"
+
     # Static method to return what the provider specific requirements are regarding needed parameters for the certificate renewal process
     @staticmethod
     def get_required_parameters():
         return ["domain", "username", "password"]
 
-    def __init__(self, domain, username, password):
+    # With an API token the certificates are listed with one call to the v2 API instead of one call per certificate
+    @staticmethod
+    def get_optional_parameters():
+        return ["api_token"]
+
+    def __init__(self, domain, username, password, api_token=None):
         self.domain = domain
         self.username = username
         self.password = password
+        self.api_token = api_token
         self.secure_url = f"https://{self.domain}:9443"
         logger.debug(f"Connection url: {self.secure_url}")
         self.url_get = f"{self.secure_url}/lbadmin/ajax/get_ssl.php"
@@ -39,63 +62,65 @@ class VAMaxCertificateManager(CertificateManager):
         self.url_security_category = f"{self.secure_url}/lbadmin/config/secure.php"
         logger.debug(f"Change settings url: {self.url_security_category}")
 
-        # If you want to use the VAMax API then initialize the following variables
-        #self.api_token = os.environ.get(api_token_env_var)
-        #self.api_token_encoded = b64encode(self.api_token.encode())
-        #self.data = '{"lbcli":[{"action":"termination","function":"list", "type":"certificate"}]}'
-        #self.url_api = f"{self.secure_url}/api/v2/"
-        #self.headers_get = {
-        #    "X-LB-APIKEY": self.api_token_encoded,
-        #    "Content-Type": "application/json"
-        #}
-        #self.headers_post = {
-        #    "X-LB-APIKEY": self.api_token_encoded,
-        #    "Content-Type": "multipart/form-data"
-        #}
+        # The v2 API is only used if an API token is configured for the instance
+        self.url_api = f"{self.secure_url}/api/v2/"
+        logger.debug(f"API url: {self.url_api}")
+        if self.api_token:
+            self.headers_api = {
+                "X-LB-APIKEY": b64encode(self.api_token.encode()).decode(),
+                "Content-Type": "application/json"
+            }
 
     ### Logic how to renew a certificate for Nutanix instances ###
     def execute_test(self):
         logger.info(f"VAMax instance parameters: Domain: {self.domain}, User: {self.username} and Password: {self.password} is provided.")
 
-    def execute_certificate_renewal(self):
+    def build_artifacts(self):
 
-        try:            
-            # Get the SSL certificate from Let's Encrypt with Certbot
-            create_instance_certificate(domain=self.domain, key_type="ecdsa")
+        # Concatenate the different certificates to match the requirements of VAMax
+        self.vamax_file = self.certificate_artifacts.vamax_bundle()
+        self.certificate_artifacts.save(vamax_path=self.vamax_file)
 
-            # Get the required paths
-            key_path, cert_path, caChain_path, vamax_path = certificate_paths(domain=self.domain, requested_paths=["key_path", "cert_path", "caChain_path", "vamax_path"])
+    def upload_certificate(self):
 
-            # Concatenate the different certificates to match the requirements of VAMax
-            concat_certificates_vamax(key_path=key_path, cert_path=cert_path, caChain_path=caChain_path, vamax_path=vamax_path)
+        # Generate a certificate name
+        new_certificate_name = generate_certificate_name(domain=self.domain)
 
-            # Load all files to open their content
-            loaded_files = load_certificate_files(read_mode="binary", vamax_path=vamax_path)
-            vamax_file = loaded_files.get("vamax_path")
+        ## Get certificate information if needed
+        ##cert_info = self.get_certificate_information()
+        ##logger.debug(f"Certificate information: {cert_info}")
 
-            # Generate a certificate name
-            new_certificate_name = generate_certificate_name(domain=self.domain)
+        # Post the new certificate
+        self.post_new_certificate(vamax_file=self.vamax_file, new_certificate_name=new_certificate_name)
+        self.deployed_certificate_id = new_certificate_name
 
-            ## Get certificate information if needed
-            ##cert_info = self.get_certificate_information()
-            ##logger.debug(f"Certificate information: {cert_info}")
+    def activate_certificate(self):
 
-            # Post the new certificate
-            self.post_new_certificate(vamax_file=vamax_file, new_certificate_name=new_certificate_name)
+        # Exchange the old with the new certificate
+        self.exchange_old_with_new_certificate(self.deployed_certificate_id)
 
-            # Exchange the old with the new certificate
-            self.exchange_old_with_new_certificate(new_certificate_name)
-            
-            # Filter the certificate to find out which one is the older one
-            earliest_certificate_iteration_tag = self.get_earliest_certificate_tag()
-            earliest_certificate_name = self.get_earliest_certificate_name(earliest_certificate_iteration_tag)
+    def cleanup_old_certificate(self):
 
-            # Delete the old certificate
-            self.delete_old_certificate(earliest_certificate_name=earliest_certificate_name, earliest_certificate_iteration_tag=earliest_certificate_iteration_tag)
+        # With an API token the certificates are listed with one API call and the oldest one is removed by its name,
+        # the web interface is scanned certificate by certificate if no API token is configured or the listing fails
+        if self.api_token:
+            try:
+                certificates = self.list_certificates_with_api()
 
-        except Exception as e:
-            logger.error(f"Unexpected error happened for {self.domain}. Error message: {e}")
-            raise   
+            except (RequestException, ValueError) as e:
+                logger.warning(f"Couldn't list the certificates of {self.domain} with the API, scanning the web interface instead: {e}")
+
+            else:
+                earliest_certificate = self.select_earliest_certificate(certificates)
+                self.delete_certificate_with_api(earliest_certificate.name)
+                return
+
+        # Filter the certificate to find out which one is the older one
+        earliest_certificate_iteration_tag = self.get_earliest_certificate_tag()
+        earliest_certificate_name = self.get_earliest_certificate_name(earliest_certificate_iteration_tag)
+
+        # Delete the old certificate
+        self.delete_old_certificate(earliest_certificate_name=earliest_certificate_name, earliest_certificate_iteration_tag=earliest_certificate_iteration_tag)
 
     ### Different tasks are handled by the below functions that are needed for the execute function ###
 
@@ -111,7 +136,7 @@ class VAMaxCertificateManager(CertificateManager):
             "ssl_upload_file": vamax_file
         }
 
-        post_certificate_response = requests.post(url=self.url_ssl_category, params=params, files=files, auth=HTTPBasicAuth(self.username, self.password), verify=False)
+        post_certificate_response = self.session.post(url=self.url_ssl_category, params=params, files=files, auth=HTTPBasicAuth(self.username, self.password))
 
         parsed_response = BeautifulSoup(post_certificate_response.text, "html.parser")
 
@@ -135,7 +160,7 @@ class VAMaxCertificateManager(CertificateManager):
              "go":"Update"
         }
 
-        exchange_certificate_response = requests.post(url=self.url_security_category, params=params, auth=HTTPBasicAuth(self.username, self.password), verify=False)
+        exchange_certificate_response = self.session.post(url=self.url_security_category, params=params, auth=HTTPBasicAuth(self.username, self.password))
         
         parsed_response = BeautifulSoup(exchange_certificate_response.text, "html.parser")
 
@@ -148,6 +173,61 @@ class VAMaxCertificateManager(CertificateManager):
             logger.error(f"Couldn't change old with new certificate")
             raise
 
+    def run_lbcli_command(self, command: dict) -> dict:
+        payload = {
+            "lbcli": [command]
+        }
+
+        lbcli_response = self.session.post(url=self.url_api, headers=self.headers_api, json=payload, auth=HTTPBasicAuth(self.username, self.password), idempotent=command["function"] == "list")
+        lbcli_response.raise_for_status()
+
+        # The API answers one result per command: {"lbcli": [{"action": ..., "function": ..., "type": ..., "status": "success", ...}]}
+        response_content = lbcli_response.json()
+        lbcli_results = response_content.get("lbcli") if isinstance(response_content, dict) else None
+        if not isinstance(lbcli_results, list) or len(lbcli_results) != 1 or not isinstance(lbcli_results[0], dict):
+            raise ValueError(f"Unexpected lbcli response to {command['function']}: {lbcli_response.text}")
+
+        lbcli_result = lbcli_results[0]
+        if lbcli_result.get("status") != "success":
+            raise ValueError(f"lbcli {command['function']} failed: {lbcli_result.get('error', lbcli_response.text)}")
+
+        return lbcli_result
+
+    def list_certificates_with_api(self) -> List[VAMaxCertificate]:
+        lbcli_result = self.run_lbcli_command({"action": "termination", "function": "list", "type": "certificate"})
+
+        # The result lists the certificates with the same fields as the web interface: {"certificates": [{"name": ..., "domain": ..., "from": ...}]}
+        certificate_entries = lbcli_result.get("certificates")
+        if not isinstance(certificate_entries, list):
+            raise ValueError(f"lbcli list result doesn't contain a certificate list: {lbcli_result}")
+
+        certificates = []
+        for entry in certificate_entries:
+            if not isinstance(entry, dict) or not all(isinstance(entry.get(field), str) for field in ("name", "domain", "from")):
+                raise ValueError(f"Unexpected certificate in the lbcli list result: {entry}")
+
+            certificates.append(VAMaxCertificate(
+                name=entry["name"],
+                domain=entry["domain"],
+                issued_at=parse_certificate_date(entry["from"])
+            ))
+        logger.debug(f"The API listed {len(certificates)} certificates")
+
+        return certificates
+
+    def select_earliest_certificate(self, certificates: List[VAMaxCertificate]) -> VAMaxCertificate:
+        domain_certificates = [certificate for certificate in certificates if certificate.domain == self.domain]
+
+        if not domain_certificates:
+            logger.error(f"No certificates found for domain '{self.domain}'")
+            raise ValueError(f"No certificates found for domain '{self.domain}'")
+
+        earliest_certificate = min(domain_certificates, key=lambda certificate: certificate.issued_at)
+        logger.debug(f"Issuance date of oldest certificate: {earliest_certificate.issued_at}")
+        logger.debug(f"The old certificate name is: {earliest_certificate.name}")
+
+        return earliest_certificate
+
     def get_earliest_certificate_tag(self):
 
         # Initialize the date and iteration tag of the older certificate
@@ -165,7 +245,7 @@ class VAMaxCertificateManager(CertificateManager):
             }
 
             # Get the certificate information of the certificate with the current iteration tag
-            certificate_response_text = requests.get(url=self.url_get, params=params, auth=HTTPBasicAuth(self.username, self.password), verify=False).text
+            certificate_response_text = self.session.get(url=self.url_get, params=params, auth=HTTPBasicAuth(self.username, self.password)).text
 
             # Check if the certificate with the current iteration tag exists
             if f"<label>The SSL Certificate can not be found.</label>" in certificate_response_text:
@@ -176,7 +256,7 @@ class VAMaxCertificateManager(CertificateManager):
 
                 # Extract the date when the certificate was issued from the "from" tag
                 current_certificate_date = certificate_response_text.split("<from>")[1].split("</from>")[0]
-                date_of_issunace = datetime.strptime(current_certificate_date, "%Y-%m-%d %H:%M:%S")
+                date_of_issunace = datetime.strptime(current_certificate_date, CERTIFICATE_DATE_FORMAT)
 
                 # Check if there already exists an earliest_date or if the date safed in the variable is newer or older
                 if earliest_date is None or date_of_issunace < earliest_date:
@@ -202,7 +282,7 @@ class VAMaxCertificateManager(CertificateManager):
             }
 
             # Get the informations from the older certificate
-            old_certificate_response = requests.get(url=self.url_get, params=params, auth=HTTPBasicAuth(self.username, self.password), verify=False)
+            old_certificate_response = self.session.get(url=self.url_get, params=params, auth=HTTPBasicAuth(self.username, self.password))
 
             # Using the "re.search" function to look for a specific pattern in the certificate response text
             # The pattern is designed to extract a certificate name from the URL-like string in "old_certificate_response.text"
@@ -232,7 +312,7 @@ class VAMaxCertificateManager(CertificateManager):
             f"cert_name[{earliest_certificate_iteration_tag}]": earliest_certificate_name
         }
 
-        requests.post(url=self.url_ssl_category, params=params, auth=HTTPBasicAuth(self.username, self.password), verify=False)
+        self.session.post(url=self.url_ssl_category, params=params, auth=HTTPBasicAuth(self.username, self.password))
         
         params = {
              "action":"remove_confirm",
@@ -241,11 +321,19 @@ class VAMaxCertificateManager(CertificateManager):
         }
 
         # Confirm to remove the old certificate
-        requests.post(url=self.url_ssl_category, params=params, auth=HTTPBasicAuth(self.username, self.password), verify=False)
+        self.session.post(url=self.url_ssl_category, params=params, auth=HTTPBasicAuth(self.username, self.password))
+
+    def delete_certificate_with_api(self, certificate_name):
 
-    ### Implement this function if you want to work with the VAMax API ###
-    #def get_certificate_information(self):
-    #   response = requests.post(url=self.url_api, headers=self.headers_get, data=self.data, auth=HTTPBasicAuth(self.username, self.username), verify=False)
-    #   return json.loads(response.text)
+        # A failed removal isn't retried through the web interface, the oldest certificate might already be gone
+        self.run_lbcli_command({"action": "termination", "function": "delete", "type": "certificate", "name": certificate_name})
+        logger.debug(f"Removed certificate {certificate_name} with the API")
 
+def parse_certificate_date(certificate_date: str) -> datetime:
 
+    # The web interface shows "2024-01-31 12:00:00", the API may return the same or an ISO 8601 timestamp.
+    # Anything else raises ValueError and the web interface is scanned instead.
+    try:
+        return datetime.strptime(certificate_date, CERTIFICATE_DATE_FORMAT)
+    except ValueError:
+        return datetime.fromisoformat(certificate_date.replace("Z", "+00:00")).replace(tzinfo=None)
@@ -3,9 +3,6 @@ import base64
 import logging
 import logging.config
 
-# Third party imports
-import requests
-
 # Local imports
 from certbot_utils import *
 from certificatemanager_abc import CertificateManager
@@ -18,6 +15,8 @@ logger = logging.getLogger("vsphere")
 
 class VSphereCertificateManager(CertificateManager):
 
+    key_type = "rsa"
+
      # Static method to return what the provider specific requirements are regarding needed parameters for the certificate renewal process
     @staticmethod
     def get_required_parameters():
@@ -45,39 +44,40 @@ class VSphereCertificateManager(CertificateManager):
     def execute_test(self):
         logger.info(f"VSphere instance parameters: Domain: {self.domain}, User: {self.username} and Password: {self.password} is provided.")
 
-    def execute_certificate_renewal(self):
+    def build_artifacts(self):
 
-        try:
-            # Get the SSL certificate from Let's Encrypt with Certbot
-            create_instance_certificate(self.domain, key_type="rsa")
+        # Concatenate the different certificates to match the requirements of VSphere
+        vsphere_bundle = self.certificate_artifacts.vsphere_bundle()
+        root_chain = self.certificate_artifacts.root_chain()
+        self.certificate_artifacts.save(vsphereSSL_path=vsphere_bundle, rootChain_path=root_chain)
+        self.key_file = self.certificate_artifacts.key_pem.decode()
+        self.root_file = root_chain.decode()
+        self.vsphereSSL_file = vsphere_bundle.decode()
 
-            # Get the required paths
-            key_path, cert_path, caChain_path, rootChain_path, vsphereSSL_path = certificate_paths(domain=self.domain, requested_paths=["key_path", "cert_path", "caChain_path", "rootChain_path", "vsphereSSL_path"])
+    def upload_certificate(self):
 
-            # Concatenate the different certificates to match the requirements of VSphere
-            concat_certificates_vsphere(cert_path=cert_path, caChain_path=caChain_path, rootChain_path=rootChain_path, vsphereSSL_path=vsphereSSL_path)
+        # Get the current session ID of the VSphere instance
+        session_id = self.get_vmware_session_id()
 
-            # Load all files to open their content
-            loaded_files = load_certificate_files(read_mode="text", key_path=key_path, rootChain_path=rootChain_path, vsphereSSL_path=vsphereSSL_path)
-            key_file = loaded_files.get("key_path")
-            root_file = loaded_files.get("rootChain_path")
-            vsphereSSL_file = loaded_files.get("vsphereSSL_path")
+        # Post the new certificate
+        self.post_new_certificate(session_id=session_id, key_file=self.key_file, root_file=self.root_file, vsphereSSL_file=self.vsphereSSL_file)
 
-            # Get the current session ID of the VSphere instance
-            session_id = self.get_vmware_session_id()
+    def activate_certificate(self):
 
-            # Post the new certificate
-            self.post_new_certificate(session_id=session_id, key_file=key_file, root_file=root_file, vsphereSSL_file=vsphereSSL_file)
+        # vCenter replaces its TLS certificate with the uploaded one and restarts its services on its own
+        pass
 
-        except Exception as e:
-            logger.error(f"Unexpected error happened for {self.domain}. Error message: {e}")
-            raise
+    def cleanup_old_certificate(self):
+
+        # The upload replaces the old certificate, there is nothing left to delete
+        pass
 
     ### Different tasks are handled by the below functions that are needed for the execute function ###
     
     def get_vmware_session_id(self):
         try:
-            get_session_id_response = requests.post(url=self.session_url, headers=self.headers_get, verify=False)
+            # Creating a session changes nothing on the instance, it is retried like a GET
+            get_session_id_response = self.session.post(url=self.session_url, headers=self.headers_get, idempotent=True)
 
             if get_session_id_response.status_code == 201:
                 # Strip any leading or trailing single ('') or double ("") quotes from the session ID
@@ -101,7 +101,7 @@ class VSphereCertificateManager(CertificateManager):
             "root_cert": root_file,
         }
 
-        post_certificate_response = requests.put(url=self.post_url, json=files, headers=headers_post, verify=False)
+        post_certificate_response = self.session.put(url=self.post_url, json=files, headers=headers_post)
 
         if post_certificate_response.status_code != 204:
             logger.error(f"Couldn't post the certificate to {self.domain}. API response:\n{post_certificate_response.text}")
@@ -6,7 +6,7 @@
 readonly ENV_TEMPLATE_FILE="env_template.env"
 readonly CONFIG_FILE="SSL_Certificate_App/config.json"
 readonly HOSTING_PROVIDERS=("AWS (Route 53)" "DigitalOcean" "Cloudflare" "DNSimple" "DNS Made Easy" "Gehirn" "Google Cloud" "Linode" "LuadDNS" "IBM NS1" "OVH" "Sakura Cloud")
-readonly PROVIDERS=("nutanix" "rubrik" "hycu" "paloalto" "vsphere" "vamax")
+readonly PROVIDERS=("nutanix" "rubrik" "hycu" "paloalto" "panorama" "vsphere" "vamax")
 
 # =============================================
 # Functions
@@ -224,6 +224,17 @@ EOF
 $(echo "$provider" | tr '[:lower:]' '[:upper:]')_SYSTEM_${system_num}_DOMAIN=""
 $(echo "$provider" | tr '[:lower:]' '[:upper:]')_SYSTEM_${system_num}_API_TOKEN=""
 $(echo "$provider" | tr '[:lower:]' '[:upper:]')_SYSTEM_${system_num}_PASSPHRASE=""
+EOF
+            ;;
+        "panorama")
+            cat >> "$ENV_TEMPLATE_FILE" <<EOF
+
+# $(echo "$provider" | tr '[:lower:]' '[:upper:]') - System ${system_num}
+$(echo "$provider" | tr '[:lower:]' '[:upper:]')_SYSTEM_${system_num}_DOMAIN=""
+$(echo "$provider" | tr '[:lower:]' '[:upper:]')_SYSTEM_${system_num}_API_HOST=""
+$(echo "$provider" | tr '[:lower:]' '[:upper:]')_SYSTEM_${system_num}_API_TOKEN=""
+$(echo "$provider" | tr '[:lower:]' '[:upper:]')_SYSTEM_${system_num}_PASSPHRASE=""
+$(echo "$provider" | tr '[:lower:]' '[:upper:]')_SYSTEM_${system_num}_TEMPLATE=""
 EOF
             ;;
         "rubrik")
@@ -287,6 +298,13 @@ EOF
                     echo "          \"api_token_env_var\": \"$(echo "$provider" | tr '[:lower:]' '[:upper:]')_SYSTEM_${i}_API_TOKEN\"," >> "$CONFIG_FILE"
                     echo "          \"passphrase_env_var\": \"$(echo "$provider" | tr '[:lower:]' '[:upper:]')_SYSTEM_${i}_PASSPHRASE\"" >> "$CONFIG_FILE"
                     ;;
+                "panorama")
+                    echo "          \"domain_env_var\": \"$(echo "$provider" | tr '[:lower:]' '[:upper:]')_SYSTEM_${i}_DOMAIN\"," >> "$CONFIG_FILE"
+                    echo "          \"api_host_env_var\": \"$(echo "$provider" | tr '[:lower:]' '[:upper:]')_SYSTEM_${i}_API_HOST\"," >> "$CONFIG_FILE"
+                    echo "          \"api_token_env_var\": \"$(echo "$provider" | tr '[:lower:]' '[:upper:]')_SYSTEM_${i}_API_TOKEN\"," >> "$CONFIG_FILE"
+                    echo "          \"passphrase_env_var\": \"$(echo "$provider" | tr '[:lower:]' '[:upper:]')_SYSTEM_${i}_PASSPHRASE\"," >> "$CONFIG_FILE"
+                    echo "          \"template_env_var\": \"$(echo "$provider" | tr '[:lower:]' '[:upper:]')_SYSTEM_${i}_TEMPLATE\"" >> "$CONFIG_FILE"
+                    ;;
                 "rubrik")
                     echo "          \"domain_env_var\": \"$(echo "$provider" | tr '[:lower:]' '[:upper:]')_SYSTEM_${i}_DOMAIN\"," >> "$CONFIG_FILE"
                     echo "          \"api_token_env_var\": \"$(echo "$provider" | tr '[:lower:]' '[:upper:]')_SYSTEM_${i}_API_TOKEN\"" >> "$CONFIG_FILE"